@@ -39,6 +39,8 @@ _schemas_loaded = False
 import pioneer.op.config_op
 import pioneer.op.log_op
 import pioneer.op.netconf_op
+import pioneer.op.netconf_session
+import pioneer.op.settings_cache
 import pioneer.op.yang_op
 from pioneer.op.ex import ActionError
 
@@ -90,7 +92,8 @@ class ActionHandler(threading.Thread):
                 raise ActionError({'error': "Operation not implemented: {0}".format(op_name)})
 
             handler_cls = self.handlers[op_name.tag]
-            handler = handler_cls(self.msocket, uinfo, dev_name, params, self.debug)
+            handler = handler_cls(self.msocket, uinfo, dev_name, params, self.debug,
+                                  self.session_pool, self.settings_cache)
             result = handler.perform()
             return self.action_response(uinfo, result)
 
@@ -144,21 +147,47 @@ class ActionHandler(threading.Thread):
     ##  REGISTRATION  ####################################################
     ######################################################################
 
+    # How often idle pooled NETCONF sessions are looked for, in seconds
+    session_expiry_interval = 10
+
+    # Configuration the settings cache is read from. Of the devices,
+    # only the leaves used to connect, so that the frequent changes to
+    # the rest of their configuration keep the cache
+    settings_cache_paths = ['/ncs:devices/device/address',
+                            '/ncs:devices/device/port',
+                            '/ncs:devices/device/authgroup',
+                            '/ncs:devices/device/device-type',
+                            '/ncs:devices/device/device-profile',
+                            '/ncs:devices/device/connect-timeout',
+                            '/ncs:devices/device/read-timeout',
+                            '/ncs:devices/device/ned-settings',
+                            '/ncs:devices/authgroups',
+                            '/ncs:devices/profiles',
+                            '/ncs:devices/global-settings',
+                            '/pioneer:pioneer']
+
     def __init__(self, debug, pipe):
         threading.Thread.__init__(self)
         self.debug = debug
         self.pipe = pipe
+        self.session_pool = pioneer.op.netconf_session.SessionPool(debug)
+        self.settings_cache = pioneer.op.settings_cache.SettingsCache(debug)
 
     def run(self):
         self.debug("Starting worker...")
 
+        invalidator = pioneer.op.settings_cache.CacheInvalidator(
+            self.debug, self.settings_cache, self.settings_cache_paths, self.pipe)
+        invalidator.start()
+
         stop = False
         while not stop:
             self.init_daemon()
 
             _r = [self.csocket, self.wsocket, self.pipe]
             while True:
-                (r, w, e) = select.select(_r, [], [])
+                (r, w, e) = select.select(_r, [], [], self.session_expiry_interval)
+                self.session_pool.expire_idle()
 
                 if self.pipe in r:
                     self.debug("Worker stop requested")
@@ -176,6 +205,8 @@ class ActionHandler(threading.Thread):
 
             self.stop_daemon()
 
+        self.session_pool.close_all()
+        invalidator.join()
         self.debug("Worker stopped")
 
     def cb_init(self, uinfo):
@@ -4,16 +4,19 @@
 #
 
 from __future__ import print_function
+import codecs
 import sys
 import os
 import re
-import threading
+import select
+import time
 
 from optparse import OptionParser, IndentedHelpFormatter
 import base64
 import socket
 from xml.dom import Node
 import xml.dom.minidom
+import xml.parsers.expat
 
 bufsiz = 16384
 ssh_trace_file = None
@@ -56,25 +59,20 @@ class IoCb(object):
             self, o.host, o.port, o.username, o.groups, o.supgroups)
 
 
-class OutputThread(threading.Thread):
-    def __init__(self, iocb, fd):
-        super(OutputThread, self).__init__()
-        self.iocb = iocb
-        self.fd = fd
-
-    def run(self):
-        buf = self.fd.read(bufsiz)
-        while buf:
-            self.iocb.output(buf)
-            buf = self.fd.read(bufsiz)
-
-
 class NetconfSSHLikeTransport(object):
     def __init__(self, iocb):
         self.iocb = iocb
-        self.buf_bytes = b""
+        # received bytes not yet handed out by recv_chunk_bytes()
+        self.rbuf = bytearray()
+        # bytes not yet sent, always less than bufsiz
+        self.wbuf = bytearray()
+        self.bytes_sent = 0
+        self.send_time = 0.0
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
         self.framing = FRAMING_1_0
         self.eom_found = False
+        # bytes of the current 1.1 chunk not yet received
+        self.chunk_left = 0
         self.trace = False
 
     def connect(self):
@@ -82,15 +80,8 @@ class NetconfSSHLikeTransport(object):
         pass
 
     def _send(self, buf):
-        # should be overridden by subclass
-        pass
-
-    def _send_eom(self):
-        # should be overridden by subclass
-        pass
-
-    def _flush(self):
-        # should be overridden by subclass, if needed
+        # should be overridden by subclass; send all of buf, which
+        # is a bytes-like object
         pass
 
     def _set_timeout(self, timeout=None):
@@ -101,11 +92,17 @@ class NetconfSSHLikeTransport(object):
         # should be overridden by subclass
         pass
 
+    def is_alive(self):
+        # should be overridden by subclass
+        return True
+
     def send(self, request):
+        data = bin_data(request)
+        if not data:
+            return
         if self.framing == FRAMING_1_1:
-            self._send('\n#{}\n{}'.format(len(request), str_data(request)))
-        else:
-            self._send(request)
+            self._write(('\n#%d\n' % len(data)).encode('ascii'))
+        self._write(data)
 
     def send_msg(self, request):
         self.send(request)
@@ -114,6 +111,44 @@ class NetconfSSHLikeTransport(object):
     def send_eom(self):
         self._send_eom()
 
+    def _send_eom(self):
+        self._write(bin_data(self._get_eom()))
+        self._flush()
+
+    def _flush(self):
+        if self.wbuf:
+            self._send_frame(self.wbuf)
+            del self.wbuf[:]
+
+    # Outgoing data is collected in wbuf and sent in frames of bufsiz
+    # bytes; the full frames of a large write are sent straight from
+    # the caller's buffer, without copying.
+    def _write(self, data):
+        wbuf = self.wbuf
+        if len(wbuf) + len(data) < bufsiz:
+            wbuf += data
+            return
+        view = memoryview(data)
+        pos = bufsiz - len(wbuf)
+        wbuf += view[:pos]
+        self._send_frame(wbuf)
+        del wbuf[:]
+        while len(view) - pos >= bufsiz:
+            self._send_frame(view[pos:pos + bufsiz])
+            pos += bufsiz
+        wbuf += view[pos:]
+
+    def _send_frame(self, frame):
+        start = time.time()
+        self._send(frame)
+        self.send_time += time.time() - start
+        self.bytes_sent += len(frame)
+
+    def send_stats(self):
+        rate = self.bytes_sent / max(self.send_time, 1e-6) / (1024 * 1024)
+        return "sent %d bytes in %.3f seconds, %.1f MB/s" % (
+            self.bytes_sent, self.send_time, rate)
+
     def _get_eom(self):
         if self.framing == FRAMING_1_0:
             return ']]>]]>'
@@ -126,102 +161,143 @@ class NetconfSSHLikeTransport(object):
     #      (-1, bytes) on socket EOF
     #      (0, "") on EOM
     #      (1, chunk-data) on data
+    #
+    # The returned chunk data is a bytearray owned by the caller, at
+    # most bufsiz bytes of a large 1.1 chunk at a time. Every received
+    # byte is copied a constant number of times, so receiving a message
+    # is linear in its size however it is chunked.
     def recv_chunk_bytes(self, timeout=None):
         self._set_timeout(timeout)
         if self.framing == FRAMING_1_0:
-            if self.eom_found:
-                self.eom_found = False
-                return (0, b"")
-            bytes = self.buf_bytes
-            self.buf_bytes = b""
-            while len(bytes) < 6:
-                x = self._recv(bufsiz)
-                if x == b"":
-                    return (-1, bytes)
-                bytes += x
-            idx = bytes.find(b"]]>]]>")
+            return self._recv_chunk_1_0()
+        else:
+            return self._recv_chunk_1_1()
+
+    def _fill_rbuf(self):
+        x = self._recv(bufsiz)
+        if not x:
+            return False
+        self.rbuf += x
+        return True
+
+    def _take_rbuf(self, n):
+        # hand out the first n bytes of rbuf; the larger part changes
+        # owner, only the smaller part is copied
+        buf = self.rbuf
+        if n >= len(buf):
+            self.rbuf = bytearray()
+        elif n > len(buf) - n:
+            self.rbuf = buf[n:]
+            del buf[n:]
+        else:
+            self.rbuf = buf
+            buf = buf[:n]
+            del self.rbuf[:n]
+        return buf
+
+    def _recv_chunk_1_0(self):
+        if self.eom_found:
+            self.eom_found = False
+            return (0, b"")
+        # look for the eom marker, only in what has not been searched
+        # before, except for the last 5 bytes that might contain the
+        # beginning of the marker
+        start = 0
+        while True:
+            idx = self.rbuf.find(b"]]>]]>", start)
             if idx > -1:
-                # eom marker found; store rest in buf
+                # eom marker found; keep the rest in rbuf
                 self.eom_found = True
-                self.buf_bytes = bytes[idx + 6:]
-                return (1, bytes[:idx])
-            else:
+                data = self._take_rbuf(idx)
+                del self.rbuf[:6]
+                return (1, data)
+            if len(self.rbuf) > 5:
                 # no eom marker found, keep the last 5 bytes
                 # (might contain parts of the eom marker)
-                self.buf_bytes = bytes[-5:]
-                return (1, bytes[:-5])
-        else:
-            # new framing
-            bytes = self.buf_bytes
-            self.buf_bytes = b""
-            # make sure we have at least 4 bytes; LF HASH INT/HASH LF
-            while len(bytes) < 4:
-                x = self._recv(bufsiz)
-                if x == b"":
-                    # error, return what we have
-                    return (-1, bytes)
-                bytes += x
-            # check the first two bytes
-            if bytes[0:2] != b"\n#":
-                # framing error
-                return (-2, bytes)
-            # read the chunk size
-            sz = -1
-            while sz == -1:
-                # find the terminating LF
-                idx = bytes.find(b"\n", 2)
-                if idx > 12:
-                    # framing error - too large integer or not correct
-                    # chunk size specification
-                    return (-2, bytes)
-                if idx > -1:
-                    # newline found, scan for number of bytes to read
-                    try:
-                        sz = int(bytes[2:idx])
-                        if sz < 1 or sz > 4294967295:
-                            # framing error - range error
-                            return (-2, bytes)
-                    except:
-                        if bytes[2:idx] == b"#":
-                            # EOM
-                            self.buf_bytes = bytes[idx + 1:]
-                            return (0, b"")
-                        # framing error - not an integer, and not EOM
-                        return (-2, bytes)
-                    # skip the chunk size.  the while loop is now done
-                    bytes = bytes[idx+1:]
-                else:
-                    # terminating LF not found, read more
-                    x = self._recv(bufsiz)
-                    if x == b"":
-                        # error, return what we have
-                        return (-1, bytes)
-                    bytes += x
-            # read the chunk data
-            while len(bytes) < sz:
-                x = self._recv(bufsiz)
-                if x == b"":
-                    return (-1, bytes)
-                bytes += x
-            # save rest of data
-            self.buf_bytes = bytes[sz:]
-            return (1, bytes[:sz])
+                return (1, self._take_rbuf(len(self.rbuf) - 5))
+            start = max(0, len(self.rbuf) - 5)
+            if not self._fill_rbuf():
+                return (-1, self._take_rbuf(len(self.rbuf)))
+
+    def _recv_chunk_1_1(self):
+        # new framing
+        if self.chunk_left:
+            return self._recv_chunk_data()
+        # make sure we have at least 4 bytes; LF HASH INT/HASH LF
+        while len(self.rbuf) < 4:
+            if not self._fill_rbuf():
+                # error, return what we have
+                return (-1, self._take_rbuf(len(self.rbuf)))
+        # check the first two bytes
+        if self.rbuf[0:2] != b"\n#":
+            # framing error
+            return (-2, self._take_rbuf(len(self.rbuf)))
+        # read the chunk size
+        while True:
+            # find the terminating LF
+            idx = self.rbuf.find(b"\n", 2, 14)
+            if idx > -1:
+                break
+            if len(self.rbuf) >= 14:
+                # framing error - too large integer or not correct
+                # chunk size specification
+                return (-2, self._take_rbuf(len(self.rbuf)))
+            # terminating LF not found, read more
+            if not self._fill_rbuf():
+                # error, return what we have
+                return (-1, self._take_rbuf(len(self.rbuf)))
+        if self.rbuf[2:idx] == b"#":
+            # EOM
+            del self.rbuf[:idx + 1]
+            return (0, b"")
+        # scan for number of bytes to read
+        try:
+            sz = int(bytes(self.rbuf[2:idx]))
+        except ValueError:
+            # framing error - not an integer, and not EOM
+            return (-2, self._take_rbuf(len(self.rbuf)))
+        if sz < 1 or sz > 4294967295:
+            # framing error - range error
+            return (-2, self._take_rbuf(len(self.rbuf)))
+        # skip the chunk size
+        del self.rbuf[:idx + 1]
+        self.chunk_left = sz
+        return self._recv_chunk_data()
+
+    def _recv_chunk_data(self):
+        # hand out what is buffered of the current chunk, or else
+        # receive at most bufsiz bytes of it, so that a large chunk
+        # is never held in memory whole
+        if not self.rbuf:
+            x = self._recv(min(self.chunk_left, bufsiz))
+            if not x:
+                self.chunk_left = 0
+                return (-1, bytearray())
+            self.rbuf += x
+        data = self._take_rbuf(min(self.chunk_left, len(self.rbuf)))
+        self.chunk_left -= len(data)
+        return (1, data)
 
     def recv_chunk(self, timeout=None):
         (flag, bytes) = self.recv_chunk_bytes(timeout=timeout)
-        return (flag, str_data(bytes))
+        if sys.hexversion < 0x03000000:
+            return (flag, str(bytes))
+        # decode across chunk boundaries, a chunk may end in the
+        # middle of a multi-byte character
+        try:
+            return (flag, self.decoder.decode(bytes, final=(flag != 1)))
+        finally:
+            if flag != 1:
+                self.decoder.reset()
 
     def recv_msg(self, timeout=None):
-        msg = ""
+        msg = []
         while True:
             (code, bytes) = self.recv_chunk(timeout)
-            if code == 1:
-                msg += bytes
-            elif code == 0:
-                return msg
-            else:
-                # error
-                return msg + bytes
+            msg.append(bytes)
+            if code != 1:
+                # EOM or error
+                return "".join(msg)
 
     # sort-of socket.create_connection() (new in 2.6)
     def create_connection(iocb, host, port):
@@ -267,7 +343,6 @@ class NetconfSSH(NetconfSSHLikeTransport):
         self.publicKeyType =  publicKeyType
         self.password  = password
         self.username = username
-        self.saved = ""
 
     def connect(self):
         sock = self.create_connection(self.hostname, self.port)
@@ -309,48 +384,19 @@ class NetconfSSH(NetconfSSHLikeTransport):
 
     def _send(self, buf):
         global ssh_trace_file
+        buf = bin_data(buf)
+        if not isinstance(buf, bytes):
+            # paramiko wants bytes
+            buf = bytes(buf) if isinstance(buf, bytearray) else buf.tobytes()
         try:
-#            self.chan.sendall(buf)
-#            return
-            if self.saved:
-                buf = self.saved + buf
-            # sending too little data in each SSH packet makes the
-            # transfer slow.
-            # paramiko still has  bug (?) where it doensn't send a full
-            # SSH message, but keeps 64 bytes.  so we will send MAX-64, 64,
-            # MAX-64, 64, ... instead of MAX all the time.
-            if len(buf) < bufsiz:
-                self.saved = buf
-            else:
-                payload = buf[:bufsiz]
-                if ssh_trace_file:
-                    print("%s" % payload, file=ssh_trace_file)
-                self.chan.sendall(buf[:bufsiz])
-                self.saved = buf[bufsiz:]
-        except socket.error as x:
-            self.iocb.output_err('socket error: %s' % (str(x), ))
-
-    def _send_eom(self):
-        global ssh_trace_file
-        try:
-            payload = self.saved + self._get_eom()
             if ssh_trace_file:
-                print("%s" % payload, file=ssh_trace_file)
-            self.chan.sendall(self.saved + self._get_eom())
-            self.saved = ""
-        except socket.error as x:
-            self.saved = ""
-            self.iocb.output_err('socket error: %s' % (str(x), ))
-
-    def _flush(self):
-        global ssh_trace_file
-        try:
-            if ssh_trace_file:
-                print("%s" % self.saved, file=ssh_trace_file)
-            self.chan.sendall(self.saved)
-            self.saved = ""
+                if sys.hexversion >= 0x03000000:
+                    # a frame may end in the middle of a character
+                    print("%s" % buf.decode('utf-8', 'replace'), file=ssh_trace_file)
+                else:
+                    print("%s" % buf, file=ssh_trace_file)
+            self.chan.sendall(buf)
         except socket.error as x:
-            self.saved = ""
             self.iocb.output_err('socket error: %s' % (str(x), ))
 
     def _recv(self, bufsiz):
@@ -362,6 +408,14 @@ class NetconfSSH(NetconfSSHLikeTransport):
     def _set_timeout(self, timeout=None):
         self.chan.settimeout(timeout)
 
+    def is_alive(self):
+        # an idle session should have nothing to read; anything
+        # pending means EOF or data we did not ask for
+        return (self.ssh.is_active() and
+                not self.chan.closed and
+                not self.chan.eof_received and
+                not self.chan.recv_ready())
+
     def close(self):
         self.ssh.close()
         return True
@@ -386,13 +440,10 @@ class NetconfTCP(NetconfSSHLikeTransport):
 
     def _send(self, buf):
         try:
-            self.sock.send(bin_data(buf))
+            self.sock.sendall(bin_data(buf))
         except socket.error as x:
             self.iocb.output_err('socket error: %s' % (str(x), ))
 
-    def _send_eom(self):
-        self._send(self._get_eom())
-
     def _recv(self, bufsiz):
         s = self.sock.recv(bufsiz)
         if self.trace:
@@ -402,6 +453,15 @@ class NetconfTCP(NetconfSSHLikeTransport):
     def _set_timeout(self, timeout=None):
         self.sock.settimeout(timeout)
 
+    def is_alive(self):
+        # an idle session should have nothing to read; a readable
+        # socket means EOF or data we did not ask for
+        try:
+            (r, w, e) = select.select([self.sock], [], [self.sock], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not r and not e
+
     def close(self):
         self.sock.close()
         return True
@@ -416,24 +476,371 @@ class HelpFormatterWithLineBreaks(IndentedHelpFormatter):
         return result
 
 def bin_data(buf):
-    if sys.hexversion >= 0x03000000 and isinstance(buf, str):
+    if sys.hexversion >= 0x03000000:
+        if isinstance(buf, str):
+            return buf.encode('utf-8')
+    elif isinstance(buf, unicode):
         return buf.encode('utf-8')
     return buf
 
 
 def str_data(buf):
-    if sys.hexversion >= 0x03000000 and isinstance(buf, bytes):
+    if sys.hexversion >= 0x03000000 and isinstance(buf, (bytes, bytearray)):
         return buf.decode('utf-8')
     return buf
 
-def write_fd(iocb, fd, data):
+class _FormatElement(object):
+    # An element of XmlFormatter. Until it is emitted, its children
+    # are kept as elements and strings of markup or text.
+    def __init__(self, name, tag, level, preserve):
+        self.name = name
+        self.tag = tag
+        self.level = level
+        self.preserve = preserve
+        self.children = []
+        self.size = len(tag)
+        self.count = 0
+        self.first_kind = None
+        self.last_kind = None
+        # has text content, so is printed as-is
+        self.verbatim = False
+        self.emitted = False
+        # emitted, but not known to be empty or not
+        self.pending = False
+        # children are indented
+        self.formatted = True
+
+
+class XmlFormatter(object):
+    """Incremental XML pretty-printer, giving the same output as
+    'xmllint --format -'. Data is fed as it arrives and the formatted
+    text is passed to write() as soon as it is known.
+
+    Like libxml2, whitespace-only text is dropped where it is not the
+    only content of an element nor next to other text, and an element
+    with text among its children is printed as-is. Whether an element
+    has text is known only at its end, so elements are kept until
+    then. When more than max_buffered characters are kept, the
+    outermost element kept is printed indented; text that comes later
+    in it gets a line of its own. NETCONF content is never mixed, so
+    in practice the output is the same."""
+
+    indent = "  "
+    # libxml2 indents at most this many levels
+    max_indent = 30
+    max_buffered = 1024 * 1024
+
+    def __init__(self, write):
+        self.write = write
+        self.out = []
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.ordered_attributes = True
+        self.parser.buffer_text = True
+        self.parser.XmlDeclHandler = self._xml_decl
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+        self.parser.CommentHandler = self._comment
+        self.parser.ProcessingInstructionHandler = self._pi
+        self.parser.StartCdataSectionHandler = self._start_cdata
+        self.parser.EndCdataSectionHandler = self._end_cdata
+        self.started = False
+        # without a declared encoding xmllint prints non-ASCII
+        # characters as character references
+        self.ascii_only = True
+        # the document, as an element whose children are not indented
+        document = _FormatElement(None, "", -1, False)
+        document.emitted = True
+        self.stack = [document]
+        self.text = []
+        self.blank = True
+        self.cdata = None
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+        self._flush_out()
+
+    def close(self):
+        self.parser.Parse("", True)
+        self._flush_out()
+
+    def _flush_out(self):
+        if self.out:
+            out = "".join(self.out)
+            self.out = []
+            if sys.hexversion < 0x03000000 and isinstance(out, unicode):
+                out = out.encode('utf-8')
+            self.write(out)
+
+    def _emit(self, text):
+        if not self.started:
+            self.out.append('<?xml version="1.0"?>\n')
+            self.started = True
+        self.out.append(text)
+
+    def _xml_decl(self, version, encoding, standalone):
+        decl = '<?xml version="%s"' % (version or "1.0")
+        if encoding:
+            decl += ' encoding="%s"' % encoding
+            self.ascii_only = encoding.lower() not in ('utf-8', 'utf8')
+        if standalone != -1:
+            decl += ' standalone="%s"' % ("yes" if standalone else "no")
+        self.out.append(decl + '?>\n')
+        self.started = True
+
+    def _escape(self, s, table):
+        s = s.replace('&', '&amp;')
+        for (c, ref) in table:
+            s = s.replace(c, ref)
+        if self.ascii_only:
+            s = re.sub(u'[^\x00-\x7f]', lambda m: '&#x%X;' % ord(m.group()), s)
+        return s
+
+    _text_refs = (('<', '&lt;'), ('>', '&gt;'), ('\r', '&#13;'))
+    _attr_refs = (('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'),
+                  ('\n', '&#10;'), ('\r', '&#13;'), ('\t', '&#9;'))
+
+    def _indent(self, level):
+        return self.indent * min(level, self.max_indent)
+
+    def _render(self, element, formatted, out):
+        # Appends the text of a complete element to out
+        formatted = formatted and not element.verbatim
+        out.append(element.tag)
+        if not element.children:
+            out.append('/>')
+            return
+        out.append('>')
+        if formatted:
+            out.append('\n')
+        for child in element.children:
+            if formatted:
+                out.append(self._indent(element.level + 1))
+            if isinstance(child, _FormatElement):
+                self._render(child, formatted, out)
+            else:
+                out.append(child)
+            if formatted:
+                out.append('\n')
+        if formatted:
+            out.append(self._indent(element.level))
+        out.append('</' + element.name + '>')
+
+    def _open_pending(self, element):
+        if element.pending:
+            self._emit('>\n' if element.formatted else '>')
+            element.pending = False
+
+    def _emit_child(self, parent, child):
+        # Prints a complete child of an emitted element
+        self._open_pending(parent)
+        out = []
+        if parent.formatted:
+            out.append(self._indent(parent.level + 1))
+        if isinstance(child, _FormatElement):
+            self._render(child, parent.formatted, out)
+        else:
+            out.append(child)
+        if parent.formatted:
+            out.append('\n')
+        self._emit("".join(out))
+
+    def _add_child(self, parent, child, kind):
+        parent.count += 1
+        if parent.first_kind is None:
+            parent.first_kind = kind
+        parent.last_kind = kind
+        if kind in ('text', 'cdata'):
+            parent.verbatim = True
+        if isinstance(child, _FormatElement):
+            if parent.emitted and not parent.formatted:
+                # within an element printed as-is, so is this one
+                self._open_pending(parent)
+                self._emit(child.tag)
+                child.emitted = True
+                child.pending = True
+                child.formatted = False
+            elif not parent.emitted:
+                parent.children.append(child)
+        elif parent.emitted:
+            self._emit_child(parent, child)
+        else:
+            parent.children.append(child)
+            parent.size += len(child)
+        self._emit_decided()
+
+    def _emit_decided(self):
+        # Prints the start of the outermost element kept, with what it
+        # has so far, once it is known to have text, or when too much
+        # is kept
+        while True:
+            i = 1
+            while i < len(self.stack) and self.stack[i].emitted:
+                i += 1
+            if i == len(self.stack):
+                return
+            (parent, element) = (self.stack[i - 1], self.stack[i])
+            if element.verbatim:
+                formatted = False
+            elif sum(e.size for e in self.stack[i:]) > self.max_buffered:
+                formatted = parent.formatted
+            else:
+                return
+            self._open_pending(parent)
+            out = [self._indent(element.level)] if parent.formatted else []
+            out.append(element.tag)
+            element.emitted = True
+            element.formatted = formatted
+            children = element.children
+            element.children = None
+            if i + 1 < len(self.stack):
+                # the open child is printed when it is decided
+                children = children[:-1]
+            if element.count == 0:
+                element.pending = True
+            else:
+                out.append('>\n' if formatted else '>')
+                for child in children:
+                    if formatted:
+                        out.append(self._indent(element.level + 1))
+                    if isinstance(child, _FormatElement):
+                        self._render(child, formatted, out)
+                    else:
+                        out.append(child)
+                    if formatted:
+                        out.append('\n')
+            self._emit("".join(out))
+
+    def _flush_text(self, closing):
+        if not self.text:
+            return
+        content = "".join(self.text)
+        self.text = []
+        blank = self.blank
+        self.blank = True
+        parent = self.stack[-1]
+        if parent.level < 0:
+            # outside the root element
+            return
+        if blank and not parent.preserve and not (closing and parent.count == 0) \
+           and parent.first_kind != 'text' and parent.last_kind != 'text':
+            # whitespace between elements
+            return
+        self._add_child(parent, content, 'text')
+
+    def _start(self, name, attrs):
+        self._flush_text(False)
+        parent = self.stack[-1]
+        # namespace declarations first, as libxml2 keeps them apart
+        pairs = [(attrs[i], attrs[i + 1]) for i in range(0, len(attrs), 2)]
+        pairs = ([p for p in pairs if p[0] == 'xmlns' or p[0].startswith('xmlns:')] +
+                 [p for p in pairs if not (p[0] == 'xmlns' or p[0].startswith('xmlns:'))])
+        tag = '<' + name
+        preserve = parent.preserve
+        for (attr, value) in pairs:
+            tag += ' %s="%s"' % (attr, self._escape(value, self._attr_refs))
+            if attr == 'xml:space':
+                preserve = value == 'preserve'
+        element = _FormatElement(name, tag, parent.level + 1, preserve)
+        self._add_child(parent, element, 'element')
+        self.stack.append(element)
+        self._emit_decided()
+
+    def _end(self, name):
+        self._flush_text(True)
+        element = self.stack.pop()
+        parent = self.stack[-1]
+        if element.emitted:
+            if element.pending:
+                out = '/>'
+            elif element.formatted:
+                out = self._indent(element.level) + '</' + name + '>'
+            else:
+                out = '</' + name + '>'
+            if parent.formatted:
+                out += '\n'
+            self._emit(out)
+        elif parent.emitted:
+            self._emit_child(parent, element)
+        else:
+            parent.size += element.size
+
+    def _text(self, data):
+        if self.cdata is not None:
+            self.cdata.append(data)
+            return
+        if self.blank and data.strip(' \t\r\n'):
+            self.blank = False
+        self.text.append(self._escape(data, self._text_refs))
+
+    def _start_cdata(self):
+        self._flush_text(False)
+        self.cdata = []
+
+    def _end_cdata(self):
+        data = '<![CDATA[' + "".join(self.cdata) + ']]>'
+        self.cdata = None
+        if self.stack[-1].level >= 0:
+            self._add_child(self.stack[-1], data, 'cdata')
+
+    def _misc(self, markup):
+        self._flush_text(False)
+        self._add_child(self.stack[-1], markup, 'misc')
+
+    def _comment(self, data):
+        self._misc('<!--' + data + '-->')
+
+    def _pi(self, target, data):
+        self._misc('<?' + target + (' ' + data if data else '') + '?>')
+
+
+class AaaFilter(object):
+    """Line filter for pretty-printed XML, dropping the Tail-f AAA and
+    IETF NACM subtrees (the noaaa style)."""
+    start_re = re.compile(r'<(aaa|nacm)')
+    end_re = re.compile(r'</(aaa|nacm)>')
+
+    def __init__(self, write):
+        self.write = write
+        self.partial = []
+        self.deleting = False
+
+    def __call__(self, data):
+        if "\n" not in data:
+            self.partial.append(data)
+            return
+        self.partial.append(data)
+        lines = "".join(self.partial).split("\n")
+        self.partial = [lines.pop()]
+        out = [line + "\n" for line in lines if self._keep(line)]
+        if out:
+            self.write("".join(out))
+
+    def _keep(self, line):
+        if self.start_re.search(line):
+            self.deleting = True
+        if self.end_re.search(line):
+            self.deleting = False
+            return False
+        return not self.deleting
+
+
+def format_xml(data):
+    out = []
+    formatter = XmlFormatter(out.append)
+    formatter.feed(data)
+    formatter.close()
+    return "".join(out)
+
+def format_chunk(iocb, formatter, chunk):
+    # chunk None ends the message
     try:
-        if fd == sys.stdout:
-            fd.write(str_data(data))
+        if chunk is None:
+            formatter.close()
         else:
-            fd.write(bin_data(data))
-    except:
-        iocb.abort("Problem with xmllint executable. Is it in PATH?")
+            formatter.feed(chunk)
+    except xml.parsers.expat.ExpatError as e:
+        iocb.abort("Malformed XML in reply: %s" % (e, ))
 
 def hello_msg(versions):
     s = '''<?xml version="1.0" encoding="UTF-8"?>
@@ -559,13 +966,22 @@ def copy_running_to_startup_msg():
     </copy-config>
 </rpc>'''
 
-def get_schema_msg(identifier):
+def get_schema_msg(identifier, message_id="1"):
     return '''<?xml version="1.0" encoding="UTF-8"?>
-<rpc xmlns="urn:ietf:params:xml:ns:netconf:base:1.0" message-id="1">
+<rpc xmlns="urn:ietf:params:xml:ns:netconf:base:1.0" message-id="%s">
     <get-schema xmlns="urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring">
       <identifier>%s</identifier>
     </get-schema>
-</rpc>''' % identifier
+</rpc>''' % (message_id, identifier)
+
+def reply_message_id(reply):
+    """Return the message-id attribute of the <rpc-reply> in reply,
+    or None if there is none."""
+    m = re.search(r'''<(?:[\w.-]+:)?rpc-reply\b[^>]*?\smessage-id\s*=\s*["']([^"']*)["']''',
+                  reply)
+    if m:
+        return m.group(1)
+    return None
 
 def create_subscription_msg(stream, xpath):
     if xpath == "":
@@ -623,47 +1039,119 @@ def get_file(name):
     else:
         return open(name, "r")
 
-def extract_save_yang(dirname,capa):
+class SchemaWriter(object):
+    """Writes the module text of a get-schema reply to the file f as
+    the reply is received. rpc_error tells if the reply was an
+    rpc-error, error holds the parse error, if any."""
+    def __init__(self, f):
+        self.f = f
+        self.depth = 0
+        self.in_data = False
+        self.rpc_error = False
+        self.error = None
+        self.parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+
+    def feed(self, data, final=False):
+        if self.error is not None:
+            return
+        if sys.hexversion < 0x03000000 and isinstance(data, bytearray):
+            data = str(data)
+        try:
+            self.parser.Parse(data, final)
+        except (xml.parsers.expat.ExpatError, IOError, OSError) as e:
+            self.error = e
+
+    def close(self):
+        self.feed(b"", True)
+
+    def _start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name == nc_ns + ' rpc-error':
+                self.rpc_error = True
+            elif name.endswith(' data'):
+                self.in_data = True
+
+    def _end(self, name):
+        if self.depth == 2:
+            self.in_data = False
+        self.depth -= 1
+
+    def _text(self, data):
+        if self.in_data:
+            self.f.write(data.encode('utf-8'))
+
+def extract_save_yang(c,dirname,capa):
     modre = re.compile("module=([^&\?]+)").search(capa)
     if modre:
         global count_yangs, count_yangs_written
         count_yangs += 1
         modname = modre.groups()[0]
         c.send_msg(get_schema_msg(modname))
-        reply = c.recv_msg()
-        d = xml.dom.minidom.parseString(reply)
-        if d is not None:
-            d = d.firstChild
-        if d is not None:
-            d = d.firstChild
-        strip(d)
-        if (d.namespaceURI == nc_ns and
-            d.localName == 'rpc-error'):
-            print ("Could not get schema for %s.yang"%modname)
+        filename = "%s/%s.yang"%(dirname,modname)
+        try:
+            f = open(filename + ".part", "wb")
+        except:
+            f = None
+        writer = SchemaWriter(f)
+        while True:
+            (code, chunk) = c.recv_chunk_bytes()
+            if code < 0:
+                writer.error = "unexpected end of reply"
+                break
+            if code == 0:
+                break
+            if f is not None:
+                writer.feed(chunk)
+        if f is None:
+            print ("Could not write schema into %s"%filename)
+            return
+        writer.close()
+        f.close()
+        if writer.rpc_error or writer.error is not None:
+            os.remove(filename + ".part")
+            if writer.rpc_error:
+                print ("Could not get schema for %s.yang"%modname)
+            else:
+                print ("Could not parse schema for %s.yang"%modname)
             return
+        try:
+            os.rename(filename + ".part", filename)
+            print ("Wrote schema into %s"%filename)
+            count_yangs_written += 1
+        except:
+            print ("Could not write schema into %s"%filename)
 
-        ## Can't find some good way to extract actual YANG module
-        ## from minidom, so here goes:
-
-        yangre = re.compile(".*(module +[a-zA-Z0-9_-]+ *{.+}).*</data>.*",
-                            re.MULTILINE|re.DOTALL).search(reply)
-        if yangre:
-            yangtext = yangre.groups()[0]
-            yangtext = yangtext.replace("&lt;","<").\
-                                replace("&gt;",">").\
-                                replace("&amp;","&").\
-                                replace("&quot;","\'")
-            filename = "%s/%s.yang"%(dirname,modname)
-            try:
-                f = open(filename,"w")
-                print(yangtext, file=f)
-                f.close()
-                print ("Wrote schema into %s"%filename)
-                count_yangs_written += 1
-            except:
-                print ("Could not write schema into %s"%filename)
-        else:
-            print ("Could not parse schema for %s.yang"%modname)
+
+def select_framing(c, hello_reply, versions):
+    """Switch the transport c to 1.1 framing if both we and the
+    server, according to its hello_reply, support base 1.1."""
+    d = xml.dom.minidom.parseString(hello_reply)
+    if d is not None:
+        d = d.firstChild
+    if d is not None:
+        strip(d)
+        if (d.namespaceURI == nc_ns and
+            d.localName == 'hello' and
+            d.firstChild is not None):
+            d = d.firstChild
+            strip(d)
+            if (d.namespaceURI == nc_ns and
+                d.localName == 'capabilities'):
+                d = d.firstChild
+                strip(d)
+                while (d is not None):
+                    if (d.namespaceURI == nc_ns and
+                        d.localName == 'capability'):
+                        if ('1.1' in versions and
+                            d.firstChild and d.firstChild.nodeValue.strip() == base_1_1):
+                            # switch to new framing
+                            c.framing = FRAMING_1_1
+                    d = d.nextSibling
 
 
 def parse_args(sys_args):
@@ -692,6 +1180,8 @@ def parse_args(sys_args):
                       " test scripts")
     parser.add_option("--ssh-output-trace", dest="ssh_trace", default="",
                       help="Write a copy of all SSH data sent in a file")
+    parser.add_option("--send-stats", dest="send_stats", action="store_true",
+                      help="Print the number of bytes sent and the send throughput to stderr")
     parser.add_option("-i", "--interactive", dest="interactive", action="store_true")
 
     styleopts = parser.add_option_group("Style Options")
@@ -892,35 +1382,15 @@ def main(sys_args, iocb, logger=None):
 
     # parse the hello message to figure out which framing
     # protocol to use
-    d = xml.dom.minidom.parseString(hello_reply)
-    if d is not None:
-        d = d.firstChild
-    if d is not None:
-        strip(d)
-        if (d.namespaceURI == nc_ns and
-            d.localName == 'hello' and
-            d.firstChild is not None):
-            d = d.firstChild
-            strip(d)
-            if (d.namespaceURI == nc_ns and
-                d.localName == 'capabilities'):
-                d = d.firstChild
-                strip(d)
-                while (d is not None):
-                    if (d.namespaceURI == nc_ns and
-                        d.localName == 'capability'):
-                        if ('1.1' in versions and
-                            d.firstChild and d.firstChild.nodeValue.strip() == base_1_1):
-                            # switch to new framing
-                            c.framing = FRAMING_1_1
-                    d = d.nextSibling
+    select_framing(c, hello_reply, versions)
 
     if cmdf is not None or dataf is not None:
         # Send the request from file
         if cmdf is not None:
             f = cmdf
-            # use raw send function; do not add framing
-            send = c._send
+            # write without framing, the file has it; writes are still
+            # buffered and counted in the send stats
+            send = lambda data: c._write(bin_data(data))
         else:
             f = dataf
             send = c.send
@@ -979,7 +1449,7 @@ def main(sys_args, iocb, logger=None):
                             if (d.namespaceURI == nc_ns and
                                 d.localName == 'capability'):
                                 capa = d.firstChild.nodeValue.strip()
-                                extract_save_yang(dirname,capa)
+                                extract_save_yang(c,dirname,capa)
                             d = d.nextSibling
 
             print ("Managed to write %s/%s YANG files"%(count_yangs_written,count_yangs))
@@ -1004,19 +1474,6 @@ def main(sys_args, iocb, logger=None):
     if o.style == 'default':
         o.style = 'pretty'
 
-    # possibly set up for pretty printing through xmllint
-    if o.style == "noaaa":
-        noaaa = "|awk ' BEGIN { del=0} /<(aaa|nacm)/ {del=1} /<\/(aaa|nacm)>/ {del=0;next} del == 1 {next} {print}'"
-    else:
-        noaaa = ""
-    xmllint = "xmllint --format - " + noaaa
-
-    if sys.hexversion >= 0x02060000:
-        import subprocess
-        use_subprocess = True
-    else:
-        use_subprocess = False
-
     do_print = True
     is_closed = False
     chunk = ""
@@ -1029,24 +1486,15 @@ def main(sys_args, iocb, logger=None):
         n = 0
 
     while not is_closed and (n != 0 or o.interactive):
-        output_thread = None
+        formatter = None
         if do_print and o.style in ("pretty", "all", "noaaa"):
-            if use_subprocess:
-                p = subprocess.Popen(xmllint, shell=True,
-                                     stdin=subprocess.PIPE,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-                forward_fun = lambda chunk: write_fd(iocb, p.stdin, chunk)
-                p.stderr.close()
-                output_thread = OutputThread(iocb, p.stdout)
-                output_thread.start()
+            if o.style == "noaaa":
+                formatter = XmlFormatter(AaaFilter(iocb.output))
             else:
-                p = os.popen(xmllint + " 2>/dev/null", 'w')
-                forward_fun = lambda chunk: write_fd(iocb, p, chunk)
-
+                formatter = XmlFormatter(iocb.output)
+            forward_fun = lambda chunk: format_chunk(iocb, formatter, chunk)
         else:
             forward_fun = iocb.output
-            p = None
 
         if o.interactive:
             msg = read_msg()
@@ -1089,23 +1537,9 @@ def main(sys_args, iocb, logger=None):
                 # we have received a full message
                 break
 
-        if p is not None:
+        if formatter is not None:
             if nchunks > 0:
-                if use_subprocess:
-                    p.stdin.close()
-                    p.wait()
-                    retcode = p.returncode
-                else:
-                    if fd.close() is None:
-                        retcode = 0
-                    else:
-                        retcode = 1
-
-                if output_thread is not None:
-                    output_thread.join()
-
-                if retcode != 0:
-                    iocb.abort("Problem with xmllint executable. Is it in PATH?")
+                format_chunk(iocb, formatter, None)
 
             if (o.style != "all") and (o.style != "raw") and (o.style != "plain"):
                 # don't print the rest of the replies
@@ -1124,6 +1558,10 @@ def main(sys_args, iocb, logger=None):
         close_reply = c.recv_msg()
 
     # Done
+    if logger:
+        logger.debug("NC: %s" % c.send_stats())
+    if o.send_stats:
+        iocb.output_err(c.send_stats())
     c.close()
     if (ssh_trace_file):
         ssh_trace_file.close()
@@ -19,12 +19,17 @@ class BaseOp(object):
     pkg_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
     ncs_run_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(pkg_root_dir))))
     ncs_rollback_dir = os.path.join(ncs_run_dir, "logs")
-    states_dir = os.path.join(ncs_run_dir, "logs")
+    states_dir = os.path.join(ncs_run_dir, "pioneer-states")
+    legacy_states_dir = os.path.join(ncs_run_dir, "logs")
+    yang_cache_dir = os.path.join(ncs_run_dir, "pioneer-yang-cache")
 
-    def __init__(self, msocket, uinfo, dev_name, params, debug_func):
+    def __init__(self, msocket, uinfo, dev_name, params, debug_func, session_pool=None,
+                 settings_cache=None):
         self.msocket = msocket
         self.uinfo = uinfo
         self.dev_name = dev_name
+        self.session_pool = session_pool
+        self.settings_cache = settings_cache
 
         self.debug = debug_func
 
@@ -40,6 +45,13 @@ class BaseOp(object):
             return default
         return str(matching_param_list[0])
 
+    def cached(self, dev_name, key, load_fun):
+        # Values read from configuration are cached by the action
+        # daemon; ops run elsewhere read them every time
+        if self.settings_cache is None:
+            return load_fun()
+        return self.settings_cache.get(dev_name, key, load_fun)
+
     def extend_timeout(self, timeout_extension):
         dp.action_set_timeout(self.uinfo, timeout_extension)
 
@@ -1,53 +1,178 @@
 # -*- mode: python; python-indent: 4 -*-
 
-import fnmatch
+import collections
+import csv
+import glob
+import hashlib
+import json
+import math
 import os
-import random
+import re
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import _ncs
 import _ncs.maapi as maapi
 
 import pioneer.op.netconf_op as netconf_op
+import pioneer.op.state_store as state_store
+import pioneer.op.state_subtrees as state_subtrees
+import pioneer.op.transition_plan as transition_plan
 import pioneer.namespaces.pioneer_ns as ns
 from pioneer.op.ex import ActionError
 
 class ConfigOp(netconf_op.NetconfOp):
-    def state_name_to_filename(self, statename, devname):
-        return devname + '--' + statename + '.state.cb'
-
-    def state_filename_to_name(self, filename, devname):
-        return filename[len(devname)+2:-9]
-
-    def transition_to_state(self, to_state_filename):
-        filename = os.path.join(self.states_dir, to_state_filename)
-        if not os.path.exists(filename):
-            state_name = self.state_filename_to_name(to_state_filename, self.dev_name)
-            raise ActionError({'error': 'No such state: {0}'.format(state_name)})
-
+    verify_methods = ['compare-config', 'check-sync']
+    verify = 'compare-config'
+
+    def param_enum(self, params, tag, values):
+        # Enumerations arrive as their values, in the order of values
+        # as in pioneer.yang; the first is the default
+        value = self.param_default(params, tag, "0")
+        return values[int(value)] if value.isdigit() else value
+
+    def state_store(self):
+        return state_store.StateStore(self.states_dir, self.legacy_states_dir, self.debug)
+
+    def transition_to_state(self, filename, dev_name=None, msocket=None,
+                            extend_timeout=None, from_filename=None, times=None,
+                            record=None):
+        # Load the state in filename, a checkout of the state store.
+        # dev_name and msocket default to the action's device and
+        # socket; extend_timeout replaces extending the action timeout
+        # when called outside the action thread. If the device is known
+        # to be in the state from_filename, only the subtrees that
+        # differ are replaced. times is a TransitionTimes to add the
+        # time of the transition and of its verification to, and the
+        # record dict, with the time of each phase, the transition
+        # mode and the result added to it.
+        dev_name = dev_name or self.dev_name
+        msocket = msocket or self.msocket
+        record = {} if record is None else record
+
+        thandle = None
+        mode = 'full'
+        start = time.time()
+        verify_start = None
+        result = "transaction-failed"
         try:
             self.debug("Transition_to_state: #{0}\n".format(filename))
-            self.extend_timeout(120) # Max 120 seconds for executing the transaction and a compare-config
-            thandle = maapi.start_trans2(self.msocket, _ncs.RUNNING, _ncs.READ_WRITE, self.uinfo.usid)
-            maapi.delete(self.msocket, thandle, "/ncs:devices/device{" + self.dev_name + "}/config")
-            maapi.load_config(self.msocket, thandle, maapi.CONFIG_J + maapi.CONFIG_MERGE, filename)
-            maapi.apply_trans(self.msocket, thandle, False)
+            # Max 120 seconds for executing the transaction and a compare-config
+            (extend_timeout or self.extend_timeout)(120)
+            thandle = maapi.start_trans2(msocket, _ncs.RUNNING, _ncs.READ_WRITE, self.uinfo.usid)
+            timer = PhaseTimer(record)
+            if from_filename is not None and \
+               self.load_differing_subtrees(msocket, thandle, dev_name, from_filename, filename,
+                                            timer):
+                mode = 'incremental'
+            else:
+                maapi.delete(msocket, thandle, "/ncs:devices/device{" + dev_name + "}/config")
+                timer.lap('delete')
+                maapi.load_config(msocket, thandle, maapi.CONFIG_J + maapi.CONFIG_MERGE, filename)
+                timer.lap('load')
+            maapi.apply_trans(msocket, thandle, False)
+            timer.lap('apply')
             self.debug("Committed\n")
-            result = maapi.request_action(self.msocket, [], 0, "/ncs:devices/device{" + self.dev_name + "}/compare-config")
-            if [] == result:
+            verify_start = time.time()
+            if times is not None:
+                times.add(mode, verify_start - start)
+            if self.verify == 'check-sync':
+                in_sync = self.check_sync(msocket, thandle, dev_name)
+                record['verify-method'] = 'check-sync'
+                if times is not None:
+                    times.add('check-sync', time.time() - verify_start, 'verify')
+                if in_sync:
+                    timer.lap('verify')
+                    result = True
+                    return result
+                record['verify-method'] = 'check-sync,compare-config'
+            else:
+                record['verify-method'] = 'compare-config'
+            compare_start = time.time()
+            compared = maapi.request_action(msocket, [], 0, "/ncs:devices/device{" + dev_name + "}/compare-config")
+            timer.lap('verify')
+            if times is not None:
+                times.add('compare-config', time.time() - compare_start, 'verify')
+            if [] == compared:
                 self.debug("In sync\n")
-                return True
+                result = True
             else:
-                return "out-of-sync"
+                result = "out-of-sync"
+            return result
         except:
             self.debug("Exception: " + repr(traceback.format_exception(*sys.exc_info())))
-            return "transaction-failed"
+            if times is not None and verify_start is None:
+                times.add(mode, time.time() - start)
+            return result
         finally:
-            maapi.finish_trans(self.msocket, thandle)
+            if thandle is not None:
+                maapi.finish_trans(msocket, thandle)
+            record['mode'] = mode
+            record['total'] = time.time() - start
+            record['result'] = 'ok' if True == result else result
+            if times is not None:
+                times.add_record(record)
+
+    def check_sync(self, msocket, thandle, dev_name):
+        # Whether NSO finds the transaction id of the device unchanged
+        # since the commit. False when that is not known, for devices
+        # without transaction ids or if check-sync fails, leaving it to
+        # compare-config to tell.
+        try:
+            output = maapi.request_action_str_th(msocket, thandle, "",
+                                                 "/ncs:devices/device{" + dev_name + "}/check-sync")
+        except Exception:
+            self.debug("check-sync failed: " + traceback.format_exc())
+            return False
+        m = re.search(r'result\s+(\S+)', output)
+        self.debug("check-sync: {0}\n".format(m.group(1) if m else output))
+        return m is not None and m.group(1) == 'in-sync'
+
+    def load_differing_subtrees(self, msocket, thandle, dev_name, from_filename, filename,
+                                timer):
+        # Replace the top-level subtrees that differ between the states
+        # in the transaction, timing the phases with timer. Returns
+        # False if that could not be done, leaving it to the caller to
+        # load the whole state.
+        partial_fd = None
+        try:
+            subtrees = state_subtrees.load_subtrees(filename)
+            (removed, changed) = state_subtrees.differing(state_subtrees.load_hashes(from_filename),
+                                                          state_subtrees.hashes(subtrees))
+            self.debug("Replacing subtrees {0}, removing {1}\n".format(changed, removed))
+            config_path = "/ncs:devices/device{" + dev_name + "}/config/"
+            for name in removed + changed:
+                path = config_path + str(name)
+                if maapi.exists(msocket, thandle, path):
+                    maapi.delete(msocket, thandle, path)
+            timer.lap('delete')
+            if changed:
+                (partial_fd, partial_filename) = tempfile.mkstemp(suffix=".state.cb")
+                state_subtrees.write_partial(partial_filename, dev_name, filename,
+                                             subtrees, changed)
+                maapi.load_config(msocket, thandle, maapi.CONFIG_J + maapi.CONFIG_MERGE,
+                                  partial_filename)
+            timer.lap('load')
+            return True
+        except Exception:
+            self.debug("Incremental load failed, loading whole state: " + traceback.format_exc())
+            return False
+        finally:
+            if partial_fd is not None:
+                os.close(partial_fd)
+                os.remove(partial_filename)
 
     def proc_run_xsltproc(self, xsl_name, input_path, output_path, log_path, params = []):
         params = params or []
@@ -61,6 +186,7 @@ class ConfigOp(netconf_op.NetconfOp):
 
         with open(log_path, "w") as log:
             proc = subprocess.Popen(args, stdout=log, stderr=log)
+            proc.wait()
 
         with open(log_path, "r") as log:
             return log.read()
@@ -71,28 +197,123 @@ class DeleteStateOp(ConfigOp):
 
     def perform(self):
         self.debug("config_delete_state() with device {0}".format(self.dev_name))
-        state_filename = self.states_dir + "/" + self.state_name_to_filename(self.state_name, self.dev_name)
-        try:
-            os.remove(state_filename)
-        except:
-            return {'error':"Could not delete " + state_filename}
+        if not self.state_store().delete(self.dev_name, self.state_name):
+            return {'error':"Could not delete " + self.state_name}
         return {'success':"Deleted " + self.state_name}
 
 class ImportIntoFileOp(ConfigOp):
+    config_path = "{http://tail-f.com/ns/ncs}devices/{http://tail-f.com/ns/ncs}device/" \
+                  "{http://tail-f.com/ns/ncs}config"
+
     def _init_params(self, params):
-        self.file_name = str(params[0].v)
+        self.file_name = self.param_default(params, ns.ns.pioneer_source_filename, "")
+        self.per_file = self.param_default(params, ns.ns.pioneer_per_file, "false") == "true"
+        self.jobs = int(self.param_default(params, ns.ns.pioneer_jobs, 4))
 
     def perform(self):
         self.debug("config_import_into_file() with device {0}".format(self.dev_name))
-        tempfile_stem = "/tmp/" + os.path.basename(self.file_name)
-        tempfile_l_name = tempfile_stem + ".ncsload.xml"
-        log_name = tempfile_stem + ".log"
+        batch = os.path.isdir(self.file_name) or glob.has_magic(self.file_name)
+        if os.path.isdir(self.file_name):
+            sources = [os.path.join(self.file_name, name)
+                       for name in sorted(os.listdir(self.file_name))]
+        elif batch:
+            sources = sorted(glob.glob(self.file_name))
+        else:
+            sources = [self.file_name]
+        sources = [source for source in sources if os.path.isfile(source)]
+        if not sources:
+            return {'error':"No files to import in " + self.file_name}
+
+        # A directory of its own for every run, so that runs do not
+        # overwrite each other's files
+        output_dir = tempfile.mkdtemp(prefix="pioneer-import-")
+        (converted, failed) = self.convert_files(sources, output_dir)
+        self.debug("config-snippet import done")
 
-        log = self.proc_run_xsltproc('ncs-import-from-top.xsl', self.file_name, tempfile_l_name, log_name)
+        result = {}
+        if failed:
+            result['failure'] = "Failed to convert {0} of {1} files:\n{2}".format(
+                len(failed), len(sources),
+                "\n".join("{0}: {1}".format(source, log.strip().split("\n")[-1])
+                          for (source, log) in failed))
+        if not batch:
+            if converted:
+                result['filename'] = converted[0][1]
+            return result
+        if converted and not self.per_file:
+            merged_name = os.path.basename(self.file_name.rstrip("/")) \
+                          if os.path.isdir(self.file_name) else "import"
+            result['filename'] = os.path.join(output_dir, merged_name + ".ncsload.xml")
+            self.merge_files([output for (source, output) in converted], result['filename'])
+            for (source, output) in converted:
+                os.remove(output)
+        elif converted:
+            result['filename'] = output_dir
+        result['message'] = "Converted {0} of {1} files".format(len(converted), len(sources))
+        return result
 
-        #self.attach_load_file(self.file_name)
-        self.debug("config-snippet import done")
-        return {'filename':tempfile_l_name}
+    def convert_files(self, sources, output_dir):
+        # Runs xsltproc on the sources from jobs threads, each its own
+        # process. Only this thread talks to NSO. Returns the (source,
+        # output file) converted and the (source, log) failed, in the
+        # order of sources.
+        outputs = {}
+        work = collections.deque()
+        for source in sources:
+            name = os.path.basename(source)
+            while name in outputs:
+                name = "_" + name
+            outputs[name] = source
+            work.append((len(work), source, os.path.join(output_dir, name)))
+        results = queue.Queue()
+
+        def worker():
+            while True:
+                try:
+                    (seq, source, stem) = work.popleft()
+                except IndexError:
+                    break
+                try:
+                    log = self.proc_run_xsltproc('ncs-import-from-top.xsl', source,
+                                                 stem + ".ncsload.xml", stem + ".log")
+                except Exception as e:
+                    log = str(e)
+                results.put((seq, source, stem, log))
+
+        threads = [threading.Thread(target=worker) for i in range(max(1, min(self.jobs, len(work))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        converted = []
+        failed = []
+        for i in range(len(sources)):
+            self.extend_timeout(120) # Max 120 seconds per file
+            (seq, source, stem, log) = results.get()
+            if os.path.exists(stem + ".ncsload.xml"):
+                converted.append((seq, source, stem + ".ncsload.xml"))
+                os.remove(stem + ".log")
+                if len(sources) > 1:
+                    self.progress_msg("{0}/{1} converted {2}\n".format(i + 1, len(sources), source))
+            else:
+                failed.append((seq, source, log))
+                if len(sources) > 1:
+                    self.progress_msg("{0}/{1} failed {2}\n".format(i + 1, len(sources), source))
+        for thread in threads:
+            thread.join()
+        return ([(source, output) for (seq, source, output) in sorted(converted)],
+                [(source, log) for (seq, source, log) in sorted(failed)])
+
+    def merge_files(self, outputs, merged_path):
+        # The device configurations of all outputs in one file
+        merged = None
+        for output in outputs:
+            root = ElementTree.parse(output).getroot()
+            if merged is None:
+                merged = root
+                merged_config = root.find(self.config_path)
+            else:
+                merged_config.extend(list(root.find(self.config_path)))
+        ElementTree.ElementTree(merged).write(merged_path, encoding="utf-8", xml_declaration=True)
 
     def attach_load_file(self, file_name):
         self.debug("31")
@@ -107,13 +328,17 @@ class ListStatesOp(ConfigOp):
 
     def perform(self):
         self.debug("config_list_states() with device {0}".format(self.dev_name))
-        state_files = [self.state_filename_to_name(f, self.dev_name) for f in os.listdir(self.states_dir) if fnmatch.fnmatch(f, self.state_name_to_filename('*', self.dev_name))]
-        return {'success':"Saved device states: " + str(state_files)}
+        state_names = [entry['name'] for entry in self.state_store().states(self.dev_name)]
+        return {'success':"Saved device states: " + str(state_names)}
 
 class RecordStateOp(ConfigOp):
+    # save-config stream read size
+    stream_bufsiz = 256 * 1024
+
     def _init_params(self, params):
         self.state_name = self.param_default(params, ns.ns.pioneer_state_name, "")
         self.include_rollbacks = self.param_default(params, ns.ns.pioneer_including_rollbacks, 0)
+        self.compress = self.param_default(params, ns.ns.pioneer_compress, "false") == "true"
 
     def perform(self):
         self.debug("config_record_state() with device {0}".format(self.dev_name))
@@ -127,27 +352,54 @@ class RecordStateOp(ConfigOp):
         except:
             rollbacks = []
         self.debug("rollbacks="+str([r.fixed_nr for r in rollbacks]))
+        store = self.state_store()
+        # All states are recorded in the action transaction, attached
+        # once. Each is streamed to a file in the store, so memory use
+        # does not depend on the size or number of states, and they are
+        # added to the store index together at the end.
         maapi.attach2(self.msocket, 0, 0, self.uinfo.actx_thandle)
         index = 0
-        state_filenames = []
-        for rb in [None] + rollbacks:
-            if None == rb:
-                self.debug("Recording current transaction state")
-            else:
-                self.debug("Recording rollback"+str(rb.fixed_nr))
-                self.debug("Recording rollback"+str(rb.nr))
-                maapi.load_rollback(self.msocket, self.uinfo.actx_thandle, 3)#rb.nr)
-
-            save_id = maapi.save_config(self.msocket, self.uinfo.actx_thandle, maapi.CONFIG_J,
-                                        "/ncs:devices/device{"+self.dev_name+"}/config")
-
-            state_name_index = state_name
-            if index > 0:
-                state_name_index = state_name+"-"+str(index)
-            state_filename = self.states_dir + "/" + self.state_name_to_filename(state_name_index, self.dev_name)
-            with open(state_filename, "w") as state_file:
+        recorded = []
+        try:
+            for rb in [None] + rollbacks:
+                state_name_index = state_name
+                if index > 0:
+                    state_name_index = state_name+"-"+str(index)
+                start = time.time()
+                if None == rb:
+                    self.debug("Recording current transaction state")
+                else:
+                    self.debug("Recording rollback {0} (fixed {1})".format(rb.nr, rb.fixed_nr))
+                    maapi.load_rollback(self.msocket, self.uinfo.actx_thandle, rb.nr)
+                (state_filename, content_hash) = self.save_state(store)
+                recorded.append((self.dev_name, state_name_index, state_filename,
+                                 rb.fixed_nr if rb is not None else None, self.compress,
+                                 content_hash))
+                self.progress_msg("Recorded state {0}: {1} bytes in {2:.2f} s\n".format(
+                    state_name_index, content_hash[1], time.time() - start))
+                index += 1
+                # Each rollback is loaded on a transaction without
+                # changes, as before
+                maapi.revert(self.msocket, self.uinfo.actx_thandle)
+            store.add_all(recorded, self.extend_timeout)
+        finally:
+            for (dev_name, name, state_filename, rollback, compress, content_hash) in recorded:
+                if os.path.exists(state_filename):
+                    os.remove(state_filename)
+        return {'success':"Recorded states " + str([name for (d, name, f, r, c, h) in recorded])}
+
+    def save_state(self, store):
+        # Returns the store temp file the device configuration in the
+        # attached transaction was saved to, and its (hash, size)
+        save_id = maapi.save_config(self.msocket, self.uinfo.actx_thandle, maapi.CONFIG_J,
+                                    "/ncs:devices/device{"+self.dev_name+"}/config")
+        (state_fd, state_filename) = store.temp_file()
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(state_fd, "wb") as state_file:
+                ssocket = socket.socket()
                 try:
-                    ssocket = socket.socket()
                     _ncs.stream_connect(
                         sock=ssocket,
                         id=save_id,
@@ -156,20 +408,19 @@ class RecordStateOp(ConfigOp):
                         port=_ncs.NCS_PORT)
 
                     while True:
-                        config_data = ssocket.recv(4096)
+                        config_data = ssocket.recv(self.stream_bufsiz)
                         if not config_data:
                             break
-                        state_file.write(str(config_data))
-                        self.debug("Data: "+str(config_data))
+                        state_file.write(config_data)
+                        sha.update(config_data)
+                        size += len(config_data)
                 finally:
                     ssocket.close()
-            state_filenames += [state_name_index]
-
-            ##maapi.save_config_result(sock, id) -> None
-
-            index += 1
-            maapi.revert(self.msocket, self.uinfo.actx_thandle)
-        return {'success':"Recorded states " + str(state_filenames)}
+            maapi.save_config_result(self.msocket, save_id)
+        except:
+            os.remove(state_filename)
+            raise
+        return (state_filename, (sha.hexdigest(), size))
 
 class SyncFromIntoFileOp(ConfigOp):
     def _init_params(self, params):
@@ -191,9 +442,8 @@ class SyncFromIntoFileOp(ConfigOp):
 
         self.debug("Fetching config with netconf-console --get-config")
         self.extend_timeout(self.get_setting('connect-timeout', int))
-        xml_config = self.nc_perform('get-config')
-        with open(tempfile_f_name, "w") as f_obj:
-            f_obj.write(xml_config)
+        with open(tempfile_f_name, "wb") as f_obj:
+            self.nc_perform('get-config', sink=f_obj)
 
         self.debug("Translating to /devices/device")
         log = self.proc_run_xsltproc(xsl_name, tempfile_f_name, tempfile_l_name, log_name,
@@ -205,7 +455,67 @@ class SyncFromIntoFileOp(ConfigOp):
         else:
             return {'message':log}
 
+class PhaseTimer(object):
+    """Adds the wall time since the previous lap to the named phase in
+    the phases dict."""
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+class TransitionTimes(object):
+    """Time taken by the transitions of an explore-transitions run, per
+    phase and kind: the transition mode for the loading and committing
+    of the transition phase, and the method for the verify phase. Also
+    keeps the record of each transition made."""
+    record_phases = ['delete', 'load', 'apply', 'verify', 'total']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.records = []
+
+    def add(self, kind, seconds, phase='transition'):
+        with self.lock:
+            self.times.setdefault(phase, {}).setdefault(kind, []).append(seconds)
+
+    def add_record(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def percentiles(self):
+        """Returns an ordered dict from phase to its count, mean, p50,
+        p95, p99 and max seconds over the successful transitions."""
+        with self.lock:
+            records = [r for r in self.records if r['result'] == 'ok']
+        result = collections.OrderedDict()
+        for phase in self.record_phases:
+            values = sorted(r[phase] for r in records if phase in r)
+            if values:
+                result[phase] = collections.OrderedDict([
+                    ('count', len(values)), ('mean', sum(values) / len(values)),
+                    ('p50', percentile(values, 50)), ('p95', percentile(values, 95)),
+                    ('p99', percentile(values, 99)), ('max', values[-1])])
+        return result
+
+    def summary(self, phase='transition'):
+        with self.lock:
+            return ", ".join("{0} {1} x {2:.2f} s".format(kind, len(times), sum(times) / len(times))
+                             for (kind, times) in sorted(self.times.get(phase, {}).items()))
+
 class ExploreTransitionsOp(ConfigOp):
+    transition_modes = ['full', 'incremental', 'alternate']
+    checkpoint_interval = 10
+
     def _init_params(self, params):
         self.stop_time = 24 * int(self.param_default(params, ns.ns.pioneer_days, 0))
         self.stop_time = 60 * int(self.param_default(params, ns.ns.pioneer_hours, self.stop_time))
@@ -213,11 +523,17 @@ class ExploreTransitionsOp(ConfigOp):
         self.stop_time =      int(self.param_default(params, ns.ns.pioneer_seconds, self.stop_time))
         self.stop_percent =   int(self.param_default(params, ns.ns.pioneer_percent, 0))
         self.stop_cases =     int(self.param_default(params, ns.ns.pioneer_cases, 0))
+        self.devices = self.param_default(params, ns.ns.pioneer_devices, "").split()
+        self.transition_mode = self.param_enum(params, ns.ns.pioneer_transition_mode, self.transition_modes)
+        self.verify = self.param_enum(params, ns.ns.pioneer_verify, self.verify_methods)
+        self.report = self.param_default(params, ns.ns.pioneer_report, "")
+        self.resume = self.param_default(params, ns.ns.pioneer_resume, "false") == "true"
 
     def perform(self):
         self.debug("config_explore_transitions() with device {0}".format(self.dev_name))
-        state_files = [f for f in os.listdir(self.states_dir) if fnmatch.fnmatch(f, self.state_name_to_filename('*', self.dev_name))]
-        num_states = len(state_files)
+        store = self.state_store()
+        states = store.states(self.dev_name)
+        num_states = len(states)
         num_transitions = num_states * (num_states - 1)
         if(0 == num_transitions):
             return {'error':"No transitions to make. Run 'config record-state' several times, "
@@ -225,8 +541,26 @@ class ExploreTransitionsOp(ConfigOp):
         self.progress_msg("Found {0} states recorded for device {1} which gives a total of {2} transitions.\n".
                           format(num_states, self.dev_name, num_transitions))
 
-        failed_transitions = []
-        remaining_transitions = {}
+        ## Transitions between states with the same configuration test
+        ## nothing new, so only one state of each equivalence class is used
+        classes = collections.OrderedDict()
+        for (entry, canonical) in zip(states, store.canonical_hashes(states)):
+            classes.setdefault(canonical or ('unparsed', entry['name']), []).append(entry)
+        if len(classes) < num_states:
+            for members in classes.values():
+                if len(members) > 1:
+                    self.progress_msg("States {0} are equal, using {1}\n".format(
+                        ", ".join(entry['name'] for entry in members), members[0]['name']))
+            states = [members[0] for members in classes.values()]
+            num_states = len(states)
+            skipped = num_transitions - num_states * (num_states - 1)
+            num_transitions -= skipped
+            self.progress_msg("Skipping {0} transitions involving equal states, {1} transitions left.\n".
+                              format(skipped, num_transitions))
+            if(0 == num_transitions):
+                return {'error':"No transitions to make. All states recorded for device {0} "
+                        "have the same configuration.".format(self.dev_name)}
+
         stop_cases = self.stop_cases
         if self.stop_percent:
             stop_cases = int(self.stop_percent / 100.0 * num_transitions + .999) ## Round upwards
@@ -234,69 +568,348 @@ class ExploreTransitionsOp(ConfigOp):
         if stop_time:
             stop_time += time.time()
         self.debug("stop_cases = {0}, stop_time = {1}".format(stop_cases, stop_time))
-        index = 0
-        for from_state in range(0, num_states):
-            remaining_transitions[from_state] = {}
-            for to_state in range(0, num_states):
-                if to_state == from_state:
-                    continue ## Can't transition to same state
-                remaining_transitions[from_state][to_state] = 1
+        devices = []
+        for dev_name in self.devices or [self.dev_name]:
+            if dev_name not in devices:
+                devices.append(dev_name)
+        state_names = [entry['name'] for entry in states]
+        self.times = TransitionTimes()
+        self.checkpoint_states = [(entry['name'], entry['hash']) for entry in states]
+        self.checkpoint_lock = threading.Lock()
+        self.checkpoint_saved = time.time()
+        if self.resume:
+            checkpoint = self.read_checkpoint(states)
+            pending = checkpoint['pending']
+            if stop_cases:
+                stop_cases += checkpoint['index']
+            self.times.times = checkpoint['times']
+            self.times.records = checkpoint['records']
+            self.progress_msg("Resuming after {0} transitions, {1} transitions left.\n".format(
+                checkpoint['index'], len(pending)))
+            plan = transition_plan.TransitionPlan(num_states, stop_cases, stop_time, len(devices),
+                                                  pending, checkpoint['index'],
+                                                  checkpoint['starts'])
+        else:
+            plan = transition_plan.TransitionPlan(num_states, stop_cases, stop_time, len(devices))
+        previous_failures = self.failures()
+
+        with store.checkout() as checkout:
+            state_files = [checkout.path(entry) for entry in states]
+            if [self.dev_name] == devices:
+                (failed_transitions, error_msg) = self.explore_device(
+                    plan, num_transitions, self.dev_name, self.msocket,
+                    state_files, state_names, self.progress_msg)
+                failed_transitions = [(f, t, c, self.dev_name) for (f, t, c) in failed_transitions]
+                errors = [error_msg] if error_msg else []
+            else:
+                (failed_transitions, errors) = self.explore_parallel(
+                    plan, num_transitions, devices, state_files, state_names)
+        failed_transitions = previous_failures + failed_transitions
+        if plan.limit_reached:
+            self.progress_msg("Requested stop-after limit reached\n")
+        left = self.save_checkpoint(plan)
+        if left:
+            self.progress_msg("{0} transitions left, run again with resume to continue\n".format(left))
+        self.progress_msg("Made {0} transitions, starting from a known state {1} times\n".format(
+            plan.index, plan.starts))
+        if self.times.summary():
+            self.progress_msg("Average transition time: {0}\n".format(self.times.summary()))
+        if self.times.summary('verify'):
+            self.progress_msg("Average verification time: {0}\n".format(self.times.summary('verify')))
+        percentiles = self.times.percentiles()
+        if percentiles:
+            self.progress_msg("Phase times p50/p95/p99: {0}\n".format(", ".join(
+                "{0} {1:.2f}/{2:.2f}/{3:.2f} s".format(phase, t['p50'], t['p95'], t['p99'])
+                for (phase, t) in percentiles.items())))
+
+        if not failed_transitions and not errors:
+            result = {'success':"Completed successfully"}
+        else:
+            if len(devices) > 1:
+                lines = ["{0}: {1} ==> {2} on {3}".format(c,f,t,d) for (f,t,c,d) in failed_transitions]
+            else:
+                lines = ["{0}: {1} ==> {2}".format(c,f,t) for (f,t,c,d) in failed_transitions]
+            result = {'failure':"\n".join(lines)}
+            if errors:
+                result['error'] = "\n".join(errors)
+        if self.report:
+            self.write_report(self.report, states, percentiles)
+            result['filename'] = self.report
+        return result
+
+    def checkpoint_path(self):
+        return os.path.join(self.states_dir, "checkpoints", self.dev_name + ".json")
+
+    def failures(self):
+        # The failed transitions recorded, starts from known states not
+        # included
+        with self.times.lock:
+            return [(r['from'], r['to'], r['result'], r['device']) for r in self.times.records
+                    if r['index'] is not None and r['result'] != 'ok']
+
+    def save_checkpoint(self, plan, interval=None):
+        # Saves the transitions left and those made so far, unless one
+        # was saved less than interval seconds ago. Removes the
+        # checkpoint when there are no transitions left. Returns the
+        # number left.
+        with self.checkpoint_lock:
+            if interval is not None and time.time() - self.checkpoint_saved < interval:
+                return None
+            self.checkpoint_saved = time.time()
+            pending = plan.pending()
+            path = self.checkpoint_path()
+            if not pending:
+                if os.path.exists(path):
+                    os.remove(path)
+                return 0
+            names = [name for (name, content_hash) in self.checkpoint_states]
+            with self.times.lock:
+                checkpoint = {'version': 1,
+                              'device': self.dev_name,
+                              'states': self.checkpoint_states,
+                              'pending': [(names[f], names[t]) for (f, t) in pending],
+                              'index': plan.index,
+                              'starts': plan.starts,
+                              'times': self.times.times,
+                              'records': self.times.records}
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + ".tmp", "w") as f:
+                    json.dump(checkpoint, f)
+            os.rename(path + ".tmp", path)
+            return len(pending)
+
+    def read_checkpoint(self, states):
+        # The checkpoint of the previous run, with the pending
+        # transitions as indexes into states
+        try:
+            with open(self.checkpoint_path()) as f:
+                checkpoint = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise ActionError({'error': "No explore-transitions run to resume for device {0}".
+                               format(self.dev_name)})
+        checkpoint_states = [(state_store.native(name), state_store.native(content_hash))
+                             for (name, content_hash) in checkpoint['states']]
+        if sorted(checkpoint_states) != sorted(self.checkpoint_states):
+            raise ActionError({'error': "The states of device {0} have changed since the run "
+                               "to resume, start a new run without resume".format(self.dev_name)})
+        indexes = dict((entry['name'], i) for (i, entry) in enumerate(states))
+        checkpoint['pending'] = [(indexes[state_store.native(f)], indexes[state_store.native(t)])
+                                 for (f, t) in checkpoint['pending']]
+        return checkpoint
+
+    report_columns = ['index', 'device', 'from', 'to', 'from-size', 'to-size', 'mode',
+                      'delete', 'load', 'apply', 'verify-method', 'verify', 'total', 'result']
+
+    def write_report(self, filename, states, percentiles):
+        # One row per transition, or per start from a known state with
+        # an empty index, as CSV if filename ends in .csv, otherwise
+        # JSON with the states and the percentiles too
+        sizes = dict((entry['name'], entry['size']) for entry in states)
+        records = []
+        for record in self.times.records:
+            record = dict(record)
+            record['from-size'] = sizes.get(record['from'])
+            record['to-size'] = sizes.get(record['to'])
+            for phase in TransitionTimes.record_phases:
+                if phase in record:
+                    record[phase] = round(record[phase], 6)
+            records.append(record)
+        if filename.endswith(".csv"):
+            if sys.hexversion < 0x03000000:
+                f = open(filename, "wb")
+            else:
+                f = open(filename, "w", newline="")
+            with f:
+                writer = csv.DictWriter(f, self.report_columns, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(records)
+        else:
+            report = collections.OrderedDict([
+                ('device', self.dev_name),
+                ('created', time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+                ('transition-mode', self.transition_mode),
+                ('verify', self.verify),
+                ('states', collections.OrderedDict((entry['name'], entry['size'])
+                                                   for entry in states)),
+                ('percentiles', percentiles),
+                ('transitions', [collections.OrderedDict((column, record.get(column))
+                                                         for column in self.report_columns)
+                                 for record in records])])
+            with open(filename, "w") as f:
+                json.dump(report, f, indent=1)
+
+    def explore_device(self, plan, num_transitions, dev_name, msocket, state_files,
+                       state_names, progress, extend_timeout=None):
+        # Make transitions from plan on one device until there are
+        # none left. Returns the failed transitions and an error
+        # message if the device could not be brought to a known state.
+        failed_transitions = []
+        route = transition_plan.Route()
         from_state = None ## Start in undefined state
-        error_msg = None
-        while remaining_transitions:
-            if (stop_time and time.time() > stop_time) or (stop_cases and index >= stop_cases):
-                self.progress_msg("Requested stop-after limit reached\n")
-                break
-
-            index += 1
-            if not remaining_transitions.has_key(from_state):
-                ## Could not find any transitions from the current (perhaps undefined) state
-                ## So let's pick a from_state at random and go to that first
-                start_attempts_remaining = 10
-                while start_attempts_remaining:
-                    from_state = random.choice(remaining_transitions.keys())
-                    from_name = self.state_filename_to_name(state_files[from_state], self.dev_name)
-                    self.progress_msg("\nStarting from known state {0}\n".format(from_name))
-                    result = self.transition_to_state(state_files[from_state])
-                    if True != result:
-                        self.progress_msg("... failed setting known state\n")
-                        start_attempts_remaining -= 1
-                    else:
-                        break
+        failed_starts = set()
+        start_attempts_remaining = 10
+        while True:
+            taken = plan.take(route, from_state, failed_starts)
+            if taken is None:
+                return (failed_transitions, None)
+            (index, to_state) = taken
+            if index is None:
+                ## Nothing planned from the current (perhaps undefined) state,
+                ## so go to the state the next trail starts from first
+                if not start_attempts_remaining:
+                    return (failed_transitions,
+                            "Failed to regain a known state despite multiple attempts")
+                progress("\nStarting from known state {0}\n".format(state_names[to_state]))
+                record = {'index': None, 'device': dev_name, 'to': state_names[to_state],
+                          'from': None if from_state is None else state_names[from_state]}
+                result = self.transition_to_state(state_files[to_state], dev_name,
+                                                  msocket, extend_timeout,
+                                                  self.diff_against(state_files, from_state, index),
+                                                  self.times, record)
                 if True != result:
-                    error_msg = "Failed to regain a known state despite multiple attempts"
-                    break
-
-            ## Pick a remaining to_state at random
-            (to_state, dummy_val) = remaining_transitions[from_state].popitem()
-            if 0 == len(remaining_transitions[from_state]):
-                del remaining_transitions[from_state]
-
-            from_name = self.state_filename_to_name(state_files[from_state], self.dev_name)
-            to_name = self.state_filename_to_name(state_files[to_state], self.dev_name)
-            self.progress_msg("Transition {0}/{1}: {2} ==> {3}\n".format(index, num_transitions, from_name, to_name))
-            result = self.transition_to_state(state_files[to_state])
+                    progress("... failed setting known state\n")
+                    failed_starts.add(to_state)
+                    start_attempts_remaining -= 1
+                    from_state = None
+                else:
+                    failed_starts.clear()
+                    start_attempts_remaining = 10
+                    from_state = to_state
+                continue
+
+            from_name = state_names[from_state]
+            to_name = state_names[to_state]
+            progress("Transition {0}/{1}: {2} ==> {3}\n".format(index, num_transitions, from_name, to_name))
+            record = {'index': index, 'device': dev_name, 'from': from_name, 'to': to_name}
+            result = self.transition_to_state(state_files[to_state], dev_name,
+                                              msocket, extend_timeout,
+                                              self.diff_against(state_files, from_state, index),
+                                              self.times, record)
+            route.current = None
             if True != result:
                 failed_transitions += [(from_name, to_name, result)]
-                self.progress_msg("   {0}\n".format(result))
+                progress("   {0}\n".format(result))
                 from_state = None ## Now in undefined state
             else:
                 from_state = to_state
-        if not failed_transitions and not error_msg:
-            return {'success':"Completed successfully"}
-        result = {'failure':"\n".join(["{0}: {1} ==> {2}".format(c,f,t) for (f,t,c) in failed_transitions])}
-        if error_msg:
-            result['error'] = error_msg
-        return result
+            self.save_checkpoint(plan, self.checkpoint_interval)
+
+    def diff_against(self, state_files, from_state, index):
+        # The state file to load only the differing subtrees against, or
+        # None to load the whole state. The alternate mode uses both
+        # ways every other transition, to compare their times.
+        if from_state is None or 'full' == self.transition_mode:
+            return None
+        if 'alternate' == self.transition_mode and (index or 0) % 2:
+            return None
+        return state_files[from_state]
+
+    def explore_parallel(self, plan, num_transitions, devices, state_files, state_names):
+        # Each device gets a worker thread and MAAPI socket of its own.
+        # As in yang download, only this thread talks to the action:
+        # it prints the workers' progress and extends the timeout.
+        self.check_devices(devices)
+        clone_dir = tempfile.mkdtemp(prefix="pioneer-explore-")
+        try:
+            device_files = {}
+            for dev_name in devices:
+                if dev_name == self.dev_name:
+                    device_files[dev_name] = state_files
+                else:
+                    device_files[dev_name] = [self.clone_state_file(f, name, dev_name, clone_dir)
+                                              for (f, name) in zip(state_files, state_names)]
+
+            results = queue.Queue()
+
+            def worker(dev_name):
+                msocket = socket.socket()
+                try:
+                    maapi.connect(msocket, '127.0.0.1', _ncs.NCS_PORT)
+                    (failed, error_msg) = self.explore_device(
+                        plan, num_transitions, dev_name, msocket,
+                        device_files[dev_name], state_names,
+                        lambda msg: results.put(('progress', dev_name, msg)),
+                        lambda timeout: results.put(('timeout', dev_name, timeout)))
+                    results.put(('done', dev_name, (failed, error_msg)))
+                except Exception as e:
+                    self.debug(traceback.format_exc())
+                    results.put(('done', dev_name, ([], "Failed: " + str(e))))
+                finally:
+                    msocket.close()
+
+            self.progress_msg("Exploring on {0} devices: {1}\n".format(len(devices), " ".join(devices)))
+            threads = [threading.Thread(target=worker, args=(dev_name,)) for dev_name in devices]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            failed_transitions = []
+            errors = []
+            running = len(threads)
+            while running:
+                (kind, dev_name, value) = results.get()
+                if kind == 'progress':
+                    lead = value[:len(value) - len(value.lstrip("\n"))]
+                    self.progress_msg("{0}{1}: {2}".format(lead, dev_name, value.lstrip("\n")))
+                elif kind == 'timeout':
+                    self.extend_timeout(value)
+                elif kind == 'done':
+                    running -= 1
+                    (failed, error_msg) = value
+                    failed_transitions += [(f, t, c, dev_name) for (f, t, c) in failed]
+                    if error_msg:
+                        errors.append("{0}: {1}".format(dev_name, error_msg))
+            for thread in threads:
+                thread.join()
+            return (failed_transitions, errors)
+        finally:
+            shutil.rmtree(clone_dir, ignore_errors=True)
+
+    def check_devices(self, devices):
+        thandle = maapi.start_trans2(self.msocket, _ncs.RUNNING, _ncs.READ, self.uinfo.usid)
+        try:
+            missing = [dev_name for dev_name in devices
+                       if not maapi.exists(self.msocket, thandle, "/ncs:devices/device{" + dev_name + "}")]
+        finally:
+            maapi.finish_trans(self.msocket, thandle)
+        if missing:
+            raise ActionError({'error': "No such device: " + " ".join(missing)})
+
+    def clone_state_file(self, state_filename, state_name, dev_name, clone_dir):
+        # The states are saved from /devices/device{dev_name}/config,
+        # so they name the device they were recorded on. Make a copy
+        # naming dev_name instead.
+        with open(state_filename) as f:
+            data = f.read()
+        device_re = re.compile(r'^(\s*device\s+)("?)' + re.escape(self.dev_name) + r'\2(\s*\{)', re.M)
+        (data, count) = device_re.subn(lambda m: m.group(1) + m.group(2) + dev_name +
+                                       m.group(2) + m.group(3), data, 1)
+        if 0 == count:
+            raise ActionError({'error': "State {0} is not for device {1}".format(
+                state_name, self.dev_name)})
+        clone_filename = os.path.join(clone_dir, dev_name + "--" + state_name + ".state.cb")
+        with open(clone_filename, "w") as f:
+            f.write(data)
+        return clone_filename
 
 class TransitionToStateOp(ConfigOp):
     def _init_params(self, params):
         self.state_name = self.param_default(params, ns.ns.pioneer_state_name, "")
+        self.verify = self.param_enum(params, ns.ns.pioneer_verify, self.verify_methods)
 
     def perform(self):
         self.debug("config_transition_to_state() with device {0} to state {1}".format(self.dev_name, self.state_name))
-        to_filename = self.state_name_to_filename(self.state_name, self.dev_name)
-        result = self.transition_to_state(to_filename)
+        store = self.state_store()
+        entry = store.lookup(self.dev_name, self.state_name)
+        if entry is None:
+            raise ActionError({'error': 'No such state: {0}'.format(self.state_name)})
+        times = TransitionTimes()
+        with store.checkout() as checkout:
+            result = self.transition_to_state(checkout.path(entry), times=times)
+        self.progress_msg("Transition time: {0}\n".format(times.summary()))
+        if times.summary('verify'):
+            self.progress_msg("Verification time: {0}\n".format(times.summary('verify')))
         if True == result:
             return {'success':"Done"}
         else:
@@ -0,0 +1,196 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Incremental builds of NETCONF NEDs.
+
+<ned>/src/pioneer-build.json records what the last build of a NED was
+made from: the package name, the NCS_DIR and the content hash of each
+YANG file compiled. The next build compares it with the enabled
+modules of the YANG directory and compiles only the modules that were
+added or changed, or that import or include one that was, directly or
+not. ncsc only applies deviation modules when it compiles all modules
+as a bundle, so with deviation modules every build is a full one.
+
+CompileScheduler compiles modules on several processes at a time, each
+module only after those it depends on."""
+
+import errno
+import fcntl
+import heapq
+import json
+import os
+import select
+import subprocess
+import sys
+
+BUILD_STATE_NAME = "pioneer-build.json"
+
+def _native(value):
+    # json gives unicode strings, Python 2 callers want str
+    if sys.hexversion < 0x03000000 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def fxs_dir(src_dir):
+    return os.path.join(src_dir, "ncsc-out", "modules", "fxs")
+
+
+def read_build_state(src_dir, name, ncs_dir):
+    """Returns a dict from module name to content hash of the last
+    build in src_dir, or None if it was not made for package name with
+    ncs_dir, or cannot be built upon. A build that applied deviation
+    modules cannot, as the modules they deviate would keep the
+    deviations when they are changed or removed."""
+    try:
+        with open(os.path.join(src_dir, BUILD_STATE_NAME)) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if (state.get('name'), state.get('ncs-dir')) != (name, ncs_dir):
+        return None
+    if state.get('deviations'):
+        return None
+    if not os.path.exists(os.path.join(src_dir, "Makefile")) or not os.path.isdir(fxs_dir(src_dir)):
+        return None
+    return dict((_native(module), _native(digest)) for (module, digest) in state['modules'].items())
+
+
+def write_build_state(src_dir, name, ncs_dir, hashes, deviations=()):
+    # deviations are the names of the deviation modules applied
+    path = os.path.join(src_dir, BUILD_STATE_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump({'version': 1, 'name': name, 'ncs-dir': ncs_dir, 'modules': hashes,
+                   'deviations': sorted(deviations)},
+                  f, indent=1, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def remove_build_state(src_dir):
+    try:
+        os.remove(os.path.join(src_dir, BUILD_STATE_NAME))
+    except OSError:
+        pass
+
+
+def plan(previous, current, graph):
+    """Returns (changed, compile, removed) going from the previous to
+    the current dicts of module name to content hash: the names of the
+    modules added or changed, of the modules to compile, being those
+    and all modules depending on them or on a removed one, and of the
+    removed modules. graph is the yang_deps.DependencyGraph of the
+    current modules; submodules are compiled with the modules
+    including them, never on their own."""
+    changed = set(name for (name, digest) in current.items() if previous.get(name) != digest)
+    removed = set(previous) - set(current)
+    affected = set(changed)
+    for name in changed | removed:
+        affected |= graph.closure(name, reverse=True)
+    compile_names = [name for name in affected
+                     if name in current and (name not in graph.modules
+                                             or graph.modules[name].belongs_to is None)]
+    return (sorted(changed), sorted(compile_names), sorted(removed))
+
+
+class CompileScheduler(object):
+    """Runs the compilations of the modules names on up to jobs
+    processes at a time, in topological order of the dependency graph:
+    a module is compiled once all of the names it depends on, directly
+    or not, have been, and not at all if one of them failed. Among the
+    modules ready, those with the most modules waiting for them go
+    first."""
+
+    def __init__(self, names, graph, jobs):
+        self.names = sorted(names)
+        self.jobs = max(1, jobs)
+        name_set = set(self.names)
+        self.waits_for = dict((name, graph.closure(name) & name_set - set([name]))
+                              for name in self.names)
+        self.waited_by = dict((name, []) for name in self.names)
+        for (name, deps) in self.waits_for.items():
+            for dep in deps:
+                self.waited_by[dep].append(name)
+        self.priority = dict((name, (-len(self.waited_by[name]), name)) for name in self.names)
+
+    def run(self, command_fun, output_fun, silence_timeout, check_fun=None):
+        """Compiles the modules, command_fun(name) giving the command
+        line of each. output_fun(name, text) is called with the output
+        of the processes as it comes, and with None when a module is
+        started. A module succeeds if its process exits with status 0
+        and check_fun(name), if given, is true. Processes are killed
+        when none of them has written anything for silence_timeout
+        seconds. Returns a dict from module name to (status, output),
+        status being one of 'ok', 'failed', 'skipped' or 'timeout';
+        the output of a skipped module is the name of the failed
+        module it depends on."""
+        self.results = {}
+        self.unfinished = dict((name, len(deps)) for (name, deps) in self.waits_for.items())
+        self.ready = [self.priority[name] for (name, count) in self.unfinished.items() if count == 0]
+        heapq.heapify(self.ready)
+        self.pending = set(self.names)
+        running = {}    # fd -> (name, process, output chunks)
+        try:
+            while self.pending or running:
+                while self.pending and len(running) < self.jobs:
+                    if self.ready:
+                        name = heapq.heappop(self.ready)[1]
+                    elif not running:
+                        # Nothing running nor ready, a dependency cycle
+                        name = min(self.pending, key=self.priority.get)
+                    else:
+                        break
+                    self.pending.discard(name)
+                    output_fun(name, None)
+                    proc = subprocess.Popen(command_fun(name),
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+                    fd = proc.stdout.fileno()
+                    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+                    running[fd] = (name, proc, [])
+                if not running:
+                    continue
+                (rlist, wlist, xlist) = select.select(list(running), [], [], silence_timeout)
+                if not rlist:
+                    for fd in list(running):
+                        running[fd][1].kill()
+                        self._finish(running, fd, 'timeout')
+                    continue
+                for fd in rlist:
+                    (name, proc, chunks) = running[fd]
+                    try:
+                        data = os.read(fd, 65536)
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            continue
+                        raise
+                    if data:
+                        if not isinstance(data, str):
+                            data = data.decode('utf-8', 'replace')
+                        chunks.append(data)
+                        output_fun(name, data)
+                        continue
+                    proc.wait()
+                    ok = proc.returncode == 0 and (check_fun is None or check_fun(name))
+                    self._finish(running, fd, 'ok' if ok else 'failed')
+        finally:
+            for fd in list(running):
+                running[fd][1].kill()
+                self._finish(running, fd, 'failed')
+        return self.results
+
+    def _finish(self, running, fd, status):
+        (name, proc, chunks) = running.pop(fd)
+        proc.wait()
+        proc.stdout.close()
+        self.results[name] = (status, "".join(chunks))
+        for waiting in self.waited_by[name]:
+            if waiting not in self.pending:
+                continue
+            if status != 'ok':
+                # waited_by is transitive, so all of those depending on
+                # name are skipped here
+                self.pending.discard(waiting)
+                self.results[waiting] = ('skipped', name)
+                continue
+            self.unfinished[waiting] -= 1
+            if self.unfinished[waiting] == 0:
+                heapq.heappush(self.ready, self.priority[waiting])
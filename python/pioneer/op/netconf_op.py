@@ -1,15 +1,16 @@
 # -*- mode: python; python-indent: 4 -*-
 
 import contextlib
-import sys
+import xml.parsers.expat
 
 import _ncs
 import ncs.maapi as maapi
 
-from io import BytesIO
 from pioneer.op.ex import ActionError
 
 import pioneer.op.base_op as base_op
+import pioneer.op.netconf_session as netconf_session
+import pioneer.op.xml_extract as xml_extract
 import pioneer.namespaces.pioneer_ns as ns
 import pioneer.netconf_console as netconf_console
 
@@ -25,20 +26,6 @@ def single_trans(readWrite):
                 yield t
 
 
-class ExtendTimeoutNetconfTCP(netconf_console.NetconfTCP):
-    def __init__(self, extend_timeout, *args, **kwargs):
-        super(ExtendTimeoutNetconfTCP, self).__init__(*args, **kwargs)
-        self.extend_timeout = extend_timeout
-
-    def _recv(self, bufsiz):
-        self.extend_timeout()
-        return super(ExtendTimeoutNetconfTCP, self)._recv(bufsiz)
-
-    def _send(self, buf):
-        self.extend_timeout()
-        return super(ExtendTimeoutNetconfTCP, self)._send(buf)
-
-
 class ExtendTimeoutNetconfSSH(netconf_console.NetconfSSH):
     def __init__(self, extend_timeout, *args, **kwargs):
         super(ExtendTimeoutNetconfSSH, self).__init__(*args, **kwargs)
@@ -53,40 +40,11 @@ class ExtendTimeoutNetconfSSH(netconf_console.NetconfSSH):
         return super(ExtendTimeoutNetconfSSH, self)._send(buf)
 
 
-class IoCb(object):
-    def __init__(self, extend_timeout):
-        self.extend_timeout = extend_timeout
-        self.out = BytesIO()
-        self.err = BytesIO()
-        self.trace = BytesIO()
-
-    def output(self, msg):
-        self.out.write(msg)
-
-    def output_err(self, msg):
-        self.err.write(msg)
-        self.err.write('\n')
-
-    def output_trace(self, msg):
-        self.trace.write(msg)
-
-    def abort(self, msg):
-        raise ActionError({'error': msg})
-
-    def create_trans(self, o):
-        if o.proto == "ssh":
-            return ExtendTimeoutNetconfSSH(
-                self.extend_timeout,
-                self, o.host, o.port, o.username, o.password, "", "",
-                o.privKeyFile, o.privKeyType)
-
-        return ExtendTimeoutNetconfTCP(
-            self.extend_timeout,
-            self, o.host, o.port, o.username, o.groups, o.supgroups)
-
-
 class NetconfOp(base_op.BaseOp):
     def get_conn_details(self):
+        return self.cached(self.dev_name, 'conn-details', self.read_conn_details)
+
+    def read_conn_details(self):
         def safe_ncs_decrypt(value):
             if value is None:
                 return None
@@ -132,12 +90,16 @@ class NetconfOp(base_op.BaseOp):
             return (address, port, remote_name, remote_password)
 
     def get_setting(self, name, conv=lambda x: x):
+        return conv(self.cached(self.dev_name, 'setting ' + name,
+                                lambda: self.read_setting(name)))
+
+    def read_setting(self, name):
         with single_trans(_ncs.READ) as t:
             dev_path = '/ncs:devices/device{"%s"}' % (self.dev_name, )
 
             dev_setting_path = '%s/%s' % (dev_path, name)
             if t.exists(dev_setting_path):
-                return conv(t.get_elem(dev_setting_path))
+                return t.get_elem(dev_setting_path)
 
             dev_profile_path = '%s/device-profile' % (dev_path, )
             if t.exists(dev_profile_path):
@@ -145,10 +107,10 @@ class NetconfOp(base_op.BaseOp):
                 profile_path = '/ncs:devices/profiles/profile{"%s"}' % (dev_profile, )
                 profile_setting_path = '%s/%s' % (profile_path, name)
                 if t.exists(profile_setting_path):
-                    return conv(t.get_elem(profile_setting_path))
+                    return t.get_elem(profile_setting_path)
 
             global_setting_path = '/ncs:devices/global-settings/%s' % (name, )
-            return conv(t.get_elem(global_setting_path))
+            return t.get_elem(global_setting_path)
 
     def device_has_capa_netconf_monitoring(self, capas_list):
         return ("urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring" in ' '.join(capas_list))
@@ -158,6 +120,18 @@ class NetconfOp(base_op.BaseOp):
         # http://cisco.com/ns/yang/Cisco-IOS-XR-bundlemgr-oper?module=Cisco-IOS-XR-bundlemgr-oper&revision=2015-11-09
         return string.split("?module=")[1].split("&")[0]
 
+    def module_revisions_from_hello(self, capas):
+        # Module name to revision, for the module capabilities with a
+        # revision, like the one above
+        revisions = {}
+        for capa in capas:
+            if capa.find("?module=") < 0:
+                continue
+            for param in capa.split("?", 1)[1].split("&"):
+                if param.startswith("revision="):
+                    revisions[self.module_name_from_capa(capa)] = param[len("revision="):]
+        return revisions
+
     def extract_model_list_from_hello(self, capas):
         self.debug("Hello capas len:\n" + str(len(capas)))
         model_list = [self.module_name_from_capa(c) for c in capas if (c.find("?module=") >= 0)]
@@ -167,45 +141,114 @@ class NetconfOp(base_op.BaseOp):
 
     def extract_capas_from_hello(self,  hello_str):
         self.debug("Parsing capas")
-        (capas_list_txt, stderr) = self.proc_run([self.get_exe_path("xsltproc"),
-                                                  "--nonet", "--novalid",
-                                                  self.pkg_root_dir + "/load-dir/ncs-extract-capas.xsl",
-                                                  "-"],
-                                                 hello_str)
-        self.debug("Parsed:\n" + capas_list_txt + "\n" + stderr)
-        if stderr != "":
-            raise ActionError({'error':"Failed to parse capas list:\n" + stderr})
-        capas_list=capas_list_txt.split("\n")
+        try:
+            capas_list = xml_extract.extract_capas(hello_str)
+        except xml_extract.ExtractError as e:
+            raise ActionError({'error':"Failed to parse capas list:\n" + str(e)})
+        self.debug("Parsed:\n" + "\n".join(capas_list))
         return capas_list
 
-    def nc_perform(self, op='get', subtree='', xpath='', method_opts=None, timeout=20):
-        if subtree != '':
-            method_opts = [ "--subtree", subtree ]
-        elif xpath != '':
-            method_opts = [ "--xpath", xpath ]
-        elif method_opts is None:
-            method_opts = []
-
-        (address, port, remote_name, remote_password) = self.get_conn_details()
-        args = ["--"+op ] + method_opts + ["--host="+str(address),
-                                           "--port="+str(port),
-                                           "--user="+str(remote_name),
-                                           "--password="+str(remote_password)]
-        iocb = IoCb(lambda: self.extend_timeout(timeout))
-        self.debug("Calling netconf_console %s" % args)
-        netconf_console.main(args, iocb, self)
-        self.debug("Returned from netconf_console")
-
-        if sys.hexversion >= 0x03000000:
-            xml_get_result = iocb.out.getvalue().decode()
-            stderr = iocb.err.getvalue().decode()
+    def get_session_pool_settings(self):
+        return self.cached(None, 'session-pool', self.read_session_pool_settings)
+
+    def read_session_pool_settings(self):
+        with single_trans(_ncs.READ) as t:
+            pool_path = '/{0}:{1}/{2}/'.format(
+                ns.ns.prefix, ns.ns.pioneer_pioneer_, ns.ns.pioneer_session_pool_)
+            idle_timeout = int(t.get_elem(pool_path + ns.ns.pioneer_idle_timeout_))
+            max_sessions = int(t.get_elem(pool_path + ns.ns.pioneer_max_sessions_per_device_))
+            return (idle_timeout, max_sessions)
+
+    def nc_session_settings(self):
+        # What nc_session reads from NSO: the connection details and
+        # the session pool settings
+        pool_settings = None
+        if self.session_pool is not None:
+            pool_settings = self.get_session_pool_settings()
+        return (self.get_conn_details(), pool_settings)
+
+    @contextlib.contextmanager
+    def nc_session(self, timeout=20, extend_timeout=None, settings=None):
+        # extend_timeout is called on every send and recv on the
+        # session, by default it extends the action timeout by timeout
+        # seconds. Threads other than the action thread must pass
+        # their own, and the settings from nc_session_settings() read
+        # by the action thread, as they must not talk to NSO.
+        if settings is None:
+            settings = self.nc_session_settings()
+        (conn_details, pool_settings) = settings
+        (address, port, remote_name, remote_password) = conn_details
+        if extend_timeout is None:
+            extend_timeout = lambda: self.extend_timeout(timeout)
+
+        def create_trans(iocb):
+            return ExtendTimeoutNetconfSSH(
+                extend_timeout,
+                iocb, address, port, remote_name, remote_password, "", "", "", "")
+
+        def connect():
+            session = netconf_session.NetconfSession(self.dev_name, conn_details, create_trans)
+            try:
+                session.connect()
+            except:
+                session.broken = True
+                session.close()
+                raise
+            return session
+
+        pool = self.session_pool
+        if pool is None:
+            # Not called from the action daemon, nothing to share
+            # the session with
+            pool = netconf_session.SessionPool(self.debug, idle_timeout=0)
         else:
-            xml_get_result = iocb.out.getvalue()
-            stderr = iocb.err.getvalue()
+            pool.configure(*pool_settings)
 
-        self.debug("Fetched:\n" + xml_get_result + "\n\n" + stderr)
-        if stderr != "":
-            raise ActionError({'error':"Failed to execute "+op+":\n" + stderr})
+        with pool.session(self.dev_name, conn_details, connect) as session:
+            session.bind(extend_timeout)
+            try:
+                yield session
+            finally:
+                session.bind(None)
+
+    def format_reply(self, reply):
+        try:
+            return netconf_console.format_xml(reply)
+        except xml.parsers.expat.ExpatError as e:
+            raise ActionError({'error':"Failed to format reply:\n" + str(e)})
+
+    def nc_perform(self, op='get', subtree='', xpath='', method_opts=None, timeout=20, sink=None):
+        # With a sink (a binary file object) the reply is written to
+        # it unformatted as it is received, and only its size and
+        # digest are logged; nothing is returned.
+        if op == 'hello':
+            msg = None
+        elif op in ('get', 'get-config'):
+            msg = netconf_console.get_msg(op, 'running', xpath, subtree, '', False)
+        elif op == 'get-schema':
+            msg = netconf_console.get_schema_msg(method_opts[0])
+        else:
+            raise ActionError({'error':"Unsupported NETCONF operation " + op})
+
+        if sink is not None:
+            sink = netconf_session.ReplySink(sink)
+        with self.nc_session(timeout) as session:
+            if msg is None:
+                reply = session.hello
+                if sink is not None:
+                    sink.write(netconf_console.bin_data(reply))
+            else:
+                self.debug("Sending {0} on NETCONF session".format(op))
+                if sink is not None:
+                    session.rpc_to(msg, sink.write)
+                else:
+                    reply = session.rpc(msg)
+
+        if sink is not None:
+            self.debug("Fetched " + sink.summary())
+            return None
+        xml_get_result = self.format_reply(reply)
+        self.debug("Fetched:\n" + xml_get_result)
         return xml_get_result
 
     def fetch_model_list_netconf_monitoring(self, method):
@@ -217,16 +260,13 @@ class NetconfOp(base_op.BaseOp):
             xml_get_result = self.nc_perform(xpath="/netconf-state")
 
         self.debug("Parsing model names")
-        (model_list_txt, stderr) = self.proc_run([self.get_exe_path("xsltproc"),
-                                                  "--nonet", "--novalid",
-                                                  self.pkg_root_dir + "/load-dir/ncs-extract-schemas.xsl",
-                                                  "-"],
-                                                 xml_get_result)
-        self.debug("Parsed:\n" + model_list_txt + "\n" + stderr)
-        if stderr != "":
-            raise ActionError({'error':"Failed to parse model list:\n" + stderr})
+        try:
+            lines = xml_extract.extract_schemas(xml_get_result)
+        except xml_extract.ExtractError as e:
+            raise ActionError({'error':"Failed to parse model list:\n" + str(e)})
+        self.debug("Parsed:\n" + "\n".join(lines))
         model_list = []
-        lines = [line for line in model_list_txt.split("\n") if line != ""]
+        lines = [line for line in lines if line != ""]
         for line in lines:
             tokens = line.split(":")
             self.debug("tokens="+str(tokens))
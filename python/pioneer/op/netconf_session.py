@@ -0,0 +1,312 @@
+# -*- mode: python; python-indent: 4 -*-
+
+import contextlib
+import hashlib
+import threading
+import time
+
+from pioneer.op.ex import ActionError
+
+import pioneer.netconf_console as netconf_console
+
+class SessionIoCb(object):
+    """netconf_console io callbacks for a pooled session. Nothing is
+    printed, transport errors are collected so that the session can
+    be marked as broken."""
+    def __init__(self):
+        self.errors = []
+
+    def output(self, msg):
+        pass
+
+    def output_err(self, msg):
+        self.errors.append(str(msg))
+
+    def output_trace(self, msg):
+        pass
+
+    def abort(self, msg):
+        raise ActionError({'error': msg})
+
+
+class ReplySink(object):
+    """Writes a reply to a binary file object as it is received,
+    keeping track of its size and SHA-256 digest."""
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, chunk):
+        self.fobj.write(chunk)
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+
+    def summary(self):
+        return "{0} bytes, sha256 {1}".format(self.size, self.sha256.hexdigest())
+
+
+class NetconfSession(object):
+    """A connected NETCONF session, hello exchanged and framing
+    negotiated, ready to carry any number of RPCs."""
+
+    def __init__(self, dev_name, conn_details, trans_factory):
+        self.dev_name = dev_name
+        self.conn_details = conn_details
+        self.iocb = SessionIoCb()
+        self.trans = trans_factory(self.iocb)
+        self.hello = None
+        self.broken = False
+        self.last_used = time.time()
+        self.message_id = 0
+
+    def bind(self, extend_timeout):
+        # The transport extends the action timeout on every send and
+        # recv; rebind it to the action currently using the session.
+        self.trans.extend_timeout = extend_timeout or (lambda: None)
+
+    def connect(self, versions=('1.0', '1.1')):
+        self.trans.connect()
+        self.send_msg(netconf_console.hello_msg(versions))
+        self.hello = self.recv_reply()
+        netconf_console.select_framing(self.trans, self.hello, versions)
+
+    def send_msg(self, msg):
+        self.trans.send_msg(msg)
+        self._check_errors()
+
+    def recv_reply(self, timeout=None):
+        chunks = []
+        while True:
+            (code, chunk) = self.trans.recv_chunk(timeout)
+            if code == 1:
+                chunks.append(chunk)
+            elif code == 0:
+                return "".join(chunks)
+            else:
+                self._transport_failed(code)
+
+    def recv_reply_to(self, write, timeout=None):
+        # pass the undecoded reply to write() chunk by chunk, nothing
+        # is kept in memory
+        while True:
+            (code, chunk) = self.trans.recv_chunk_bytes(timeout)
+            if code == 1:
+                write(chunk)
+            elif code == 0:
+                return
+            else:
+                self._transport_failed(code)
+
+    def rpc(self, msg, timeout=None):
+        self.send_msg(msg)
+        return self.recv_reply(timeout)
+
+    def rpc_to(self, msg, write, timeout=None):
+        self.send_msg(msg)
+        self.recv_reply_to(write, timeout)
+
+    def next_message_id(self):
+        self.message_id += 1
+        return str(self.message_id)
+
+    def pipeline(self, requests, window, timeout=None):
+        """Send the (message_id, msg) pairs from requests, keeping at
+        most window of them outstanding. Generates (message_id, reply)
+        pairs in the order the replies arrive."""
+        def recv():
+            reply = self.recv_reply(timeout)
+            return (netconf_console.reply_message_id(reply), reply)
+        return self._pipeline(requests, window, recv)
+
+    def pipeline_to(self, requests, window, make_sink, timeout=None):
+        """As pipeline(), but each reply is fed to a new sink from
+        make_sink() as it is received, and (message_id, sink) pairs
+        are generated. The sink has a feed(chunk) method and a
+        message_id attribute, known once the reply has been fed; it
+        must not raise from feed()."""
+        def recv():
+            sink = make_sink()
+            self.recv_reply_to(sink.feed, timeout)
+            return (sink.message_id, sink)
+        return self._pipeline(requests, window, recv)
+
+    def _pipeline(self, requests, window, recv):
+        requests = iter(requests)
+        outstanding = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(outstanding) < window:
+                try:
+                    (message_id, msg) = next(requests)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.send_msg(msg)
+                outstanding.add(message_id)
+            if not outstanding:
+                return
+            (message_id, reply) = recv()
+            if message_id not in outstanding:
+                self.broken = True
+                raise ActionError({'error': "Unexpected rpc-reply message-id {0}".format(message_id)})
+            outstanding.remove(message_id)
+            yield (message_id, reply)
+
+    def is_healthy(self):
+        if self.broken:
+            return False
+        try:
+            return self.trans.is_alive()
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            if not self.broken:
+                self.rpc(netconf_console.close_msg(), timeout=5)
+        except Exception:
+            pass
+        finally:
+            try:
+                self.trans.close()
+            except Exception:
+                pass
+
+    def _transport_failed(self, code):
+        self.broken = True
+        if code == -1:
+            raise ActionError({'error': "unexpected EOF in NETCONF transport"})
+        raise ActionError({'error': "NETCONF transport framing error"})
+
+    def _check_errors(self):
+        if self.iocb.errors:
+            self.broken = True
+            errors = self.iocb.errors
+            self.iocb.errors = []
+            raise ActionError({'error': "NETCONF transport error: " + "; ".join(errors)})
+
+
+class SessionsBusyError(ActionError):
+    """No session to the device could be had within the wait timeout."""
+    pass
+
+
+class SessionPool(object):
+    """NETCONF sessions kept open between RPCs and actions, keyed by
+    device name. Sessions idle for longer than idle_timeout seconds
+    are closed, and no more than max_sessions are opened per device."""
+
+    def __init__(self, debug, idle_timeout=300, max_sessions=4):
+        self.debug = debug
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.cond = threading.Condition()
+        self.idle = {}
+        self.in_use = {}
+
+    def configure(self, idle_timeout, max_sessions):
+        with self.cond:
+            self.idle_timeout = idle_timeout
+            self.max_sessions = max_sessions
+            self.cond.notify_all()
+
+    def checkout(self, dev_name, conn_details, connect_fun, wait_timeout=60):
+        deadline = time.time() + wait_timeout
+        stale = []
+        session = None
+        granted = False
+        with self.cond:
+            while True:
+                stale.extend(self._pop_expired())
+                idle = self.idle.get(dev_name, [])
+                while idle:
+                    candidate = idle.pop()
+                    if candidate.conn_details == conn_details and candidate.is_healthy():
+                        session = candidate
+                        break
+                    stale.append(candidate)
+                if session is not None or self.in_use.get(dev_name, 0) < self.max_sessions:
+                    self.in_use[dev_name] = self.in_use.get(dev_name, 0) + 1
+                    granted = True
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+        self._close_sessions(stale)
+        if not granted:
+            raise SessionsBusyError({'error': "All {0} NETCONF sessions to {1} are busy".format(
+                self.max_sessions, dev_name)})
+        if session is not None:
+            self.debug("Reusing NETCONF session to {0}".format(dev_name))
+            return session
+
+        self.debug("Opening new NETCONF session to {0}".format(dev_name))
+        try:
+            return connect_fun()
+        except:
+            self._release(dev_name)
+            raise
+
+    def checkin(self, session):
+        session.last_used = time.time()
+        keep = self.idle_timeout > 0 and session.is_healthy()
+        with self.cond:
+            if keep:
+                self.idle.setdefault(session.dev_name, []).append(session)
+            self._release_locked(session.dev_name)
+        if not keep:
+            self._close_sessions([session])
+
+    @contextlib.contextmanager
+    def session(self, dev_name, conn_details, connect_fun):
+        session = self.checkout(dev_name, conn_details, connect_fun)
+        try:
+            yield session
+        except:
+            # we cannot tell if a reply is still pending on the session
+            session.broken = True
+            raise
+        finally:
+            self.checkin(session)
+
+    def expire_idle(self):
+        with self.cond:
+            expired = self._pop_expired()
+        self._close_sessions(expired)
+
+    def close_all(self):
+        with self.cond:
+            sessions = [s for idle in self.idle.values() for s in idle]
+            self.idle = {}
+        self._close_sessions(sessions)
+
+    def _pop_expired(self):
+        expired = []
+        limit = time.time() - self.idle_timeout
+        for dev_name in list(self.idle.keys()):
+            keep = [s for s in self.idle[dev_name] if s.last_used > limit]
+            expired.extend([s for s in self.idle[dev_name] if s.last_used <= limit])
+            if keep:
+                self.idle[dev_name] = keep
+            else:
+                del self.idle[dev_name]
+        return expired
+
+    def _release(self, dev_name):
+        with self.cond:
+            self._release_locked(dev_name)
+
+    def _release_locked(self, dev_name):
+        self.in_use[dev_name] -= 1
+        if self.in_use[dev_name] == 0:
+            del self.in_use[dev_name]
+        self.cond.notify_all()
+
+    def _close_sessions(self, sessions):
+        for session in sessions:
+            self.debug("Closing NETCONF session to {0}, {1}".format(
+                session.dev_name, session.trans.send_stats()))
+            session.close()
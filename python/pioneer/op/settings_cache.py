@@ -0,0 +1,106 @@
+# -*- mode: python; python-indent: 4 -*-
+
+import select
+import socket
+import threading
+import traceback
+
+import _ncs
+import _ncs.cdb as cdb
+
+class SettingsCache(object):
+    """Values read from NSO configuration, such as device connection
+    details and settings, keyed by device name and setting. The cache
+    is only used while a CacheInvalidator is subscribed to the
+    configuration the values come from; any change to it empties the
+    cache."""
+
+    def __init__(self, debug):
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.values = {}
+        self.enabled = False
+        # bumped on every invalidation, so that a value read before an
+        # invalidation is not stored after it
+        self.generation = 0
+
+    def get(self, dev_name, key, load_fun):
+        with self.lock:
+            if not self.enabled:
+                generation = None
+            elif (dev_name, key) in self.values:
+                return self.values[(dev_name, key)]
+            else:
+                generation = self.generation
+        value = load_fun()
+        with self.lock:
+            if self.enabled and generation == self.generation:
+                self.values[(dev_name, key)] = value
+        return value
+
+    def enable(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            self._clear_locked()
+
+    def invalidate(self):
+        with self.lock:
+            self._clear_locked()
+
+    def _clear_locked(self):
+        self.generation += 1
+        self.values = {}
+
+
+class CacheInvalidator(threading.Thread):
+    """CDB subscriber emptying a SettingsCache whenever any of paths
+    changes. Runs until stop_fd becomes readable."""
+
+    priority = 100
+    retry_interval = 5
+
+    def __init__(self, debug, cache, paths, stop_fd):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.debug = debug
+        self.cache = cache
+        self.paths = paths
+        self.stop_fd = stop_fd
+
+    def run(self):
+        while True:
+            sock = None
+            try:
+                sock = self.subscribe()
+                self.cache.enable(True)
+                if self.serve(sock):
+                    return
+            except Exception:
+                self.debug("Settings cache subscriber failed: " + traceback.format_exc())
+            finally:
+                self.cache.enable(False)
+                if sock is not None:
+                    sock.close()
+            (r, w, e) = select.select([self.stop_fd], [], [], self.retry_interval)
+            if r:
+                return
+
+    def subscribe(self):
+        sock = socket.socket()
+        cdb.connect(sock, cdb.SUBSCRIPTION_SOCKET, '127.0.0.1', _ncs.NCS_PORT)
+        for path in self.paths:
+            cdb.subscribe(sock, self.priority, 0, path)
+        cdb.subscribe_done(sock)
+        self.debug("Settings cache subscribed to " + ", ".join(self.paths))
+        return sock
+
+    def serve(self, sock):
+        # Returns True when asked to stop
+        while True:
+            (r, w, e) = select.select([sock, self.stop_fd], [], [])
+            if self.stop_fd in r:
+                return True
+            cdb.read_subscription_socket(sock)
+            self.debug("Configuration changed, emptying settings cache")
+            self.cache.invalidate()
+            cdb.sync_subscription_socket(sock, cdb.DONE_PRIORITY)
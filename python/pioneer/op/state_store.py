@@ -0,0 +1,254 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Store of recorded device states.
+
+index.json lists the states with their device, name, size, content
+hash, canonical hash (see state_subtrees.canonical_hash), creation
+time and the rollback they were recorded from. The
+content of a state is kept in objects/<sha256 of content>, or gzip
+compressed in objects/<sha256>.gz, so states with the same content
+share an object. The subtree hashes of state_subtrees are kept next
+to the object as objects/<sha256>.hashes."""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pioneer.op.state_subtrees as state_subtrees
+
+LEGACY_SUFFIX = ".state.cb"
+
+def native(value):
+    # json gives unicode strings, Python 2 callers want str
+    if sys.hexversion < 0x03000000 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha.update(data)
+            size += len(data)
+    return (sha.hexdigest(), size)
+
+
+class StateStore(object):
+    # The index is rewritten as a whole; one writer at a time
+    lock = threading.Lock()
+
+    def __init__(self, directory, legacy_dir=None, debug=None):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.index_path = os.path.join(directory, "index.json")
+        self.debug = debug or (lambda msg: None)
+        with self.lock:
+            if not os.path.exists(self.index_path):
+                self._create(legacy_dir)
+
+    def _create(self, legacy_dir):
+        if not os.path.isdir(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        states = []
+        if legacy_dir and os.path.isdir(legacy_dir):
+            # States used to be <device>--<name>.state.cb files among
+            # the NSO logs
+            for filename in sorted(os.listdir(legacy_dir)):
+                if not filename.endswith(LEGACY_SUFFIX) or '--' not in filename:
+                    continue
+                (device, name) = filename[:-len(LEGACY_SUFFIX)].split('--', 1)
+                path = os.path.join(legacy_dir, filename)
+                created = time.gmtime(os.path.getmtime(path))
+                states.append(self._store_object(device, name, path, None, False, created))
+                state_subtrees.remove_hashes(path)
+                self.debug("Moved state {0} of {1} into the state store".format(name, device))
+        self._write_index(states)
+
+    def _read_index(self):
+        with open(self.index_path) as f:
+            index = json.load(f)
+        return [dict((native(k), native(v)) for (k, v) in entry.items())
+                for entry in index['states']]
+
+    def _write_index(self, states):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'version': 1, 'states': states}, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+    def object_path(self, entry):
+        return os.path.join(self.objects_dir,
+                            entry['hash'] + (".gz" if entry['compressed'] else ""))
+
+    def states(self, device):
+        return [entry for entry in self._read_index() if entry['device'] == device]
+
+    def lookup(self, device, name):
+        for entry in self._read_index():
+            if entry['device'] == device and entry['name'] == name:
+                return entry
+        return None
+
+    def temp_file(self):
+        # A file to record a state into before adding it, on the same
+        # file system as the objects
+        return tempfile.mkstemp(dir=self.objects_dir, suffix=".tmp")
+
+    def add(self, device, name, path, rollback=None, compress=False, content_hash=None):
+        """Adds the state in file path, which is moved or removed,
+        replacing any state with the same name. content_hash is the
+        (sha256 hex digest, size) of the file, if already known.
+        Returns its entry."""
+        return self.add_all([(device, name, path, rollback, compress, content_hash)])[0]
+
+    def add_all(self, states, extend_timeout=None):
+        """Adds several states, tuples of the arguments to add(), with
+        a single update of the index. Each state is parsed for its
+        hashes, taking about a second per MB; extend_timeout(seconds),
+        if given, is called before each one."""
+        with self.lock:
+            created = time.gmtime()
+            entries = []
+            for (device, name, path, rollback, compress, content_hash) in states:
+                if extend_timeout is not None:
+                    extend_timeout(self.store_timeout(path))
+                entries.append(self._store_object(device, name, path, rollback, compress,
+                                                  created, content_hash))
+            names = set((e['device'], e['name']) for e in entries)
+            kept = [e for e in self._read_index() if (e['device'], e['name']) not in names]
+            self._write_index(kept + entries)
+            self._collect(kept + entries)
+        return entries
+
+    @staticmethod
+    def store_timeout(path):
+        # Seconds to allow for storing the state in file path
+        return 60 + 2 * os.path.getsize(path) // (1024 * 1024)
+
+    def _store_object(self, device, name, path, rollback, compress, created, content_hash=None):
+        (digest, size) = content_hash or file_hash(path)
+        try:
+            (subtrees, canonical) = state_subtrees.read_state(path)
+        except state_subtrees.StateFormatError as e:
+            self.debug("No subtree or canonical hashes of state {0}: {1}".format(name, e))
+            (subtrees, canonical) = (None, None)
+        plain_path = os.path.join(self.objects_dir, digest)
+        compressed_path = plain_path + ".gz"
+        if os.path.exists(plain_path):
+            compress = False
+        elif os.path.exists(compressed_path):
+            compress = True
+        else:
+            if compress:
+                with open(path, "rb") as src:
+                    with gzip.open(compressed_path + ".tmp", "wb") as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.rename(compressed_path + ".tmp", compressed_path)
+            else:
+                shutil.copyfile(path, plain_path + ".tmp")
+                os.rename(plain_path + ".tmp", plain_path)
+            if subtrees is not None:
+                state_subtrees.write_hashes(path, subtrees)
+                os.rename(path + state_subtrees.HASHES_SUFFIX,
+                          plain_path + state_subtrees.HASHES_SUFFIX)
+        os.remove(path)
+        return {'device': device, 'name': name, 'size': size, 'hash': digest,
+                'canonical': canonical, 'compressed': compress, 'rollback': rollback,
+                'created': time.strftime("%Y-%m-%dT%H:%M:%SZ", created)}
+
+    def _canonical_hash(self, name, path, compressed):
+        try:
+            with (gzip.open(path, "rb") if compressed else open(path, "rb")) as f:
+                data = f.read()
+            return state_subtrees.canonical_hash(data.decode('utf-8'))
+        except state_subtrees.StateFormatError as e:
+            self.debug("No canonical hash of state {0}: {1}".format(name, e))
+            return None
+
+    def canonical_hashes(self, entries):
+        """Returns the canonical hashes of entries, computing and saving
+        those of states added before the index had them. None for states
+        that could not be parsed."""
+        missing = [e for e in entries if 'canonical' not in e]
+        if missing:
+            computed = dict(((e['device'], e['name']),
+                             self._canonical_hash(e['name'], self.object_path(e),
+                                                  e['compressed']))
+                            for e in missing)
+            with self.lock:
+                states = self._read_index()
+                for e in states:
+                    key = (e['device'], e['name'])
+                    if 'canonical' not in e and key in computed:
+                        e['canonical'] = computed[key]
+                self._write_index(states)
+            for e in missing:
+                e['canonical'] = computed[(e['device'], e['name'])]
+        return [e['canonical'] for e in entries]
+
+    def delete(self, device, name):
+        with self.lock:
+            states = self._read_index()
+            remaining = [e for e in states if (e['device'], e['name']) != (device, name)]
+            if len(remaining) == len(states):
+                return False
+            self._write_index(remaining)
+            self._collect(remaining)
+        return True
+
+    def _collect(self, states):
+        # Remove the objects no state refers to
+        used = set(e['hash'] for e in states)
+        for filename in os.listdir(self.objects_dir):
+            digest = filename.split('.')[0]
+            if digest not in used and not filename.endswith(".tmp"):
+                os.remove(os.path.join(self.objects_dir, filename))
+
+    def checkout(self):
+        return Checkout(self)
+
+
+class Checkout(object):
+    """Plain files of states for loading into NSO, decompressing the
+    compressed ones into a temporary directory removed by close()."""
+
+    def __init__(self, store):
+        self.store = store
+        self.tmp_dir = None
+
+    def path(self, entry):
+        path = self.store.object_path(entry)
+        if not entry['compressed']:
+            return path
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix="pioneer-states-")
+        plain_path = os.path.join(self.tmp_dir, entry['hash'])
+        if not os.path.exists(plain_path):
+            with gzip.open(path, "rb") as src:
+                with open(plain_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            hashes_path = os.path.join(self.store.objects_dir,
+                                       entry['hash'] + state_subtrees.HASHES_SUFFIX)
+            if os.path.exists(hashes_path):
+                shutil.copyfile(hashes_path, plain_path + state_subtrees.HASHES_SUFFIX)
+        return plain_path
+
+    def close(self):
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -0,0 +1,244 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Top-level subtrees of recorded device states.
+
+A state file is the J-format (curly brace) configuration saved from
+/devices/device{name}/config. The top-level nodes of the device
+configuration are the subtrees: all entries of a list count as one
+subtree, as do all leafs of a leaf-list. The hash of each subtree and
+the byte offsets of its entries are kept in a sidecar file next to the
+state, so that the subtrees that differ between two states can be
+found without reading either, and then read without parsing it."""
+
+import collections
+import hashlib
+import json
+import os
+import re
+
+HASHES_SUFFIX = ".hashes"
+
+_token_re = re.compile(r'"(?:[^"\\]|\\.)*"|[{};]|[^\s{};"]+', re.S)
+# For bytes decoded as latin-1, where only ASCII whitespace separates
+_byte_token_re = re.compile(_token_re.pattern, re.S | getattr(re, 'ASCII', 0))
+
+_config_path = ['devices', 'device', 'config']
+
+class StateFormatError(Exception):
+    pass
+
+
+def parse_tree(data, token_re=_token_re):
+    """Returns the statements of J-format data as a list of (tokens,
+    children, start, end), children being None for statements ending
+    in ;, and start and end the offsets of the statement in data."""
+    root = []
+    stack = [(root, None, 0)]
+    current = []
+    current_start = None
+    for m in token_re.finditer(data):
+        token = m.group(0)
+        if current_start is None:
+            current_start = m.start()
+        if token == '{':
+            stack.append(([], current, current_start))
+            current = []
+            current_start = None
+        elif token == '}':
+            if current or len(stack) == 1:
+                raise StateFormatError("Unbalanced braces")
+            (children, tokens, start) = stack.pop()
+            stack[-1][0].append((tokens, children, start, m.end()))
+            current_start = None
+        elif token == ';':
+            stack[-1][0].append((current, None, current_start, m.end()))
+            current = []
+            current_start = None
+        else:
+            current.append(token)
+    if current or len(stack) != 1:
+        raise StateFormatError("Unbalanced braces")
+    return root
+
+
+def config_statements(tree):
+    statements = tree
+    for name in _config_path:
+        matching = [children for (tokens, children, start, end) in statements
+                    if tokens[:1] == [name] and children is not None]
+        if len(matching) != 1:
+            raise StateFormatError("No device config found")
+        statements = matching[0]
+    return statements
+
+
+def _flat_tokens(statement, out):
+    (tokens, children, start, end) = statement
+    out.extend(tokens)
+    if children is None:
+        out.append(';')
+    else:
+        out.append('{')
+        for child in children:
+            _flat_tokens(child, out)
+        out.append('}')
+    return out
+
+
+def _subtrees(statements, encoding):
+    subtrees = collections.OrderedDict()
+    last_name = None
+    for statement in statements:
+        (tokens, children, start, end) = statement
+        name = tokens[0]
+        (hashes, spans) = subtrees.setdefault(name, ([], []))
+        hashes.append(" ".join(_flat_tokens(statement, [])))
+        if spans and last_name == name:
+            # only whitespace since the previous entry, one span for
+            # all entries of a list keeps the sidecar small
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+        last_name = name
+
+    result = collections.OrderedDict()
+    for (name, (hashes, spans)) in subtrees.items():
+        joined = "\n".join(hashes)
+        if not isinstance(joined, bytes):
+            joined = joined.encode(encoding)
+        digest = hashlib.sha256(joined).hexdigest()
+        result[name] = (digest, spans)
+    return result
+
+
+def parse_state(data, encoding='utf-8'):
+    """Returns the subtrees and the canonical hash of the state in
+    J-format data, parsing it once. The subtrees are an ordered dict
+    from top-level node name to (hash, spans), spans being the (start,
+    end) offsets in data of the text of the entries with that name, one
+    for each run of them. Hashes are of the text encoded with encoding;
+    read_state decodes the file as latin-1, so that offsets are byte
+    offsets."""
+    token_re = _token_re if encoding == 'utf-8' else _byte_token_re
+    statements = config_statements(parse_tree(data, token_re))
+    canonical = _canonical(statements, None)
+    if not isinstance(canonical, bytes):
+        canonical = canonical.encode(encoding)
+    return (_subtrees(statements, encoding), hashlib.sha256(canonical).hexdigest())
+
+
+def _unquote(token):
+    if token.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+    return token
+
+
+def _canonical(statements, parent_prefix):
+    # Node names carry their prefix only where it differs from the
+    # parent's, values are unquoted, and siblings are sorted
+    lines = []
+    for (tokens, children, start, end) in statements:
+        (prefix, sep, name) = tokens[0].rpartition(':')
+        prefix = prefix or parent_prefix
+        if prefix != parent_prefix:
+            name = prefix + ':' + name
+        line = "\x1f".join([name] + [_unquote(token) for token in tokens[1:]])
+        if children is None:
+            line += ";"
+        else:
+            line += "{" + _canonical(children, prefix) + "}"
+        lines.append(line)
+    return "\x1e".join(sorted(lines))
+
+
+def canonical_hash(data):
+    """Hash of the device configuration in J-format data, equal for
+    configurations that only differ in whitespace, quoting, redundant
+    prefixes or the order of statements. The order of entries in
+    ordered-by-user lists is thus ignored too."""
+    return parse_state(data)[1]
+
+
+def read_state(state_path):
+    """parse_state of a state file."""
+    with open(state_path, "rb") as f:
+        data = f.read()
+    if isinstance(data, str):
+        return parse_state(data)
+    return parse_state(data.decode('latin-1'), 'latin-1')
+
+
+def parse_file(state_path):
+    return read_state(state_path)[0]
+
+
+def write_hashes(state_path, subtrees=None):
+    """Writes the sidecar file of a state, the subtrees being those
+    parse_file returns for it. Returns the subtrees."""
+    if subtrees is None:
+        subtrees = parse_file(state_path)
+    entries = [[name, digest, [list(span) for span in spans]]
+               for (name, (digest, spans)) in subtrees.items()]
+    tmp_path = state_path + HASHES_SUFFIX + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entries, f, indent=1)
+    os.rename(tmp_path, state_path + HASHES_SUFFIX)
+    return subtrees
+
+
+def load_subtrees(state_path):
+    """Returns what parse_file would for a state, from the sidecar file
+    if it is up to date, otherwise parsing the state again."""
+    hashes_path = state_path + HASHES_SUFFIX
+    try:
+        if os.path.getmtime(hashes_path) >= os.path.getmtime(state_path):
+            with open(hashes_path) as f:
+                entries = json.load(f)
+            # a dict is a sidecar without offsets, from before they
+            # were kept
+            if isinstance(entries, list):
+                return collections.OrderedDict(
+                    (name, (digest, [tuple(span) for span in spans]))
+                    for (name, digest, spans) in entries)
+    except (OSError, IOError, ValueError):
+        pass
+    return write_hashes(state_path)
+
+
+def hashes(subtrees):
+    return collections.OrderedDict((name, digest) for (name, (digest, spans))
+                                   in subtrees.items())
+
+
+def load_hashes(state_path):
+    """Returns the subtree hashes of a state."""
+    return hashes(load_subtrees(state_path))
+
+
+def remove_hashes(state_path):
+    try:
+        os.remove(state_path + HASHES_SUFFIX)
+    except OSError:
+        pass
+
+
+def differing(from_hashes, to_hashes):
+    """Returns the names of the subtrees to remove and those to load to
+    go from the from_hashes state to the to_hashes one."""
+    removed = [name for name in from_hashes if name not in to_hashes]
+    changed = [name for name in to_hashes if from_hashes.get(name) != to_hashes[name]]
+    return (removed, changed)
+
+
+def write_partial(path, dev_name, state_path, subtrees, names):
+    # J-format of only the named subtrees of the state, for loading
+    # with merge; subtrees are those of load_subtrees
+    if not isinstance(dev_name, bytes):
+        dev_name = dev_name.encode('utf-8')
+    with open(state_path, "rb") as state:
+        with open(path, "wb") as f:
+            f.write(b"devices {\n    device " + dev_name + b" {\n        config {\n")
+            for name in names:
+                for (start, end) in subtrees[name][1]:
+                    state.seek(start)
+                    f.write(state.read(end - start) + b"\n")
+            f.write(b"        }\n    }\n}\n")
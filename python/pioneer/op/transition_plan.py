@@ -0,0 +1,265 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Scheduling of the transitions made by explore-transitions.
+
+Every recorded state can be reached from every other, so the
+transitions form a complete directed graph, in which every state has
+as many transitions in as out. Such a graph has an Eulerian circuit,
+a walk making every transition exactly once, and a device that never
+fails needs a single commit to reach a known state before following
+it. After failures the remaining transitions no longer balance, and
+the walk is split into trails, each costing a commit to reach its
+first state. The trails of a walk are kept and claimed one at a time
+from the state the device is in, so that a failure only discards the
+rest of one trail, which is joined to the others again. A new walk is
+planned only when no trail starts where a device is."""
+
+import random
+import threading
+import time
+
+class TransitionSet(object):
+    """Set of transitions between num_states states, one bit each."""
+
+    def __init__(self, num_states):
+        self.num_states = num_states
+        self.bits = bytearray((num_states * num_states + 7) // 8)
+        self.out_degree = [0] * num_states
+        self.in_degree = [0] * num_states
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, transition):
+        (from_state, to_state) = transition
+        i = from_state * self.num_states + to_state
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def add(self, from_state, to_state):
+        if (from_state, to_state) not in self:
+            i = from_state * self.num_states + to_state
+            self.bits[i >> 3] |= 1 << (i & 7)
+            self.out_degree[from_state] += 1
+            self.in_degree[to_state] += 1
+            self.count += 1
+
+    def remove(self, from_state, to_state):
+        if (from_state, to_state) in self:
+            i = from_state * self.num_states + to_state
+            self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+            self.out_degree[from_state] -= 1
+            self.in_degree[to_state] -= 1
+            self.count -= 1
+
+    def successors(self, from_state):
+        return [to_state for to_state in range(self.num_states)
+                if (from_state, to_state) in self]
+
+def plan_trails(transitions, start, shuffle=random.shuffle):
+    """Returns the trails of a covering walk of transitions starting in
+    start, each a list of the states it visits, the first one being
+    start. Only the transitions reachable from start are covered.
+
+    The states with more transitions out than in are where the trails
+    of a minimal cover start, and those with more in than out where
+    they end. Virtual transitions from the latter to the former
+    balance the graph, an Eulerian circuit of the balanced graph is
+    found with Hierholzer's algorithm, and it is split into trails
+    where it takes virtual transitions."""
+    num_states = transitions.num_states
+    adjacent = []
+    surplus = []
+    deficit = []
+    for state in range(num_states):
+        successors = transitions.successors(state)
+        shuffle(successors)
+        adjacent.append([(to_state, False) for to_state in successors])
+        balance = transitions.out_degree[state] - transitions.in_degree[state]
+        surplus += [state] * max(0, balance)
+        deficit += [state] * max(0, -balance)
+    for (from_state, to_state) in zip(deficit, surplus):
+        # Taken last, at the front of the list, so that real
+        # transitions come first when there is a choice
+        adjacent[from_state].insert(0, (to_state, True))
+
+    stack = [(start, False)]
+    circuit = []
+    while stack:
+        (state, virtual) = stack[-1]
+        if adjacent[state]:
+            stack.append(adjacent[state].pop())
+        else:
+            circuit.append(stack.pop())
+    circuit.reverse()
+
+    trails = [[start]]
+    for (state, virtual) in circuit[1:]:
+        if virtual:
+            trails.append([state])
+        else:
+            trails[-1].append(state)
+    return [trail for trail in trails if len(trail) > 1]
+
+class Route(object):
+    """The trail a device is following: the state it should be in, the
+    states still to visit, last one first, and the transition being
+    made, if any."""
+
+    def __init__(self):
+        self.at = None
+        self.states = []
+        self.current = None
+
+class TransitionPlan(object):
+    """The transitions of an explore-transitions run that are still to
+    be made, shared by the num_devices devices making them. A device
+    claims one trail at a time, at most its share of what remains, so
+    that devices exploring in parallel do not follow the same one; the
+    stop-after limits apply to the run as a whole."""
+
+    # Most transitions claimed at a time
+    max_claim = 32
+
+    def __init__(self, num_states, stop_cases, stop_time, num_devices=1,
+                 transitions=None, index=0, starts=0):
+        # transitions, index and starts are those left and made by an
+        # earlier run being resumed
+        self.lock = threading.Lock()
+        self.remaining = TransitionSet(num_states)
+        if transitions is None:
+            transitions = [(from_state, to_state)
+                           for from_state in range(0, num_states)
+                           for to_state in range(0, num_states)
+                           if to_state != from_state] ## Can't transition to same state
+        for (from_state, to_state) in transitions:
+            self.remaining.add(from_state, to_state)
+        self.num_devices = num_devices
+        self.stop_cases = stop_cases
+        self.stop_time = stop_time
+        self.index = index
+        self.starts = starts
+        self.limit_reached = False
+        self.routes = []
+        # Trails of the planned walk not claimed yet, covering the
+        # remaining transitions, or None when there is no plan
+        self.trails = None
+
+    def take(self, route, from_state, avoid=()):
+        # Returns None when no more transitions should be made, (index,
+        # to_state) for the next transition of route, or (None, state)
+        # when the device has to go to state before it can continue.
+        # from_state is None when the device is in an unknown state;
+        # the states in avoid are not picked to start from if possible.
+        with self.lock:
+            route.current = None
+            if route not in self.routes:
+                self.routes.append(route)
+            if (self.stop_time and time.time() > self.stop_time) or \
+               (self.stop_cases and self.index >= self.stop_cases):
+                self.limit_reached = True
+            if self.limit_reached:
+                return None
+            if route.states and route.at != from_state:
+                self._release(route)
+            if not route.states:
+                if from_state is None or 0 == self.remaining.out_degree[from_state]:
+                    # The remaining transitions may be claimed by other
+                    # devices, and are made by them unless they fail
+                    start = self._pick_start(avoid)
+                    if start is not None:
+                        self.starts += 1
+                        return (None, start)
+                    return None
+                trail = self._take_trail(from_state)
+                if trail is None:
+                    self.trails = plan_trails(self.remaining, from_state)
+                    trail = self._take_trail(from_state)
+                # Leave some of the work for the other devices; the
+                # rest of the trail stays planned, so claiming a part
+                # of it at a time costs no commit and keeps what a
+                # failure gives back short
+                share = max(1, min(self.max_claim, len(self.remaining) // self.num_devices))
+                if len(trail) > share + 1:
+                    self._add_trail(trail[share:])
+                self._claim(route, from_state, trail[1:share + 1])
+            route.current = (route.at, route.states[-1])
+            route.at = route.states.pop()
+            self.index += 1
+            return (self.index, route.at)
+
+    def pending(self):
+        """Returns the transitions not made yet: the remaining ones,
+        those claimed by routes and those being made."""
+        with self.lock:
+            transitions = set((from_state, to_state)
+                              for from_state in range(self.remaining.num_states)
+                              for to_state in self.remaining.successors(from_state))
+            for route in self.routes:
+                if route.current is not None:
+                    transitions.add(route.current)
+                state = route.at
+                for to_state in reversed(route.states):
+                    transitions.add((state, to_state))
+                    state = to_state
+            return sorted(transitions)
+
+    def _claim(self, route, from_state, trail):
+        state = from_state
+        for to_state in trail:
+            self.remaining.remove(state, to_state)
+            state = to_state
+        route.at = from_state
+        route.states = trail[::-1]
+
+    def _release(self, route):
+        state = route.at
+        for to_state in reversed(route.states):
+            self.remaining.add(state, to_state)
+            state = to_state
+        if self.trails is not None:
+            self._add_trail([route.at] + route.states[::-1])
+        route.states = []
+
+    def _take_trail(self, from_state):
+        # Removes and returns the planned trail starting in from_state,
+        # or None if there is none
+        if self.trails is None:
+            return None
+        for (i, trail) in enumerate(self.trails):
+            if trail[0] == from_state:
+                del self.trails[i]
+                return trail
+        return None
+
+    def _add_trail(self, trail):
+        # Joins trail to a planned one ending where it starts or
+        # starting where it ends, so that it costs no extra commit
+        for planned in self.trails:
+            if planned[-1] == trail[0]:
+                planned.extend(trail[1:])
+                return
+        for planned in self.trails:
+            if planned[0] == trail[-1]:
+                planned[:1] = trail
+                return
+        self.trails.append(trail)
+
+    def _pick_start(self, avoid):
+        # Trails of a minimal cover start where there are more
+        # transitions out than in, but any state with transitions out
+        # is better than one the device just failed to go to
+        if self.trails:
+            planned = [trail[0] for trail in self.trails if trail[0] not in avoid]
+            if planned:
+                return random.choice(planned)
+        remaining = self.remaining
+        starts = [state for state in range(remaining.num_states)
+                  if remaining.out_degree[state]]
+        surplus = [state for state in starts
+                   if remaining.out_degree[state] > remaining.in_degree[state]]
+        for candidates in ([state for state in surplus if state not in avoid],
+                           [state for state in starts if state not in avoid],
+                           surplus, starts):
+            if candidates:
+                return random.choice(candidates)
+        return None
@@ -0,0 +1,223 @@
+# -*- mode: python; python-indent: 4 -*-
+"""In-process replacements for the ncs-extract-*.xsl stylesheets.
+
+The extractors are fed the XML incrementally and give the same
+result as running xsltproc with the corresponding stylesheet, including
+failing on the elements the stylesheet does not match."""
+
+import sys
+import xml.parsers.expat
+
+NC_NS = 'urn:ietf:params:xml:ns:netconf:base:1.0'
+NCM_NS = 'urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring'
+CONFD_NS = 'http://tail-f.com/yang/confd-monitoring'
+
+class ExtractError(Exception):
+    pass
+
+
+def native_str(s):
+    # expat gives unicode, Python 2 callers want utf-8 encoded str
+    if sys.hexversion < 0x03000000 and isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+class Extractor(object):
+    """Base class; subclasses implement start(path, name), end(path,
+    name) and text(path, data). path is the list of (namespace, local
+    name) of the open elements, the current element last."""
+
+    def __init__(self):
+        self.parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+        self.parser.namespace_prefixes = True
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+        self.path = []
+        self.qnames = []
+
+    def feed(self, data):
+        if sys.hexversion < 0x03000000 and isinstance(data, bytearray):
+            data = str(data)
+        try:
+            self.parser.Parse(data, False)
+        except xml.parsers.expat.ExpatError as e:
+            raise ExtractError(str(e))
+
+    def close(self):
+        try:
+            self.parser.Parse("", True)
+        except xml.parsers.expat.ExpatError as e:
+            raise ExtractError(str(e))
+        return self.result()
+
+    def unmatched(self):
+        raise ExtractError("Unmatched element: " + self.qnames[-1])
+
+    def _start(self, name, attrs):
+        self.attrs = attrs
+        parts = name.split(' ')
+        if len(parts) == 1:
+            self.path.append(('', parts[0]))
+            self.qnames.append(parts[0])
+        else:
+            self.path.append((parts[0], parts[1]))
+            self.qnames.append(parts[2] + ':' + parts[1] if len(parts) == 3 else parts[1])
+        self.start(self.path, self.path[-1])
+
+    def _end(self, name):
+        self.end(self.path, self.path[-1])
+        self.path.pop()
+        self.qnames.pop()
+
+    def _text(self, data):
+        if self.path:
+            self.text(self.path, data)
+
+    def start(self, path, name):
+        pass
+
+    def end(self, path, name):
+        pass
+
+    def text(self, path, data):
+        pass
+
+
+class CapasExtractor(Extractor):
+    """ncs-extract-capas.xsl: the capabilities of a hello message."""
+
+    capa_path = [(NC_NS, 'hello'), (NC_NS, 'capabilities'), (NC_NS, 'capability')]
+
+    def __init__(self):
+        Extractor.__init__(self)
+        self.capas = []
+        self.current = []
+        self.first_text_done = False
+
+    def start(self, path, name):
+        if len(path) == 1 and name != (NC_NS, 'hello'):
+            self.unmatched()
+        if path == self.capa_path:
+            self.current = []
+            self.first_text_done = False
+        elif len(path) == 4 and self.current:
+            # only the first text node is selected
+            self.first_text_done = True
+
+    def end(self, path, name):
+        if path == self.capa_path:
+            self.capas.append("".join(self.current))
+
+    def text(self, path, data):
+        if path == self.capa_path and not self.first_text_done:
+            self.current.append(data)
+
+    def result(self):
+        return [native_str(capa) for capa in self.capas]
+
+
+class ModuleExtractor(Extractor):
+    """ncs-extract-module.xsl: the module text of a get-schema reply,
+    or "ERROR" for an rpc-error.
+
+    If write is given, the module text is instead passed to it piece
+    by piece as it is parsed, and result() only tells if the reply
+    was an rpc-error. The message-id of the reply is available in
+    message_id as soon as the rpc-reply start tag is parsed."""
+
+    def __init__(self, write=None):
+        Extractor.__init__(self)
+        self.out = []
+        self.streaming = write is not None
+        self.write = write or self.out.append
+        self.in_data = False
+        self.message_id = None
+        self.rpc_error = False
+
+    def start(self, path, name):
+        if len(path) == 1:
+            if name != (NC_NS, 'rpc-reply'):
+                self.unmatched()
+            self.message_id = native_str(self.attrs.get('message-id'))
+        elif len(path) == 2:
+            if name == (NCM_NS, 'data'):
+                self.in_data = True
+            elif name == (NC_NS, 'rpc-error'):
+                self.rpc_error = True
+                self.out.append("ERROR")
+            else:
+                self.unmatched()
+
+    def end(self, path, name):
+        if len(path) == 2:
+            self.in_data = False
+
+    def text(self, path, data):
+        if self.in_data:
+            self.write(data)
+
+    def result(self):
+        if self.streaming:
+            return self.rpc_error
+        return native_str("".join(self.out))
+
+
+class SchemasExtractor(Extractor):
+    """ncs-extract-schemas.xsl: the list of schemas of a netconf-state
+    or confd-state get reply, as 'confd:<name>' lines.
+
+    The stylesheet has a template per schema format, but xsltproc
+    resolves their conflict with the equal priority catch-all template
+    for schemas/* in favour of the catch-all, which prints nothing.
+    Entries in netconf-state/schemas are therefore not reported."""
+
+    model_path = [(NC_NS, 'rpc-reply'), (NC_NS, 'data'),
+                  (CONFD_NS, 'confd-state'), (CONFD_NS, 'loaded-data-models'),
+                  (CONFD_NS, 'data-model')]
+    name_path = model_path + [(CONFD_NS, 'name')]
+
+    def __init__(self):
+        Extractor.__init__(self)
+        self.lines = []
+        self.name = None
+        self.in_name = False
+
+    def start(self, path, name):
+        if len(path) == 1 and name != (NC_NS, 'rpc-reply'):
+            self.unmatched()
+        if path == self.model_path:
+            self.name = None
+        elif path == self.name_path and self.name is None:
+            # only the first name is selected
+            self.name = []
+            self.in_name = True
+
+    def end(self, path, name):
+        if path == self.model_path:
+            self.lines.append("confd:" + "".join(self.name or []))
+        elif path == self.name_path:
+            self.in_name = False
+
+    def text(self, path, data):
+        if self.in_name:
+            self.name.append(data)
+
+    def result(self):
+        return [native_str(line) for line in self.lines]
+
+
+def extract(extractor, data):
+    extractor.feed(data)
+    return extractor.close()
+
+def extract_capas(hello):
+    return extract(CapasExtractor(), hello)
+
+def extract_module(reply):
+    return extract(ModuleExtractor(), reply)
+
+def extract_schemas(reply):
+    return extract(SchemasExtractor(), reply)
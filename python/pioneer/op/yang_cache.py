@@ -0,0 +1,114 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Cache of downloaded YANG modules shared by all devices.
+
+The text of each module is kept once in objects/<sha256>.yang, and
+modules/<name>@<revision>.yang is a symbolic link to the object, so
+devices advertising the same module revision in their hello get the
+module from the cache instead of downloading it again. Modules are
+hard linked from the cache into the YANG directories of the devices,
+or copied where that is not possible. As a file may be changed
+through any of its links, the objects are made read-only, so that
+editing a module in place fails rather than changing it for every
+device that has it. An object is still checked against its hash
+before it is used, and dropped from the cache if it has changed.
+
+No index is kept: entries are added by renaming them into place, so
+any number of operations may use the cache at the same time."""
+
+import errno
+import hashlib
+import os
+import shutil
+import threading
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def _tmp_name(path):
+    return "{0}.{1}-{2}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+
+
+def link_or_copy(src, dst):
+    """Makes dst a hard link to src, or a copy of it if src is on
+    another file system, replacing dst if it exists."""
+    tmp_path = _tmp_name(dst)
+    try:
+        os.link(src, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(src, tmp_path)
+    os.rename(tmp_path, dst)
+
+
+class YangCache(object):
+    def __init__(self, directory, debug=None):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.modules_dir = os.path.join(directory, "modules")
+        self.debug = debug or (lambda msg: None)
+        for path in [self.objects_dir, self.modules_dir]:
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def entry_path(self, name, revision):
+        return os.path.join(self.modules_dir, "{0}@{1}.yang".format(name, revision))
+
+    def lookup(self, name, revision):
+        """Returns the path of the object of module name at revision,
+        or None if it is not in the cache."""
+        entry_path = self.entry_path(name, revision)
+        try:
+            object_name = os.readlink(entry_path)
+        except OSError:
+            return None
+        object_path = os.path.join(self.modules_dir, object_name)
+        digest = os.path.basename(object_name)[:-len(".yang")]
+        try:
+            if file_hash(object_path) == digest:
+                return object_path
+        except (IOError, OSError):
+            pass
+        self.debug("Dropping changed or missing {0}@{1} from the YANG cache".format(name, revision))
+        for path in [entry_path, object_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return None
+
+    def link(self, name, revision, path):
+        """Links module name at revision from the cache to path.
+        Returns False if it is not in the cache."""
+        object_path = self.lookup(name, revision)
+        if object_path is None:
+            return False
+        link_or_copy(object_path, path)
+        return True
+
+    def add(self, name, revision, path, digest=None):
+        """Adds the file path as module name at revision."""
+        digest = digest or file_hash(path)
+        object_path = os.path.join(self.objects_dir, digest + ".yang")
+        try:
+            current = file_hash(object_path)
+        except (IOError, OSError):
+            current = None
+        if current != digest:
+            link_or_copy(path, object_path)
+        os.chmod(object_path, 0o444)
+        entry_path = self.entry_path(name, revision)
+        tmp_path = _tmp_name(entry_path)
+        os.symlink(os.path.join(os.pardir, "objects", digest + ".yang"), tmp_path)
+        os.rename(tmp_path, entry_path)
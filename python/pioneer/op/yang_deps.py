@@ -0,0 +1,253 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Dependencies between YANG modules, read from the module headers.
+
+Only the module/submodule, belongs-to, import, include and revision
+statements are read, stopping at the first statement of the module
+body, so a whole directory of modules is scanned without compiling
+any of them. The body is only read on for its deviation statements,
+in the modules that have any."""
+
+import os
+import re
+import sys
+
+# Whitespace and comments, or a token: a quoted string, a brace or
+# semicolon, or an unquoted string
+_token_re = re.compile(r'(\s+|//[^\n]*|/\*.*?\*/)|'
+                       r'("(?:[^"\\]|\\.)*"|\'[^\']*\'|[{};]|[^\s{};"\']+)', re.S)
+
+# Statements allowed before the body of a module, RFC 7950 section 7.1.1
+_header_keywords = set(['yang-version', 'namespace', 'prefix', 'belongs-to',
+                        'import', 'include', 'organization', 'contact',
+                        'description', 'reference', 'revision'])
+
+# Quick check for a deviation statement, before reading the body
+_deviation_re = re.compile(r'(?:^|[\s;{}])deviation\s')
+
+class YangDepsError(Exception):
+    pass
+
+
+class ModuleHeader(object):
+    """What a YANG file says about its name, revision and dependencies.
+    imports and includes are lists of (name, revision-date or None),
+    deviates the sorted names of the other modules it has deviations
+    for."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.keyword = None
+        self.name = None
+        self.revision = None
+        self.belongs_to = None
+        self.imports = []
+        self.includes = []
+        self.deviates = []
+
+    def dependencies(self):
+        names = [name for (name, revision) in self.imports + self.includes]
+        if self.belongs_to is not None:
+            names.append(self.belongs_to)
+        return names
+
+
+def _unquote(token):
+    if token[:1] == '"':
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+    if token[:1] == "'":
+        return token[1:-1]
+    return token
+
+
+def parse_header(text, filename=None):
+    """Returns the ModuleHeader of the YANG module or submodule text."""
+    header = ModuleHeader(filename)
+    keywords = []   # keywords of the enclosing statements
+    statement = []
+    in_body = False
+    prefixes = {}   # import prefix -> module name
+    deviations = []
+    for m in _token_re.finditer(text):
+        token = m.group(2)
+        if token is None:
+            continue
+        if token not in ('{', ';', '}'):
+            statement.append(token)
+            continue
+        if token == '}':
+            if statement or not keywords:
+                raise YangDepsError("Unbalanced braces")
+            keywords.pop()
+            if not keywords:
+                break
+            continue
+        if not statement:
+            raise YangDepsError("Missing statement keyword")
+        (keyword, argument) = (statement[0], _unquote(statement[1]) if len(statement) > 1 else None)
+        statement = []
+        depth = len(keywords)
+        if depth == 0:
+            if keyword not in ('module', 'submodule'):
+                raise YangDepsError("Not a YANG module")
+            (header.keyword, header.name) = (keyword, argument)
+        elif depth == 1 and in_body:
+            if keyword == 'deviation':
+                deviations.append(argument)
+        elif depth == 1:
+            if keyword == 'import':
+                header.imports.append((argument, None))
+            elif keyword == 'include':
+                header.includes.append((argument, None))
+            elif keyword == 'belongs-to':
+                header.belongs_to = argument
+            elif keyword == 'revision':
+                if header.revision is None or argument > header.revision:
+                    header.revision = argument
+            elif keyword not in _header_keywords and ':' not in keyword:
+                # The body starts, nothing more to learn unless there
+                # are deviations
+                if not _deviation_re.search(text):
+                    break
+                in_body = True
+                if keyword == 'deviation':
+                    deviations.append(argument)
+        elif depth == 2 and keyword == 'revision-date' and keywords[1] in ('import', 'include'):
+            linkage = header.imports if keywords[1] == 'import' else header.includes
+            linkage[-1] = (linkage[-1][0], argument)
+        elif depth == 2 and keyword == 'prefix' and keywords[1] == 'import':
+            prefixes[argument] = header.imports[-1][0]
+        if token == '{':
+            keywords.append(keyword)
+    if header.name is None:
+        raise YangDepsError("Not a YANG module")
+    # The target of a deviation is a schema node id such as
+    # /if:interfaces/if:interface, a node of the modules of its prefixes
+    deviates = set()
+    for target in deviations:
+        for prefix in re.findall(r'([^/:\s]+):', target or ""):
+            if prefix in prefixes:
+                deviates.add(prefixes[prefix])
+    header.deviates = sorted(deviates)
+    return header
+
+
+def scan_file(filename):
+    with open(filename, "rb") as f:
+        text = f.read()
+    if not isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return parse_header(text, filename)
+
+
+def module_file_name(filename):
+    # The module name of <name>.yang or <name>@<revision>.yang
+    return os.path.basename(filename)[:-len(".yang")].split('@')[0]
+
+
+class DependencyGraph(object):
+    """The modules and submodules of a set of YANG files and what they
+    depend on. errors maps the files that could not be read to why."""
+
+    def __init__(self, headers, errors=None):
+        self.modules = dict((header.name, header) for header in headers)
+        self.errors = errors or {}
+        self._dependents = {}
+        for header in headers:
+            for name in header.dependencies():
+                self._dependents.setdefault(name, set()).add(header.name)
+
+    def dependencies(self, name):
+        header = self.modules.get(name)
+        return header.dependencies() if header is not None else []
+
+    def dependents(self, name):
+        """Returns the names of the modules depending directly on name."""
+        return sorted(self._dependents.get(name, ()))
+
+    def closure(self, name, reverse=False):
+        """Returns the names of the modules name depends on, directly or
+        not, or with reverse those depending on name."""
+        found = set()
+        todo = [name]
+        while todo:
+            current = todo.pop()
+            for next_name in (self.dependents(current) if reverse
+                              else self.dependencies(current)):
+                if next_name not in found:
+                    found.add(next_name)
+                    todo.append(next_name)
+        found.discard(name)
+        return found
+
+    def missing(self, available=()):
+        """Returns a dict from the name of each module depended on but
+        not in the graph, nor among the available names, to the sorted
+        names of the modules depending on it."""
+        return dict((name, sorted(users)) for (name, users) in self._dependents.items()
+                    if name not in self.modules and name not in available)
+
+    def deviations(self):
+        """Returns a dict from the name of each module of the graph with
+        deviations for other modules to their sorted names."""
+        return dict((name, header.deviates) for (name, header) in self.modules.items()
+                    if header.deviates)
+
+    def revision_mismatches(self):
+        """Returns (module, dependency, revision-date wanted, revision
+        found) for the imports and includes of a revision other than
+        the one in the graph."""
+        mismatches = []
+        for header in self.modules.values():
+            for (name, revision) in header.imports + header.includes:
+                found = self.modules.get(name)
+                if revision is not None and found is not None and found.revision != revision:
+                    mismatches.append((header.name, name, revision, found.revision))
+        return sorted(mismatches)
+
+
+def scan_directory(directory, names=None):
+    """Returns the DependencyGraph of the .yang files in directory, or
+    only of those of the given module names."""
+    headers = []
+    errors = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".yang"):
+            continue
+        if names is not None and module_file_name(filename) not in names:
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            headers.append(scan_file(path))
+        except (YangDepsError, IOError, OSError) as e:
+            errors[path] = str(e)
+    return DependencyGraph(headers, errors)
+
+
+def pyang_search_path(pyang=None):
+    """The directories pyang looks for modules in when they are not in
+    its --path, in its order: those of YANG_MODPATH, ~/yang/modules,
+    and $YANG_INSTALL/yang/modules, or else the share/yang/modules
+    directory where pyang installs its bundled modules, such as
+    ietf-inet-types. That one is looked for under the installation
+    prefix of pyang, the executable being pyang, and of this Python."""
+    directories = [d for d in os.environ.get('YANG_MODPATH', '').split(os.pathsep) if d]
+    if os.environ.get('HOME'):
+        directories.append(os.path.join(os.environ['HOME'], 'yang', 'modules'))
+    if os.environ.get('YANG_INSTALL'):
+        directories.append(os.path.join(os.environ['YANG_INSTALL'], 'yang', 'modules'))
+    else:
+        prefixes = [sys.prefix]
+        if pyang:
+            prefixes.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(pyang))))
+        directories += [os.path.join(prefix, 'share', 'yang', 'modules') for prefix in prefixes]
+    return [d for d in directories if os.path.isdir(d)]
+
+
+def modules_in(directories):
+    """Returns the set of names of the modules in directories and their
+    subdirectories, which pyang searches too."""
+    names = set()
+    for directory in directories:
+        for (dirpath, dirnames, filenames) in os.walk(directory):
+            names.update(module_file_name(f) for f in filenames if f.endswith(".yang"))
+    return names
@@ -0,0 +1,187 @@
+# -*- mode: python; python-indent: 4 -*-
+"""Manifest of the modules in a YANG directory.
+
+Whether a module is enabled, disabled or marked for download is still
+told by its file name, <module>.yang, .yang.no or .yang.yes, since
+the NED build and users go by the files. The manifest,
+pioneer-manifest.json in the directory, keeps for each module its
+status, revision, file size and time, content hash, where it came
+from, what it imports, includes and belongs to, and the modules it has
+deviations for. It is reconciled with the files in one listing of the
+directory, reading only the files that changed, so that the yang
+operations find and match modules without listing or reading the
+directory again."""
+
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import sys
+
+import pioneer.op.yang_deps as yang_deps
+
+MANIFEST_NAME = "pioneer-manifest.json"
+# The modules of a manifest of another version are read again
+MANIFEST_VERSION = 2
+
+SUFFIXES = [('enabled', ".yang"),
+            ('disabled', ".yang.no"),
+            ('marked', ".yang.yes")]
+
+def _native(value):
+    # json gives unicode strings, Python 2 callers want str
+    if sys.hexversion >= 0x03000000:
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_native(k), _native(v)) for (k, v) in value.items())
+    return value
+
+
+class YangManifest(object):
+    def __init__(self, directory, debug=None):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.debug = debug or (lambda msg: None)
+        self.modules = {}
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.modules = _native(manifest['modules'])
+            if manifest['version'] != MANIFEST_VERSION:
+                for entry in self.modules.values():
+                    entry['mtime'] = None
+                self.dirty = True
+        except (IOError, OSError, ValueError, KeyError):
+            self.dirty = True
+
+    def file_name(self, name, status=None):
+        suffix = dict(SUFFIXES)[status or self.modules[name]['status']]
+        return os.path.join(self.directory, name + suffix)
+
+    def reconcile(self):
+        """Brings the manifest up to date with the files."""
+        found = {}
+        for filename in os.listdir(self.directory):
+            for (status, suffix) in SUFFIXES:
+                if filename.endswith(suffix):
+                    found[filename[:-len(suffix)]] = status
+                    break
+        for name in list(self.modules):
+            if name not in found:
+                del self.modules[name]
+                self.dirty = True
+        for (name, status) in found.items():
+            self._refresh(name, status)
+
+    def _refresh(self, name, status, source=None):
+        # Reads the file of the module again if it has changed
+        path = self.file_name(name, status)
+        st = os.stat(path)
+        entry = self.modules.get(name)
+        if entry is not None and source is None and (entry['status'], entry['size'], entry['mtime']) \
+           == (status, st.st_size, st.st_mtime):
+            return entry
+        if entry is None:
+            entry = {'source': None}
+        entry.update({'status': status, 'size': st.st_size, 'mtime': st.st_mtime,
+                      'hash': None, 'revision': None, 'imports': [], 'includes': [],
+                      'belongs-to': None, 'deviates': [], 'error': None})
+        if source is not None:
+            entry['source'] = source
+        if st.st_size:
+            with open(path, "rb") as f:
+                data = f.read()
+            entry['hash'] = hashlib.sha256(data).hexdigest()
+            try:
+                header = yang_deps.parse_header(data if isinstance(data, str)
+                                                else data.decode('utf-8', 'replace'), path)
+                entry['revision'] = header.revision
+                entry['imports'] = [list(i) for i in header.imports]
+                entry['includes'] = [list(i) for i in header.includes]
+                entry['belongs-to'] = header.belongs_to
+                entry['deviates'] = header.deviates
+            except yang_deps.YangDepsError as e:
+                self.debug("Could not read the header of {0}: {1}".format(path, e))
+                entry['error'] = str(e)
+        self.modules[name] = entry
+        self.dirty = True
+        return entry
+
+    def update(self, name, source=None):
+        """Records the current file of module name, written from source."""
+        for (status, suffix) in SUFFIXES:
+            if os.path.exists(os.path.join(self.directory, name + suffix)):
+                return self._refresh(name, status, source)
+        if name in self.modules:
+            del self.modules[name]
+            self.dirty = True
+        return None
+
+    def names(self, status):
+        return sorted(name for (name, entry) in self.modules.items() if entry['status'] == status)
+
+    def match(self, patterns, statuses):
+        """Returns the sorted names of the modules with one of the
+        statuses matching any of the fnmatch patterns."""
+        literal = [p for p in patterns if p and not re.search(r'[*?\[]', p)]
+        names = set(name for name in literal
+                    if name in self.modules and self.modules[name]['status'] in statuses)
+        wildcards = [fnmatch.translate(p) for p in patterns if p and p not in literal]
+        if wildcards:
+            regex = re.compile("|".join("(?:" + w + ")" for w in wildcards))
+            names.update(name for (name, entry) in self.modules.items()
+                         if entry['status'] in statuses and regex.match(name))
+        return sorted(names)
+
+    def set_status(self, name, status):
+        """Renames the file of module name for the new status."""
+        os.rename(self.file_name(name), self.file_name(name, status))
+        # The content and modification time stay the same
+        self.modules[name]['status'] = status
+        self.dirty = True
+        return self.modules[name]
+
+    def remove(self, name):
+        """Removes the files of module name."""
+        for (status, suffix) in SUFFIXES + [(None, ".yang.part")]:
+            path = os.path.join(self.directory, name + suffix)
+            if os.path.exists(path):
+                self.debug("Deleting " + path)
+                os.remove(path)
+        if self.modules.pop(name, None) is not None:
+            self.dirty = True
+
+    def dependency_graph(self, status='enabled'):
+        """The yang_deps.DependencyGraph of the modules with status."""
+        headers = []
+        for name in self.names(status):
+            entry = self.modules[name]
+            header = yang_deps.ModuleHeader(self.file_name(name))
+            header.name = name
+            header.revision = entry['revision']
+            header.imports = [tuple(i) for i in entry['imports']]
+            header.includes = [tuple(i) for i in entry['includes']]
+            header.belongs_to = entry['belongs-to']
+            header.deviates = entry['deviates']
+            headers.append(header)
+        return yang_deps.DependencyGraph(headers)
+
+    def save(self):
+        if not self.dirty:
+            return
+        # A line per module, without indent, which makes json use its
+        # much faster C encoder
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write('{"version": %d, "modules": {' % MANIFEST_VERSION)
+            f.write(','.join("\n " + json.dumps(name) + ": " + json.dumps(entry, sort_keys=True)
+                             for (name, entry) in sorted(self.modules.items())))
+            f.write('\n}}\n')
+        os.rename(tmp_path, self.path)
+        self.dirty = False
@@ -1,18 +1,32 @@
 # -*- mode: python; python-indent: 4 -*-
 
+import collections
 import fnmatch
 import os
 import re
 import shutil
 import socket
+import threading
 import time
 import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import _ncs
 import _ncs.maapi as maapi
 
+import pioneer.op.ned_build as ned_build
 import pioneer.op.netconf_op as netconf_op
+import pioneer.op.netconf_session as netconf_session
+import pioneer.op.xml_extract as xml_extract
+import pioneer.op.yang_cache as yang_cache
+import pioneer.op.yang_deps as yang_deps
+import pioneer.op.yang_manifest as yang_manifest
 import pioneer.namespaces.pioneer_ns as ns
+import pioneer.netconf_console as netconf_console
 
 from pioneer.op.ex import ActionError
 
@@ -21,6 +35,8 @@ class YangOp(netconf_op.NetconfOp):
     def _init_params(self, params):
         netconf_op.NetconfOp._init_params(self, params)
         self.yang_directory = self.param_default(params, ns.ns.pioneer_yang_directory, os.path.join("/tmp/download", self.dev_name))
+        self._manifest = None
+        self._yang_cache = None
 
     def create_yang_dir(self):
         try:
@@ -30,13 +46,39 @@ class YangOp(netconf_op.NetconfOp):
         if not os.path.exists(self.yang_directory):
             raise ActionError({'error': 'Failed to create directory {0}'.format(self.yang_directory)})
 
+    def manifest(self):
+        # The manifest of yang_directory, brought up to date with the
+        # files once per operation
+        if self._manifest is None:
+            self._manifest = yang_manifest.YangManifest(self.yang_directory, self.debug)
+            self._manifest.reconcile()
+        return self._manifest
+
+    def yang_cache(self):
+        if self._yang_cache is None:
+            self._yang_cache = yang_cache.YangCache(self.yang_cache_dir, self.debug)
+        return self._yang_cache
+
+    def cache_module(self, modname, revision=None):
+        # Adds the enabled module modname to the cache, if it is of the
+        # revision expected
+        entry = self.manifest().modules.get(modname)
+        if entry is None or entry['status'] != 'enabled' or entry['revision'] is None:
+            return
+        if revision is not None and entry['revision'] != revision:
+            self.debug("Not caching {0}, revision {1} instead of {2}".format(
+                modname, entry['revision'], revision))
+            return
+        try:
+            # Files named <module>@<revision>.yang are cached as <module>
+            self.yang_cache().add(modname.partition('@')[0], entry['revision'],
+                                  self.manifest().file_name(modname), entry['hash'])
+        except (IOError, OSError) as e:
+            self.debug("Failed to add {0} to the YANG cache: {1}".format(modname, e))
+
     def list_models_in_dir(self, cat='enabled'):
-        if(cat == 'marked'):
-            return [f[:-9] for f in os.listdir(self.yang_directory) if fnmatch.fnmatch(f, '*.yang.yes')]
-        if(cat == 'disabled'):
-            return [f[:-8] for f in os.listdir(self.yang_directory) if fnmatch.fnmatch(f, '*.yang.no')]
-        if(cat == 'enabled'):
-            return [f[:-5] for f in os.listdir(self.yang_directory) if fnmatch.fnmatch(f, '*.yang')]
+        if cat in ('enabled', 'disabled', 'marked'):
+            return self.manifest().names(cat)
         if(cat == 'builtin'):
             return [f[:-5] for f in os.listdir(self.ncs_dir + "/src/ncs/yang") if fnmatch.fnmatch(f, '*.yang')]
         return []
@@ -58,14 +100,114 @@ class YangOp(netconf_op.NetconfOp):
         yang_file_name = self.yang_directory + "/" + modname + ".yang.yes"
         with open(yang_file_name, "w") as m:
             m.write("")
+        self.manifest().update(modname)
+
+    def has_module(self, modname):
+        # Whether modname is downloaded, enabled or not
+        entry = self.manifest().modules.get(modname)
+        return entry is not None and entry['status'] in ('enabled', 'disabled')
+
+class ModuleFileSink(object):
+    """Receives a get-schema reply chunk by chunk and writes the module
+    text to <module>.yang.part in yang_directory as it is parsed, so
+    that memory use does not depend on the module size. modules maps
+    message-id to (seq, file_no, modname)."""
+
+    def __init__(self, yang_directory, modules, debug):
+        self.yang_directory = yang_directory
+        self.modules = modules
+        self.debug = debug
+        self.extractor = xml_extract.ModuleExtractor(self.write)
+        self.modname = None
+        self.f = None
+        self.size = 0
+        self.error = None
+
+    @property
+    def message_id(self):
+        return self.extractor.message_id
+
+    def feed(self, chunk):
+        if self.error is None:
+            try:
+                self.extractor.feed(chunk)
+            except (xml_extract.ExtractError, IOError, OSError) as e:
+                self.error = e
+
+    def part_file_name(self):
+        return os.path.join(self.yang_directory, self.modname + ".yang.part")
+
+    def open(self):
+        if self.modname is None:
+            module = self.modules.get(self.message_id)
+            if module is None:
+                # not ours, the session will be torn down
+                return False
+            self.modname = module[2]
+            self.f = open(self.part_file_name(), "wb")
+        return True
+
+    def write(self, text):
+        if self.open():
+            text = text.encode('utf-8')
+            self.f.write(text)
+            self.size += len(text)
+
+    def close(self):
+        # Returns (success, progress note, result line)
+        modname = self.modules[self.message_id][2]
+        rpc_error = False
+        if self.error is None:
+            try:
+                rpc_error = self.extractor.close()
+                # an empty module still gets its file
+                self.open()
+            except (xml_extract.ExtractError, IOError, OSError) as e:
+                self.error = e
+        yang_file_name = os.path.join(self.yang_directory, modname + ".yang")
+        try:
+            if self.f is not None:
+                self.f.close()
+            if isinstance(self.error, xml_extract.ExtractError):
+                return (False, "parsing failed", "Failed {0} parse error '{1}'".format(modname, self.error))
+            if self.error is not None:
+                return (False, "writing file failed", "Failed {0} write error".format(modname))
+            if rpc_error:
+                return (False, "failed, not found", "Failed {0} rpc error".format(modname))
+            self.debug("Saved module {0}, {1} bytes".format(modname, self.size))
+            os.rename(self.part_file_name(), yang_file_name)
+            self.f = None
+            if os.path.exists(yang_file_name + ".yes"):
+                os.remove(yang_file_name + ".yes")
+        except (IOError, OSError):
+            return (False, "writing file failed", "Failed {0} write error".format(modname))
+        finally:
+            self.discard()
+        return (True, "succeeded", "Downloaded {0}".format(modname))
+
+    def discard(self):
+        # remove what was written, if the module was not saved
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            try:
+                os.remove(self.part_file_name())
+            except OSError:
+                pass
+
 
 class DownloadOp(YangOp):
     tag = ns.ns.pioneer_download
+    # Times to wait for a busy session before giving up on the modules
+    busy_retries = 3
 
     def _init_params(self, params):
         YangOp._init_params(self, params)
         self.name = self.param_default(params, ns.ns.pioneer_include_names, '')
         self.file = self.param_default(params, ns.ns.pioneer_include_names_in_file, '')
+        self.pipeline_window = int(self.param_default(params, ns.ns.pioneer_pipeline_window, 1))
+        self.parallel_sessions = int(self.param_default(params, ns.ns.pioneer_parallel_sessions, 1))
+        self.use_cache = self.param_default(params, ns.ns.pioneer_use_cache, "true") == "true"
 
     def perform(self):
         self.debug("yang_download() with device {0}".format(self.dev_name))
@@ -80,64 +222,240 @@ class DownloadOp(YangOp):
             return {'yang-directory':self.yang_directory,
                     'error':"No files marked for download; did you forget to run fetch-list?"}
         self.progress_msg("Downloading {0} modules to {1}\n".format(files_tot,self.yang_directory))
-        downloaded_count = 0
-        failed_count = 0
-        skipped_count = 0
+        self.downloaded_count = 0
+        self.failed_count = 0
+        self.skipped_count = 0
+        self.cached_count = 0
+        self.result_str = ""
+        self.revisions = {}
+        if self.use_cache and [modname for modname in model_list if not self.has_module(modname)]:
+            try:
+                self.extend_timeout(180) # Max 180 seconds for hello, ok?
+                self.revisions = self.module_revisions_from_hello(
+                    self.extract_capas_from_hello(self.nc_perform('hello')))
+            except ActionError as e:
+                self.debug("No module revisions from hello, not using the YANG cache: " + str(e))
+        modules = collections.deque()
         file_no = 0
-        result_str = ""
         for modname in model_list:
             file_no += 1
-            yang_file_name = self.yang_directory + "/" + modname + ".yang"
-            self.debug("FQFN " + yang_file_name)
-            if os.path.exists(yang_file_name) or os.path.exists(yang_file_name + ".no"):
-                skipped_count += 1
+            if self.has_module(modname):
+                self.skipped_count += 1
                 self.debug("Module already downloaded, skipping " + modname)
                 self.progress_msg("Skipping module " + modname + " -- already downloaded\n")
                 continue
-            self.debug("Downloading module " + modname)
-            self.progress_msg("{0}/{1} Downloading module {2} ".
-                              format(file_no, files_tot, modname))
-            self.extend_timeout(180) # Max 180 seconds per file, ok?
+            if self.link_from_cache(modname):
+                self.report_module(None, file_no, files_tot, modname, True, "succeeded from cache",
+                                   "Downloaded {0} from cache".format(modname))
+                continue
+            modules.append((len(modules), file_no, modname))
+
+        num_sessions = min(self.parallel_sessions, len(modules))
+        if num_sessions > 1:
+            max_sessions = self.get_session_pool_settings()[1]
+            if num_sessions > max_sessions:
+                self.progress_msg("Limiting download to {0} sessions, see pioneer session-pool "
+                                  "max-sessions-per-device\n".format(max_sessions))
+                num_sessions = max_sessions
+        if num_sessions > 1:
+            self.download_parallel(modules, files_tot, num_sessions)
+        else:
+            busy = 0
+            while modules:
+                if self.download_session(modules, files_tot, self.report_module):
+                    busy = 0
+                    continue
+                busy += 1
+                if busy == self.busy_retries:
+                    self.fail_remaining(modules, files_tot, self.report_module)
+
+        self.debug("Model download done")
+        self.manifest().save()
+        message = "Downloaded {0} modules, failed {1}, skipped {2}, {3} from cache:\n{4}".format(
+            self.downloaded_count, self.failed_count, self.skipped_count, self.cached_count,
+            self.result_str)
+        return {'yang-directory':self.yang_directory, 'message':message}
+
+    def link_from_cache(self, modname):
+        # Links modname from the cache if the device advertises a
+        # revision of it that is there
+        revision = self.revisions.get(modname)
+        if revision is None:
+            return False
+        yang_file_name = os.path.join(self.yang_directory, modname + ".yang")
+        try:
+            if not self.yang_cache().link(modname, revision, yang_file_name):
+                return False
+        except (IOError, OSError) as e:
+            self.debug("Failed to link {0} from the YANG cache: {1}".format(modname, e))
+            return False
+        if os.path.exists(yang_file_name + ".yes"):
+            os.remove(yang_file_name + ".yes")
+        self.cached_count += 1
+        return True
+
+    def fail_remaining(self, modules, files_tot, report):
+        # No session could be had for the modules left
+        while modules:
+            try:
+                (seq, file_no, modname) = modules.popleft()
+            except IndexError:
+                return
+            report(seq, file_no, files_tot, modname, False, "download failed",
+                   "Failed {0} fetch error 'all NETCONF sessions busy'".format(modname))
+
+    def download_parallel(self, modules, files_tot, num_sessions):
+        # Each worker thread downloads from the shared modules deque
+        # over its own NETCONF session. Only this thread talks to NSO:
+        # it reads the session settings, reports the results in module
+        # order and extends the action timeout as long as any worker
+        # makes progress.
+        results = queue.Queue()
+        activity = [time.time()]
+        settings = self.nc_session_settings()
+        lock = threading.Lock()
+        active = [num_sessions]
+
+        def touch():
+            activity[0] = time.time()
+
+        def worker():
+            report = lambda *result: results.put(('result', result))
+            busy = 0
             try:
-                xml_module = self.nc_perform('get-schema', method_opts=[str(modname)])
+                while modules:
+                    if self.download_session(modules, files_tot, report, touch, settings):
+                        busy = 0
+                        continue
+                    # All sessions are busy; the modules are left to
+                    # the other workers, the last one tries again
+                    touch()
+                    busy += 1
+                    with lock:
+                        last = active[0] == 1
+                        if not last:
+                            active[0] -= 1
+                    if not last:
+                        return
+                    if busy == self.busy_retries:
+                        self.fail_remaining(modules, files_tot, report)
             except Exception as e:
-                self.progress_msg("-- download failed\n")
                 self.debug(traceback.format_exc())
-                result_str += "Failed {0} fetch error '{1}'\n".format(modname, repr(e))
-                failed_count += 1
-            else:
-                self.extend_timeout(90) # Max 90 seconds per file, ok?
-                (yang_module, stderr) = self.proc_run([self.get_exe_path("xsltproc"),
-                                                       "--nonet", "--novalid",
-                                                       self.pkg_root_dir + "/load-dir/ncs-extract-module.xsl",
-                                                       "-"],
-                                                      xml_module)
-                self.debug("Parsed module:\n" + yang_module + "\n" + stderr)
-                if yang_module == "ERROR":
-                    self.progress_msg(" -- failed, not found\n")
-                    result_str += "Failed {0} rpc error\n".format(modname)
-                    failed_count += 1
-                elif stderr != "":
-                    self.progress_msg(" -- parsing failed\n")
-                    result_str += "Failed {0} parse error '{1}'\n".format(modname, stderr)
-                    failed_count += 1
-                else:
-                    try:
-                        with open(yang_file_name, "w") as m:
-                            m.write(yang_module)
-                        self.progress_msg(" -- succeeded\n")
-                        result_str += "Downloaded {0}\n".format(modname)
-                        downloaded_count += 1
-                        if os.path.exists(yang_file_name + ".yes"):
-                            os.remove(yang_file_name + ".yes")
-                    except:
-                        self.progress_msg(" -- writing file failed\n")
-                        result_str += "Failed {0} write error\n".format(modname)
-                        failed_count += 1
-        self.debug("Model download done")
-        message = "Downloaded {0} modules, failed {1}, skipped {2}:\n{3}".format(
-            downloaded_count, failed_count, skipped_count, result_str)
-        return {'yang-directory':self.yang_directory, 'message':message}
+                results.put(('error', e))
+            finally:
+                results.put(('done', None))
+
+        self.progress_msg("Using {0} parallel NETCONF sessions\n".format(num_sessions))
+        self.extend_timeout(180) # Max 180 seconds per file, ok?
+        threads = [threading.Thread(target=worker) for i in range(num_sessions)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        running = len(threads)
+        error = None
+        next_seq = 0
+        held = {}
+        last_activity = activity[0]
+        while running:
+            try:
+                (kind, value) = results.get(timeout=5)
+            except queue.Empty:
+                (kind, value) = (None, None)
+            if kind is not None or activity[0] != last_activity:
+                last_activity = activity[0]
+                self.extend_timeout(180) # Max 180 seconds per file, ok?
+            if kind == 'done':
+                running -= 1
+            elif kind == 'error':
+                error = error or value
+                modules.clear()
+            elif kind == 'result':
+                held[value[0]] = value
+            while next_seq in held:
+                self.report_module(*held.pop(next_seq))
+                next_seq += 1
+        for seq in sorted(held.keys()):
+            self.report_module(*held.pop(seq))
+        for thread in threads:
+            thread.join()
+        if error is not None:
+            raise error
+
+    def download_session(self, modules, files_tot, report, extend_timeout=None, settings=None):
+        # Download modules from the modules deque over one NETCONF
+        # session, with up to pipeline_window get-schema requests
+        # outstanding. Returns when the deque is empty or the session
+        # failed, False if no session could be had as all were busy.
+        outstanding = {}
+
+        def requests(session):
+            while True:
+                try:
+                    (seq, file_no, modname) = modules.popleft()
+                except IndexError:
+                    return
+                message_id = session.next_message_id()
+                outstanding[message_id] = (seq, file_no, modname)
+                self.debug("Requesting module {0} message-id {1}".format(modname, message_id))
+                yield (message_id, netconf_console.get_schema_msg(modname, message_id))
+
+        if extend_timeout is None:
+            self.extend_timeout(180) # Max 180 seconds per file, ok?
+        sinks = []
+
+        def make_sink():
+            sink = ModuleFileSink(self.yang_directory, outstanding, self.debug)
+            sinks[:] = [sink]
+            return sink
+
+        saving = None
+        try:
+            with self.nc_session(180, extend_timeout, settings) as session:
+                for (message_id, sink) in session.pipeline_to(requests(session),
+                                                              self.pipeline_window, make_sink):
+                    saving = outstanding[message_id]
+                    (seq, file_no, modname) = saving
+                    result = sink.close()
+                    del outstanding[message_id]
+                    report(seq, file_no, files_tot, modname, *result)
+                    saving = None
+        except netconf_session.SessionsBusyError as e:
+            # Nothing was requested, the modules stay in the deque
+            self.debug("Download session not started: " + str(e.get_info()))
+            return False
+        except Exception as e:
+            if saving is not None:
+                # Not a download problem, e.g. a bug in ModuleFileSink.close()
+                raise
+            self.debug(traceback.format_exc())
+            for sink in sinks:
+                sink.discard()
+            if not outstanding:
+                # Failed before any request went out
+                try:
+                    outstanding[None] = modules.popleft()
+                except IndexError:
+                    pass
+            for (seq, file_no, modname) in sorted(outstanding.values()):
+                report(seq, file_no, files_tot, modname, False, "download failed",
+                       "Failed {0} fetch error '{1}'".format(modname, repr(e)))
+        return True
+
+    def report_module(self, seq, file_no, files_tot, modname, success, note, result_line):
+        self.progress_msg("{0}/{1} Downloading module {2} -- {3}\n".
+                          format(file_no, files_tot, modname, note))
+        self.result_str += result_line + "\n"
+        if seq is None:
+            self.manifest().update(modname, 'cache')
+        else:
+            self.manifest().update(modname, 'get-schema' if success else None)
+            if success and modname in self.revisions:
+                self.cache_module(modname, self.revisions[modname])
+        if success:
+            self.downloaded_count += 1
+        else:
+            self.failed_count += 1
 
 class DisableOp(YangOp):
     def _init_params(self, params):
@@ -148,21 +466,22 @@ class DisableOp(YangOp):
         self.debug("yang_disable() with device {0}".format(self.dev_name))
         if not os.path.exists(self.yang_directory):
             return {'error':"Failed to find source directory " + self.yang_directory}
-        yangs = self.list_models_in_dir()
-        yangs.extend(self.list_models_in_dir('marked'))
-        builtin_yangs = self.list_models_in_dir('builtin')
+        manifest = self.manifest()
+        if self.name_pattern == ['']:
+            # Without a pattern, the modules NSO comes with
+            builtin_yangs = set(self.list_models_in_dir('builtin'))
+            yangs = [yang for yang in manifest.names('enabled') + manifest.names('marked')
+                     if yang in builtin_yangs]
+        else:
+            self.debug("Check disable name-pattern="+str(self.name_pattern))
+            yangs = manifest.match(self.name_pattern, ('enabled', 'marked'))
         message = ""
         for yang in yangs:
-            self.debug("Check disable "+ yang + " name-pattern="+str(self.name_pattern))
-            if [sp for sp in self.name_pattern if fnmatch.fnmatch(yang, sp)] or (self.name_pattern == [''] and yang in builtin_yangs):
-                self.debug("Disabling "+ yang)
-                message += "Disabling module {0}\n".format(yang)
-                # Renaming file to .yang.no
-                enabled_fq_yang = os.path.join(self.yang_directory, '{0}.yang'.format(yang))
-                disabled_fq_yang = '{0}.no'.format(enabled_fq_yang)
-                if not os.path.exists(enabled_fq_yang):
-                    enabled_fq_yang += ".yes"
-                os.rename(enabled_fq_yang, disabled_fq_yang)
+            self.debug("Disabling "+ yang)
+            message += "Disabling module {0}\n".format(yang)
+            # Renaming file to .yang.no
+            manifest.set_status(yang, 'disabled')
+        manifest.save()
         if "" == message:
             return {'error':"No modules matching pattern"}
         else:
@@ -177,20 +496,19 @@ class EnableOp(YangOp):
         self.debug("yang_enable() with device {0}".format(self.dev_name))
         if not os.path.exists(self.yang_directory):
             return {'error':"Failed to find source directory " + self.yang_directory}
-        disabled_yangs = self.list_models_in_dir('disabled')
+        manifest = self.manifest()
         message = ""
-        for yang in disabled_yangs:
-            if [sp for sp in self.name_pattern if fnmatch.fnmatch(yang, sp)]:
-                self.debug("Enabling "+ yang)
-                message += "Enabling module {0}\n".format(yang)
-                enabled_fq_yang = os.path.join(self.yang_directory, '{0}.yang'.format(yang))
-                disabled_fq_yang = '{0}.no'.format(enabled_fq_yang)
-                # 0 bytes disabled file is treated as a result from
-                # fetch-list to avoid re-downloading modules everytime
-                # download is called
-                if os.path.getsize(disabled_fq_yang) == 0:
-                    enabled_fq_yang += '.yes'
-                os.rename(disabled_fq_yang, enabled_fq_yang)
+        for yang in manifest.match(self.name_pattern, ('disabled',)):
+            self.debug("Enabling "+ yang)
+            message += "Enabling module {0}\n".format(yang)
+            # 0 bytes disabled file is treated as a result from
+            # fetch-list to avoid re-downloading modules everytime
+            # download is called
+            if manifest.modules[yang]['size'] == 0:
+                manifest.set_status(yang, 'marked')
+            else:
+                manifest.set_status(yang, 'enabled')
+        manifest.save()
         return {'success':message}
 
 class FetchListOp(YangOp):
@@ -229,9 +547,7 @@ netconf-monitoring xpath: {3}
         marked_count = 0
         skipped_count = 0
         for modname in mods:
-            yang_file_name = self.yang_directory + "/" + modname + ".yang"
-            self.debug("FQFN " + yang_file_name)
-            if os.path.exists(yang_file_name) or os.path.exists(yang_file_name + ".no"):
+            if self.has_module(modname):
                 skipped_count += 1
                 self.debug("Module already downloaded or disabled, skipping " + modname)
                 self.progress_msg("Skipping module " + modname + " -- already downloaded/disabled\n")
@@ -240,6 +556,7 @@ netconf-monitoring xpath: {3}
             self.make_yang_mark_file(modname)
             marked_count += 1
         self.debug("Model list fetch done")
+        self.manifest().save()
         message = "Marked {0} modules for download, skipped {1}".format(
             marked_count, skipped_count)
 
@@ -269,41 +586,32 @@ class CheckDependenciesOp(YangOp):
         self.debug("yang_check_dependencies() with device {0}".format(self.dev_name))
         enabled_yangs = self.list_models_in_dir()
         disabled_yangs = self.list_models_in_dir('disabled')
-        missing_files = {}
-        items = len(enabled_yangs)
-        item = 0
+        manifest = self.manifest()
+        graph = manifest.dependency_graph()
         for yang in enabled_yangs:
-            item += 1
-            self.progress_msg("{0}/{1} checking {2}: ".format(item, items, yang))
-            self.extend_timeout(180) # Max 3 mins per file, ok?
-            #'pyang' must be in PATH before using pioneer
-            (depend_txt, stderr) = self.proc_run(["pyang",
-                              "-f", "depend",
-                              "--path", self.yang_directory,
-                              self.yang_directory + "/" + yang + ".yang"])
-            compiler_output = depend_txt + "\n" + stderr
-            self.debug("dependencies:\n" + compiler_output)
-            for line in compiler_output.split("\n"):
-                self.debug("line " + str(line) + "\n")
-                err_msg_parts = line.split("error: ")
-
-                self.debug("err_msg_parts " + str(err_msg_parts) + "\n")
-                if len(err_msg_parts) == 2:
-                    module_msg_parts = err_msg_parts[1].split('"')
-                    if module_msg_parts[0] == "module " and module_msg_parts[2] == " not found in search path":
-                        missing_modname = module_msg_parts[1]
-                        missing_files[missing_modname] = 1
-                        if missing_modname not in disabled_yangs:
-                            self.progress_msg(missing_modname + " ")
-                            self.make_yang_mark_file(missing_modname)
-                        else:
-                            self.progress_msg("(" + missing_modname + ") ")
-
-            self.progress_msg("\n")
+            if manifest.modules[yang]['error']:
+                self.progress_msg("Could not read {0}: {1}\n".format(
+                    manifest.file_name(yang), manifest.modules[yang]['error']))
+        for (modname, dependency, wanted, found) in graph.revision_mismatches():
+            self.progress_msg("{0} wants revision {1} of {2}, found {3}\n".format(
+                modname, wanted, dependency, found))
+        # Modules pyang would find outside the YANG directory, such as
+        # those bundled with it
+        search_path = yang_deps.pyang_search_path(self.get_exe_path_from_PATH("pyang"))
+        self.debug("Module search path: " + os.pathsep.join(search_path))
+        available = yang_deps.modules_in(search_path)
+        missing_files = graph.missing(available)
+        for (missing_modname, users) in sorted(missing_files.items()):
+            if missing_modname not in disabled_yangs:
+                self.progress_msg("{0} needed by {1}\n".format(missing_modname, " ".join(users)))
+                self.make_yang_mark_file(missing_modname)
+            else:
+                self.progress_msg("({0}) needed by {1}\n".format(missing_modname, " ".join(users)))
+        manifest.save()
         if len(missing_files) == 0:
             return {'success':"The set of {0} enabled yang files seems consistent".
                     format(len(enabled_yangs))}
-        return {'missing':" ".join(missing_files.keys()),
+        return {'missing':" ".join(sorted(missing_files.keys())),
                 'failure':"The set of {0} enabled yang files are missing {1} files".
                     format(len(enabled_yangs), len(missing_files))}
 
@@ -316,17 +624,13 @@ class DeleteOp(YangOp):
         self.debug("yang_delete() with device {0}".format(self.dev_name))
         if not os.path.exists(self.yang_directory):
             return {'error':"Failed to find source directory " + self.yang_directory}
-        enabled_yangs = self.list_models_in_dir()
-        disabled_yangs = self.list_models_in_dir('disabled')
-        marked_yangs = self.list_models_in_dir('marked')
+        manifest = self.manifest()
         message = ""
-        for yang in enabled_yangs + disabled_yangs + marked_yangs:
-            if [sp for sp in self.name_pattern.split(' ') if fnmatch.fnmatch(yang, sp)]:
-                self.debug("Deleting "+ yang + " name-pattern="+str(self.name_pattern))
-                message += "Deleting module {0}\n".format(yang)
-                for f in [self.yang_directory + "/" + f for f in os.listdir(self.yang_directory) if fnmatch.fnmatch(f, yang + ".yang*")]:
-                    self.debug("Deleting "+ f)
-                    os.remove(f)
+        for yang in manifest.match(self.name_pattern.split(' '), ('enabled', 'disabled', 'marked')):
+            self.debug("Deleting "+ yang + " name-pattern="+str(self.name_pattern))
+            message += "Deleting module {0}\n".format(yang)
+            manifest.remove(yang)
+        manifest.save()
         return {'success':message}
 
 class BuildNetconfNedOp(YangOp):
@@ -335,6 +639,8 @@ class BuildNetconfNedOp(YangOp):
         self.name = self.param_default(params, ns.ns.pioneer_name, self.dev_name)
         self.ned_directory = self.param_default(params, ns.ns.pioneer_ned_directory, "/tmp/packages/" + self.name)
         self.silence_timeout = int(self.param_default(params, ns.ns.pioneer_silence_timeout, "60"))
+        self.incremental = self.param_default(params, ns.ns.pioneer_incremental, "false") == "true"
+        self.jobs = int(self.param_default(params, ns.ns.pioneer_jobs, "1"))
 
     def perform(self):
         self.debug("yang_build_netconf_ned() with device {0}".format(self.dev_name))
@@ -346,35 +652,168 @@ class BuildNetconfNedOp(YangOp):
             pass
         if not os.path.exists(self.ned_directory):
             return {'error':"Failed to create ned directory " + self.ned_directory}
-        yang_dir = self.ned_directory + "/src/yang"
+        manifest = self.manifest()
+        manifest.save()
+        enabled_yangs  = manifest.names('enabled')
+        hashes = dict((name, manifest.modules[name]['hash']) for name in enabled_yangs)
+        src_dir = self.ned_directory + "/src"
+        (incremental, jobs) = (self.incremental, self.jobs)
+        deviations = manifest.dependency_graph().deviations()
+        if deviations and (incremental or jobs > 1):
+            # ncsc applies deviations when compiling the modules as a
+            # bundle, not one by one
+            self.progress_msg("Deviation modules {0} are applied by a full build on one process only, "
+                              "building all modules\n".format(" ".join(sorted(deviations))))
+            (incremental, jobs) = (False, 1)
+        if incremental:
+            previous = ned_build.read_build_state(src_dir, self.name, self.ncs_dir)
+            if previous is not None:
+                return self.compile_modules(previous, hashes, True)
+            self.progress_msg("No previous build in {0} to update, building all modules\n".format(self.ned_directory))
+        ned_build.remove_build_state(src_dir)
+        yang_dir = src_dir + "/yang"
         if os.path.exists(yang_dir):
             self.progress_msg("Cleaning up existing ned-directory\n")
             [ os.remove(yang_dir + "/" + f) for f in os.listdir(yang_dir) if f.endswith(".yang") ]
-        enabled_yangs  = self.list_models_in_dir()
         num_yangs = len(enabled_yangs)
         self.progress_msg("Starting build of {0} YANG modules, this may take some time\n".format(num_yangs))
         self.extend_timeout(60) # Start with max 60 secs silence, ok?
-        ## FIXME
-        def build_progress_fun(state, stdout):
-            self.progress_msg(stdout)
-            self.extend_timeout(120)
-            return None
-
-        build_output = self.proc_run([self.get_exe_path('bash'),
-                                      self.pkg_root_dir + "/python/pioneer/ncs-make-package-verbose",
-                                      self.yang_directory, self.name, self.ned_directory],
+        command = [self.get_exe_path('bash'),
+                   self.pkg_root_dir + "/python/pioneer/ncs-make-package-verbose",
+                   self.yang_directory, self.name, self.ned_directory]
+        if jobs > 1:
+            # Only make the package, the modules are compiled below
+            command.append("--no-fxs")
+        build_output = self.proc_run(command,
                                      timeout=self.silence_timeout,
-                                     outputfun=build_progress_fun)
+                                     outputfun=self.build_progress_fun)
         self.debug("Output from build\n{0}\n".format(build_output))
 
-        if os.path.exists(self.ned_directory + "/src/ncsc-out/.done"):
+        if jobs > 1 and os.path.exists(src_dir + "/Makefile"):
+            return self.compile_modules({}, hashes, False)
+        if os.path.exists(src_dir + "/ncsc-out/.done"):
+            ned_build.write_build_state(src_dir, self.name, self.ncs_dir, hashes, deviations)
             self.progress_msg("Build complete. Run install-netconf-ned, then run 'packages reload' to use the package")
             return {'ned-directory':self.ned_directory}
         else:
-            stdout_issues = "\n".join([str(line) for line in build_output.split('\n') if re.search(r"(?i)\berror|\bwarning", line)])
-            self.progress_msg("Build failed. Error and warning messages below. See log for complete details\n{0}\n".format(stdout_issues))
+            self.progress_msg("Build failed. Error and warning messages below. See log for complete details\n{0}\n".format(self.build_issues(build_output)))
         return {'failure':'Build failed'}
 
+    ## FIXME
+    def build_progress_fun(self, state, stdout):
+        self.progress_msg(stdout)
+        self.extend_timeout(120)
+        return None
+
+    def build_issues(self, build_output):
+        return "\n".join([str(line) for line in build_output.split('\n') if re.search(r"(?i)\berror|\bwarning", line)])
+
+    def compile_modules(self, previous, hashes, incremental):
+        # Compiles the modules changed since the previous build into a
+        # package made by ncs-make-package, or all of them into a new
+        # package
+        src_dir = self.ned_directory + "/src"
+        yang_dir = src_dir + "/yang"
+        fxs_dir = ned_build.fxs_dir(src_dir)
+        load_dir = self.ned_directory + "/load-dir"
+        graph = self.manifest().dependency_graph()
+        (changed, compile_names, removed) = ned_build.plan(previous, hashes, graph)
+        if incremental:
+            self.progress_msg("Incremental build of {0} YANG modules, {1} changed, {2} removed, compiling {3}\n"
+                              .format(len(hashes), len(changed), len(removed), len(compile_names)))
+            for name in removed:
+                for path in [yang_dir + "/" + name + ".yang",
+                             fxs_dir + "/" + name + ".fxs",
+                             load_dir + "/" + name + ".fxs"]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            for name in changed:
+                # The old copy may be read-only, as the modules in the cache are
+                if os.path.exists(yang_dir + "/" + name + ".yang"):
+                    os.remove(yang_dir + "/" + name + ".yang")
+                shutil.copyfile(self.manifest().file_name(name), yang_dir + "/" + name + ".yang")
+        self.extend_timeout(60)
+        for directory in [fxs_dir, load_dir]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        # Modules that fail to compile are left out of the build state,
+        # to be compiled again by the next build
+        built = dict((name, digest) for (name, digest) in previous.items() if name in hashes)
+        for name in compile_names:
+            built.pop(name, None)
+        done_path = src_dir + "/ncsc-out/.done"
+        if os.path.exists(done_path):
+            os.remove(done_path)
+        for name in compile_names:
+            fxs_path = fxs_dir + "/" + name + ".fxs"
+            if os.path.exists(fxs_path):
+                os.remove(fxs_path)
+
+        def command(name):
+            return [ncsc, "--verbose",
+                    "--ncs-compile-module", yang_dir + "/" + name + ".yang",
+                    "--ncs-device-dir", src_dir + "/ncsc-out",
+                    "--ncs-device-type", "netconf",
+                    "--yangpath", yang_dir]
+
+        # Output comes in chunks from jobs processes at a time, each
+        # line is shown with the name of its module
+        started = []
+        partial = {}
+        def output(name, text):
+            if text is None:
+                started.append(name)
+                self.progress_msg("Compiling module {0} ({1}/{2})\n".format(name, len(started), len(compile_names)))
+            else:
+                lines = (partial.pop(name, "") + text).split("\n")
+                if lines[-1]:
+                    partial[name] = lines[-1]
+                if len(lines) > 1:
+                    self.progress_msg("".join(name + ": " + line + "\n" for line in lines[:-1]))
+            self.extend_timeout(120)
+
+        ncsc = os.path.join(self.ncs_dir, "bin", "ncsc")
+        scheduler = ned_build.CompileScheduler(compile_names, graph, self.jobs)
+        try:
+            results = scheduler.run(command, output, self.silence_timeout,
+                                    lambda name: os.path.exists(fxs_dir + "/" + name + ".fxs"))
+        except OSError:
+            raise ActionError({'error':"Dependent application not found, please install: " + ncsc})
+        if partial:
+            self.progress_msg("".join(name + ": " + line + "\n" for (name, line) in sorted(partial.items())))
+        failed = []
+        issues = []
+        for name in compile_names:
+            (status, build_output) = results[name]
+            if status == 'ok':
+                shutil.copyfile(fxs_dir + "/" + name + ".fxs", load_dir + "/" + name + ".fxs")
+                built[name] = hashes[name]
+                continue
+            failed.append(name)
+            if status == 'skipped':
+                issues.append("{0}: not compiled, depends on {1} which failed".format(name, build_output))
+            elif status == 'timeout':
+                issues.append("{0}: silence timeout, compilation terminated".format(name))
+            else:
+                self.debug("Output from compiling {0}\n{1}\n".format(name, build_output))
+                issues.extend(name + ": " + line for line in self.build_issues(build_output).split("\n") if line)
+        # Submodules are compiled with the modules including them
+        for name in changed:
+            if name not in compile_names and name not in failed:
+                built[name] = hashes[name]
+        ned_build.write_build_state(src_dir, self.name, self.ncs_dir, built)
+
+        if failed:
+            self.progress_msg("Build failed for {0}. Error and warning messages below. See log for complete details\n{1}\n"
+                              .format(" ".join(failed), "\n".join(issues)))
+            return {'failure':'Build failed'}
+        with open(done_path, "w"):
+            pass
+        os.utime(self.ned_directory, None)
+        self.progress_msg("Build complete. Run install-netconf-ned, then run 'packages reload' to use the package")
+        return {'ned-directory':self.ned_directory}
+
 class InstallOpBase(YangOp):
     def _init_params(self, params):
         YangOp._init_params(self, params)
@@ -447,18 +886,40 @@ class SftpOp(YangOp):
                     names = [name for name in sftp.listdir(self.remote_path)
                              if name.endswith('.yang') and match(name)]
                     self.progress_msg("Downloading {0} files using SFTP...\n".format(len(names)))
+                    cached = 0
                     for name in names:
-                        remote_path = '{0}/{1}'.format(self.remote_path, name)
                         local_path = os.path.join(self.yang_directory, name)
-                        sftp.get(remote_path, local_path)
-                    message = 'transferred {0} files'.format(len(names))
+                        if self.link_from_cache(name, local_path):
+                            cached += 1
+                        else:
+                            # Written under another name and renamed over
+                            # the file, which may be linked to the cache
+                            remote_path = '{0}/{1}'.format(self.remote_path, name)
+                            sftp.get(remote_path, local_path + ".part")
+                            os.rename(local_path + ".part", local_path)
+                        self.manifest().update(name[:-len('.yang')], 'sftp')
+                        self.cache_module(name[:-len('.yang')])
+                    message = 'transferred {0} files, {1} from cache'.format(len(names) - cached, cached)
         except Exception as e:
             message = 'error occured {0}'.format(e)
             self.debug(message)
             self.debug(traceback.format_exc())
+        self.manifest().save()
 
         return {'yang-directory':self.yang_directory, 'message':message}
 
+    def link_from_cache(self, name, local_path):
+        # Only files named <module>@<revision>.yang tell the revision
+        # before they are transferred
+        (modname, _, revision) = name[:-len('.yang')].partition('@')
+        if not revision:
+            return False
+        try:
+            return self.yang_cache().link(modname, revision, local_path)
+        except (IOError, OSError) as e:
+            self.debug("Failed to link {0} from the YANG cache: {1}".format(name, e))
+            return False
+
     def _yang_sftp_read_settings(self):
         def safe_get(sock, th, path, default=None):
             try:
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent: 4 -*-
+"""Time of compiling a NED on one process and on several.
+
+Builds the dependency graph of generated modules, each importing a few
+of the previous ones, and runs them through ned_build.CompileScheduler
+with a command sleeping as long as a short ncsc run, once with one job
+and once with the given number. Checks that no module is started
+before the modules it depends on have finished.
+
+Usage: python bench_compile_scheduler.py [number-of-modules [jobs [seconds-per-module]]]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', '..', 'python', 'pioneer', 'op'))
+
+import ned_build
+import yang_deps
+
+
+def make_graph(count):
+    headers = []
+    for i in range(count):
+        header = yang_deps.ModuleHeader("m%d.yang" % i)
+        header.name = "m%d" % i
+        # Every tenth module starts a new chain
+        if i % 10:
+            header.imports = [("m%d" % j, None) for j in range(max(i - i % 10, i - 3), i)]
+        headers.append(header)
+    return yang_deps.DependencyGraph(headers)
+
+
+def run(graph, jobs, seconds):
+    finished = set()
+    errors = []
+
+    def output(name, text):
+        if text is None:
+            waiting = set(graph.closure(name)) - finished
+            if waiting:
+                errors.append("%s started before %s" % (name, " ".join(sorted(waiting))))
+
+    def check(name):
+        finished.add(name)
+        return True
+
+    scheduler = ned_build.CompileScheduler(list(graph.modules), graph, jobs)
+    start = time.time()
+    results = scheduler.run(lambda name: ["sleep", str(seconds)], output, 60, check)
+    elapsed = time.time() - start
+    if errors:
+        raise SystemExit("\n".join(errors))
+    if set(status for (status, text) in results.values()) != set(['ok']):
+        raise SystemExit("unexpected results %r" % results)
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    graph = make_graph(count)
+    single = run(graph, 1, seconds)
+    print("1 job: %d modules in %.2f s" % (count, single))
+    parallel = run(graph, jobs, seconds)
+    print("%d jobs: %d modules in %.2f s, %.1f times faster" % (jobs, count, parallel, single / parallel))
+
+
+if __name__ == '__main__':
+    main()
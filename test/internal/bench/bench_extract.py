@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent: 4 -*-
+"""Hello and get-schema reply parsing, xsltproc versus xml_extract.
+
+Runs the ncs-extract-capas.xsl and ncs-extract-module.xsl stylesheets
+through xsltproc, the way the yang ops used to, and the in-process
+extractors that replaced them, on canned replies. Prints the time per
+call for both and checks that they agree.
+
+Usage: python bench_extract.py [iterations]
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..')
+sys.path.insert(0, os.path.join(top, 'python', 'pioneer', 'op'))
+
+import xml_extract
+
+xsl_dir = os.path.join(top, 'src', 'xsl')
+
+
+def make_hello(num_capas):
+    capas = ''.join('<capability>http://example.com/ns/yang/mod-%d'
+                    '?module=mod-%d&amp;revision=2019-01-01</capability>' % (i, i)
+                    for i in range(num_capas))
+    return ('<hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">'
+            '<capabilities>' + capas + '</capabilities>'
+            '<session-id>1</session-id></hello>')
+
+
+def make_schema_reply(num_lines):
+    module = 'module mod {\n' + '  leaf x { type string; }\n' * num_lines + '}\n'
+    return ('<rpc-reply xmlns="urn:ietf:params:xml:ns:netconf:base:1.0" message-id="1">'
+            '<data xmlns="urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring">' +
+            module.replace('&', '&amp;').replace('<', '&lt;') +
+            '</data></rpc-reply>')
+
+
+def run_xsltproc(xsl, data):
+    proc = subprocess.Popen(['xsltproc', '--nonet', '--novalid',
+                             os.path.join(xsl_dir, xsl), '-'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (out, err) = proc.communicate(data.encode('utf-8'))
+    return out.decode('utf-8')
+
+
+def timeit(fun, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        result = fun()
+    return ((time.time() - start) / iterations, result)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    try:
+        subprocess.call(['xsltproc', '--version'],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        have_xsltproc = True
+    except OSError:
+        print("xsltproc not found, only timing xml_extract")
+        have_xsltproc = False
+
+    cases = [("hello, %d capas" % n, 'ncs-extract-capas.xsl', make_hello(n),
+              xml_extract.extract_capas, lambda capas: ''.join(c + '\n' for c in capas))
+             for n in (10, 1000)]
+    cases += [("get-schema, %d lines" % n, 'ncs-extract-module.xsl', make_schema_reply(n),
+               xml_extract.extract_module, lambda module: module)
+              for n in (100, 10000)]
+
+    print("%-24s %14s %14s %8s" % ("input", "xsltproc ms", "extract ms", "speedup"))
+    for (name, xsl, data, extract, as_text) in cases:
+        (t_extract, result) = timeit(lambda: extract(data), iterations)
+        if have_xsltproc:
+            (t_xslt, expected) = timeit(lambda: run_xsltproc(xsl, data), iterations)
+            if as_text(result) != expected:
+                raise SystemExit("%s: results differ" % name)
+            print("%-24s %14.2f %14.2f %7.0fx" % (name, t_xslt * 1000, t_extract * 1000,
+                                                 t_xslt / max(t_extract, 1e-9)))
+        else:
+            print("%-24s %14s %14.2f %8s" % (name, "-", t_extract * 1000, "-"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent: 4 -*-
+"""Receive and send throughput of the netconf_console transport framing.
+
+Feeds canned replies of increasing size, in both NETCONF 1.0 and 1.1
+framing, through NetconfSSHLikeTransport and prints MB/s for each.
+The reassembled reply is checked against what was sent, and no
+piece of it handed out may be larger than bufsiz. Then sends
+requests of the same sizes, written in pieces the way netconf-console
+pushes a file, and checks the framed output.
+
+Usage: python bench_framing.py [max-size-in-MB]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', '..', 'python', 'pioneer'))
+
+import netconf_console
+
+
+class IoCb(object):
+    def output(self, msg):
+        pass
+
+    def output_err(self, msg):
+        print(msg, file=sys.stderr)
+
+    def output_trace(self, msg):
+        pass
+
+    def abort(self, msg):
+        raise SystemExit(msg)
+
+
+class CannedTransport(netconf_console.NetconfSSHLikeTransport):
+    """Hands out a canned byte string in recv sized pieces, like a
+    socket would."""
+    def __init__(self, data, recv_size):
+        netconf_console.NetconfSSHLikeTransport.__init__(self, IoCb())
+        self.data = data
+        self.pos = 0
+        self.recv_size = recv_size
+        self.sent = []
+
+    def _recv(self, bufsiz):
+        n = min(bufsiz, self.recv_size)
+        s = self.data[self.pos:self.pos + n]
+        self.pos += len(s)
+        return s
+
+    def _set_timeout(self, timeout=None):
+        pass
+
+    def _send(self, buf):
+        self.sent.append(buf.tobytes() if isinstance(buf, memoryview) else bytes(buf))
+
+
+def make_reply(size):
+    row = (u'<row><name>r\u00e9sum\u00e9</name>'
+           u'<value>0123456789abcdef</value></row>\n').encode('utf-8')
+    body = row * (size // len(row) + 1)
+    return (b'<rpc-reply xmlns="urn:ietf:params:xml:ns:netconf:base:1.0" '
+            b'message-id="1"><data>' + body + b'</data></rpc-reply>')
+
+
+def frame(reply, framing, chunk_size):
+    if framing == netconf_console.FRAMING_1_0:
+        return reply + b']]>]]>'
+    framed = []
+    for i in range(0, len(reply), chunk_size):
+        chunk = reply[i:i + chunk_size]
+        framed.append(('\n#%d\n' % len(chunk)).encode('ascii') + chunk)
+    framed.append(b'\n##\n')
+    return b''.join(framed)
+
+
+def run(size, framing, chunk_size, recv_size):
+    reply = make_reply(size)
+    trans = CannedTransport(frame(reply, framing, chunk_size), recv_size)
+    trans.framing = framing
+    start = time.time()
+    pieces = []
+    while True:
+        (code, piece) = trans.recv_chunk()
+        pieces.append(piece)
+        if code != 1:
+            break
+    elapsed = max(time.time() - start, 1e-9)
+    if max(len(piece) for piece in pieces) > netconf_console.bufsiz:
+        raise SystemExit("piece larger than bufsiz, size %d framing %d" % (size, framing))
+    msg = "".join(pieces)
+    if not isinstance(msg, bytes):
+        msg = msg.encode('utf-8')
+    if msg != reply:
+        raise SystemExit("reply mismatch, size %d framing %d" % (size, framing))
+    return len(reply) / elapsed / (1024 * 1024)
+
+
+def run_send(size, framing, write_size):
+    request = make_reply(size)
+    trans = CannedTransport(b'', 0)
+    trans.framing = framing
+    start = time.time()
+    for i in range(0, len(request), write_size):
+        trans.send(request[i:i + write_size])
+    trans.send_eom()
+    elapsed = max(time.time() - start, 1e-9)
+    data = b''.join(trans.sent)
+    if framing == netconf_console.FRAMING_1_0:
+        expected = request + b']]>]]>'
+    else:
+        expected = frame(request, framing, write_size)
+    if data != expected:
+        raise SystemExit("sent data mismatch, size %d framing %d" % (size, framing))
+    return len(request) / elapsed / (1024 * 1024)
+
+
+def main():
+    max_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    print("%10s %8s %12s %10s" % ("size", "framing", "chunk", "MB/s"))
+    size = 64 * 1024
+    while size <= max_mb * 1024 * 1024:
+        for (name, framing, chunk_size) in (
+                ("1.0", netconf_console.FRAMING_1_0, 0),
+                ("1.1", netconf_console.FRAMING_1_1, 4093),
+                ("1.1", netconf_console.FRAMING_1_1, 1024 * 1024)):
+            mbps = run(size, framing, chunk_size, netconf_console.bufsiz)
+            print("%10d %8s %12s %10.1f" % (size, name, chunk_size or "-", mbps))
+        size *= 4
+    print()
+    print("%10s %8s %12s %10s" % ("size", "framing", "write", "send MB/s"))
+    size = 64 * 1024
+    while size <= max_mb * 1024 * 1024:
+        for (name, framing) in (("1.0", netconf_console.FRAMING_1_0),
+                                ("1.1", netconf_console.FRAMING_1_1)):
+            for write_size in (netconf_console.bufsiz, 1024 * 1024):
+                mbps = run_send(size, framing, write_size)
+                print("%10d %8s %12d %10.1f" % (size, name, write_size, mbps))
+        size *= 4
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent: 4 -*-
+"""Commits needed by explore-transitions, old scheduler versus
+transition_plan.
+
+Simulates runs over n recorded states where each transition fails
+with a given probability, and counts the commits made: one per
+transition plus one per start from a known state. The old scheduler
+took any transition left from the current state and jumped to a
+random state when there was none. Also checks that the plan makes
+every transition exactly once.
+
+Usage: python bench_transition_plan.py [runs]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', '..', 'python', 'pioneer', 'op'))
+
+import transition_plan
+
+
+def run_old(num_states, fail_rate):
+    remaining = {}
+    for from_state in range(num_states):
+        remaining[from_state] = dict((to_state, 1) for to_state in range(num_states)
+                                     if to_state != from_state)
+    commits = 0
+    from_state = None
+    while remaining:
+        if from_state not in remaining:
+            from_state = random.choice(list(remaining.keys()))
+            commits += 1
+        (to_state, dummy_val) = remaining[from_state].popitem()
+        if not remaining[from_state]:
+            del remaining[from_state]
+        commits += 1
+        from_state = None if random.random() < fail_rate else to_state
+    return commits
+
+
+def run_plan(num_states, fail_rate):
+    plan = transition_plan.TransitionPlan(num_states, 0, 0)
+    route = transition_plan.Route()
+    made = set()
+    from_state = None
+    while True:
+        taken = plan.take(route, from_state)
+        if taken is None:
+            break
+        (index, to_state) = taken
+        if index is None:
+            from_state = to_state
+            continue
+        if (from_state, to_state) in made:
+            raise SystemExit("transition made twice")
+        made.add((from_state, to_state))
+        from_state = None if random.random() < fail_rate else to_state
+    if len(made) != num_states * (num_states - 1):
+        raise SystemExit("transitions missing")
+    return plan.index + plan.starts
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print("%7s %6s %12s %12s %10s %9s" % ("states", "fail", "transitions",
+                                          "old commits", "commits", "plan ms"))
+    for num_states in (5, 20, 50):
+        for fail_rate in (0.0, 0.05, 0.2):
+            old = sum(run_old(num_states, fail_rate) for _ in range(runs)) / float(runs)
+            start = time.time()
+            new = sum(run_plan(num_states, fail_rate) for _ in range(runs)) / float(runs)
+            elapsed = (time.time() - start) / runs
+            print("%7d %6.2f %12d %12.1f %10.1f %9.1f" % (
+                num_states, fail_rate, num_states * (num_states - 1), old, new,
+                elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent: 4 -*-
+"""Time of finding the missing modules of a YANG directory.
+
+Writes a directory of generated modules, each importing a few of the
+previous ones and a module that does not exist, scans it with
+yang_deps and checks the missing module is found. With pyang in PATH,
+also times pyang -f depend on a sample of the modules, the way
+check-dependencies used to run it once per module.
+
+Usage: python bench_yang_deps.py [number-of-modules]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', '..', 'python', 'pioneer', 'op'))
+
+import yang_deps
+
+
+def write_modules(directory, count):
+    body = "  container c%d {\n    leaf l { type string; }\n  }\n"
+    for i in range(count):
+        imports = "".join("  import m%d { prefix p%d; }\n" % (j, j)
+                          for j in range(max(0, i - 5), i))
+        if i == count - 1:
+            imports += "  import not-there { prefix n; }\n"
+        with open(os.path.join(directory, "m%d.yang" % i), "w") as f:
+            f.write('module m%d {\n  namespace "urn:m%d";\n  prefix m%d;\n%s'
+                    '  revision 2020-01-01;\n%s}\n'
+                    % (i, i, i, imports, "".join(body % k for k in range(500))))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    directory = tempfile.mkdtemp()
+    try:
+        write_modules(directory, count)
+        start = time.time()
+        graph = yang_deps.scan_directory(directory)
+        missing = graph.missing()
+        elapsed = time.time() - start
+        if missing != {'not-there': ['m%d' % (count - 1)]}:
+            raise SystemExit("unexpected missing modules %r" % missing)
+        print("yang_deps: %d modules in %.3f s" % (count, elapsed))
+        try:
+            sample = 10
+            start = time.time()
+            for i in range(count - sample, count):
+                subprocess.call(["pyang", "-f", "depend", "--path", directory,
+                                 os.path.join(directory, "m%d.yang" % i)],
+                                stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+            elapsed = time.time() - start
+            print("pyang -f depend: %.3f s per module, about %.0f s for %d modules"
+                  % (elapsed / sample, elapsed / sample * count, count))
+        except OSError:
+            print("pyang not in PATH, skipping it")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent: 4 -*-
+"""Compares netconf_console.XmlFormatter with 'xmllint --format -'.
+
+Formats each document with both and prints the differences. The
+documents are fed to the formatter whole, one character at a time,
+and with a buffer limit small enough to make it print elements before
+their end. Exits with status 1 if any output differs from xmllint.
+
+Usage: python check_xml_format.py [file.xml ...]
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', '..', 'python', 'pioneer'))
+
+import netconf_console
+
+DOCUMENTS = [
+    '<rpc-reply message-id="1" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"'
+    ' xmlns:x="urn:x" a="b"><data><x:a>1</x:a></data></rpc-reply>',
+    '<a c="1" xmlns:y="urn:y" b="2" xmlns="urn:a"><y:b/></a>',
+    '<a><b>text<c/>more</b></a>',
+    '<a><b><c/>text</b></a>',
+    '<a><b><c/> <d/>text</b></a>',
+    '<a>\n  <b>\n    <c>t</c>\n  </b>\n  <d>  </d>\n</a>',
+    '<a>t <b> x </b> <c/>\n</a>',
+    '<a><b>  <c/></b><d>x<e>  <f/> </e></d></a>',
+    '<a><!-- c --><b/>x</a>',
+    '<a><!-- c --><b/></a>',
+    '<a>&amp; <b/></a>',
+    '<a> &amp;<b/></a>',
+    '<a><b/>\n  <c/><![CDATA[x]]></a>',
+    '<a><?pi x?><b>x</b></a>',
+    '<a xml:space="preserve"> <b> </b> </a>',
+    '<?xml version="1.0" encoding="UTF-8"?>\n<a>\n <b attr="&lt;&quot;">&lt;x&gt;</b>\n</a>',
+    '<!-- before --><a/><!-- after -->',
+    ''.join('<l%d>' % i for i in range(40)) + 'x' + ''.join('</l%d>' % i for i in reversed(range(40))),
+    ''.join('<l%d>' % i for i in range(40)) + '<e/>' + ''.join('</l%d>' % i for i in reversed(range(40))),
+    '<data>' + '<item><name>n%d</name><value/></item>' * 200 + '</data>',
+]
+
+
+def xmllint(document):
+    proc = subprocess.Popen(['xmllint', '--format', '-'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    (out, err) = proc.communicate(document.encode('utf-8'))
+    return out.decode('utf-8')
+
+
+def formatted(document, piece, max_buffered=None):
+    out = []
+    formatter = netconf_console.XmlFormatter(out.append)
+    if max_buffered is not None:
+        formatter.max_buffered = max_buffered
+    for i in range(0, len(document), piece or len(document) or 1):
+        formatter.feed(document[i:i + piece] if piece else document)
+        if not piece:
+            break
+    formatter.close()
+    out = "".join(out)
+    return out if isinstance(out, type(u'')) else out.decode('utf-8')
+
+
+def main():
+    documents = DOCUMENTS
+    if len(sys.argv) > 1:
+        documents = []
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                documents.append(f.read().decode('utf-8'))
+    differ = 0
+    for document in documents:
+        expected = xmllint(document)
+        runs = [('whole', formatted(document, None)),
+                ('by character', formatted(document, 1))]
+        if '<data>' in document:
+            # printed long before the end, xmllint gives the same
+            # here as no element has both text and children
+            runs.append(('limited buffer', formatted(document, 4096, 100)))
+        for (how, output) in runs:
+            if output != expected:
+                differ += 1
+                print("%s, fed %s:" % (document[:60], how))
+                print("  xmllint: %r" % expected[:400])
+                print("  got:     %r" % output[:400])
+    print("%d of %d documents differ" % (differ, len(documents)))
+    sys.exit(1 if differ else 0)
+
+
+if __name__ == '__main__':
+    main()